@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Накопительные подтверждения
+Вместо RECEIVED| на каждое сообщение - один ACK|<seq> на пачку
+(каждые N сообщений или через короткую задержку)
+"""
+
+import threading
+import time
+
+DEFAULT_ACK_DELAY = 0.02
+DEFAULT_ACK_BATCH = 32
+
+
+class AckBatcher:
+    """Подтверждения для клиентов с функцией batch_ack.
+
+    seq - сколько сообщений клиента принято на этом подключении,
+    ACK|seq подтверждает их все разом. Клиент, приславший меньше
+    batch сообщений, получает ACK не позже чем через delay секунд.
+    """
+
+    def __init__(self, server, delay=DEFAULT_ACK_DELAY, batch=DEFAULT_ACK_BATCH):
+        self.server = server
+        self.delay = delay
+        self.batch = max(1, batch)
+        # client_id -> срок отправки ACK
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.sent = 0
+
+    def received(self, record, count):
+        """Учесть count принятых сообщений. Вернуть текст ACK, если слать сразу"""
+        with self.lock:
+            record.ack_seq += count
+            record.ack_pending += count
+            if record.ack_pending >= self.batch:
+                record.ack_pending = 0
+                self.pending.pop(record.client_id, None)
+                self.sent += 1
+                return f"ACK|{record.ack_seq}"
+            if record.client_id not in self.pending:
+                self.pending[record.client_id] = time.monotonic() + self.delay
+        return None
+
+    def tick(self, now=None):
+        """Отправить ACK клиентам, чей срок наступил"""
+        if not self.pending:
+            return
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            for client_id, deadline in list(self.pending.items()):
+                if deadline <= now:
+                    del self.pending[client_id]
+                    record = self.server.clients.get(client_id)
+                    if record is not None and record.ack_pending:
+                        record.ack_pending = 0
+                        record.ack_flushed += 1
+                        due.append((record, record.ack_seq))
+            self.sent += len(due)
+        for record, seq in due:
+            self.server.send_control(record, f"ACK|{seq}")
+
+    def flush(self):
+        """Отправить все накопленные ACK сразу (остановка сервера)"""
+        self.tick(float('inf'))
+
+    def timeout(self, default):
+        """Таймаут select: не дольше delay, пока есть неотправленные ACK"""
+        return min(default, self.delay) if self.pending else default
+
+    def run(self):
+        """Поток таймера для движка threads"""
+        while self.server.server_running:
+            time.sleep(self.delay)
+            self.tick()
@@ -0,0 +1,776 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный тест сервера
+Много имитированных Android клиентов на localhost: подключения/сек,
+сообщения/сек, задержка подтверждения RECEIVED| и память на подключение
+"""
+
+import argparse
+import errno
+import multiprocessing
+import os
+import random
+import selectors
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from collections import deque
+
+from binary_protocol import BINARY_HEADER, SEQ, OP_TEXT, OP_RECEIVED, OP_ACK, pack_frame
+import compression
+from selector_engine import raise_fd_limit
+from tls_support import ensure_certificate, make_client_context
+
+FRAME_HEADER = struct.Struct('!I')
+PROTO_OK = b'PROTO_OK|'
+ACK_MARKER = b'RECEIVED|'
+BATCH_ACK_MARKER = b'ACK|'
+
+
+def read_rss(pid):
+    """Резидентная память процесса в байтах (None если узнать нельзя)"""
+    try:
+        with open(f"/proc/{pid}/status", encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except Exception:
+        return None
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run_server(options, ready, stop):
+    """Процесс с сервером без консоли"""
+    from messenger_server import SimpleTestServer
+
+    # Генератор нагрузки шлет со 127.0.0.1 быстрее любого телефона - лимиты
+    # сервера выключены, если сценарий не задал их явно
+    options = dict({'client_rate': 0, 'ip_rate': 0, 'accept_rate': 0}, **options)
+    server = SimpleTestServer(port=0, log_level='warning', quiet=True, **options)
+    server.listen()
+    server.port = server.server_socket.getsockname()[1]
+    server.start_engine()
+    ready.put((server.port, os.getpid()))
+    stop.wait()
+    server.stop()
+
+
+class LocalServer:
+    """Сервер в отдельном процессе - генератор нагрузки не делит с ним GIL"""
+
+    def __init__(self, options):
+        self.options = options
+        self.process = None
+        self.stop_event = None
+        self.port = None
+        self.pid = None
+
+    def __enter__(self):
+        context = multiprocessing.get_context()
+        ready = context.Queue()
+        self.stop_event = context.Event()
+        self.process = context.Process(target=run_server,
+                                       args=(self.options, ready, self.stop_event))
+        self.process.daemon = True
+        self.process.start()
+        self.port, self.pid = ready.get(timeout=15)
+        return self
+
+    def __exit__(self, *exc):
+        self.stop_event.set()
+        self.process.join(10)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class LoadClient:
+    """Один имитированный телефон"""
+
+    __slots__ = ('sock', 'buffer', 'framed', 'batch_ack', 'binary', 'compress', 'ready', 'sent_times', 'next_send',
+                 'acked', 'events', 'outbuf')
+
+    def __init__(self, sock, framed, batch_ack=False, binary=False, compress=0):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.framed = framed or binary
+        self.batch_ack = batch_ack
+        self.binary = binary
+        self.compress = compress if self.framed else 0
+        # raw клиент готов сразу, framed - после PROTO_OK
+        self.ready = not framed
+        self.sent_times = deque()
+        self.next_send = 0.0
+        self.acked = 0
+        self.events = selectors.EVENT_READ
+        self.outbuf = bytearray()
+
+    def encode(self, payload):
+        compressed = compression.maybe_compress(payload, self.compress)
+        if compressed is not None:
+            if self.binary:
+                return pack_frame(OP_TEXT | compression.OPCODE_FLAG, compressed)
+            return FRAME_HEADER.pack(len(compressed) | compression.FRAMED_FLAG) + compressed
+        if self.binary:
+            return pack_frame(OP_TEXT, payload)
+        if self.framed:
+            return FRAME_HEADER.pack(len(payload)) + payload
+        return payload
+
+    def take_acks(self):
+        """Сколько подтверждений пришло в буфере"""
+        count = 0
+        if not self.framed:
+            count = self.buffer.count(ACK_MARKER)
+            # Хвост мог оборваться посреди маркера - оставляем его
+            keep = len(ACK_MARKER) - 1
+            del self.buffer[:max(0, len(self.buffer) - keep)]
+            return count
+
+        if not self.ready:
+            start = self.buffer.find(PROTO_OK)
+            end = self.buffer.find(b'\n', start)
+            if start < 0 or end < 0:
+                return 0
+            del self.buffer[:end + 1]
+            self.ready = True
+
+        if self.binary:
+            return self._take_binary_acks()
+
+        offset = 0
+        while len(self.buffer) - offset >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            start = offset + FRAME_HEADER.size
+            if self.buffer.startswith(ACK_MARKER, start):
+                count += 1
+            elif self.batch_ack and self.buffer.startswith(BATCH_ACK_MARKER, start):
+                # ACK|seq подтверждает все сообщения до seq включительно
+                seq = int(self.buffer[start + len(BATCH_ACK_MARKER):end])
+                count += seq - self.acked
+                self.acked = seq
+            offset = end
+        del self.buffer[:offset]
+        return count
+
+    def _take_binary_acks(self):
+        count = 0
+        offset = 0
+        while len(self.buffer) - offset >= BINARY_HEADER.size:
+            length, opcode, _ = BINARY_HEADER.unpack_from(self.buffer, offset)
+            end = offset + BINARY_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            if opcode == OP_RECEIVED:
+                count += 1
+            elif opcode == OP_ACK:
+                (seq,) = SEQ.unpack_from(self.buffer, offset + BINARY_HEADER.size)
+                count += seq - self.acked
+                self.acked = seq
+            offset = end
+        del self.buffer[:offset]
+        return count
+
+
+class LoadGenerator:
+    """Генератор нагрузки на одном цикле selectors"""
+
+    def __init__(self, host, port, clients, rate, size, framed, connect_batch, batch_ack=False,
+                 binary=False, compress=0):
+        self.host = host
+        self.port = port
+        self.count = clients
+        self.rate = rate
+        self.size = size
+        self.framed = framed
+        self.connect_batch = connect_batch
+        self.binary = binary
+        self.batch_ack = batch_ack and (framed or binary)
+        self.compress = compress
+        # Сколько байт ушло на сервер (с заголовками и сжатием)
+        self.bytes_sent = 0
+        self.selector = selectors.DefaultSelector()
+        self.clients = []
+        self.latencies = []
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        # Сколько recv вернули данные - примерно число пакетов от сервера
+        self.reads = 0
+
+    def connect_all(self, timeout=30.0):
+        """Подключить всех клиентов пачками, вернуть время в секундах"""
+        started = time.perf_counter()
+        deadline = started + timeout
+        pending = 0
+        index = 0
+        while (index < self.count or pending) and time.perf_counter() < deadline:
+            while index < self.count and pending < self.connect_batch:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setblocking(False)
+                sock.connect_ex((self.host, self.port))
+                self.selector.register(sock, selectors.EVENT_WRITE, None)
+                pending += 1
+                index += 1
+            for key, _ in self.selector.select(timeout=1.0):
+                if key.data is not None:
+                    continue
+                sock = key.fileobj
+                pending -= 1
+                error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error:
+                    self.errors += 1
+                    self.selector.unregister(sock)
+                    sock.close()
+                    continue
+                client = LoadClient(sock, self.framed, self.batch_ack, self.binary,
+                                    self.compress)
+                if client.framed:
+                    features = [b'binary,v1' if self.binary else b'framed']
+                    if self.batch_ack:
+                        features.append(b'batch_ack')
+                    if client.compress:
+                        features.append(b'deflate')
+                    client.outbuf += b'PROTO|' + b','.join(features) + b'\n'
+                    client.events = selectors.EVENT_READ | selectors.EVENT_WRITE
+                self.selector.modify(sock, client.events, client)
+                self.clients.append(client)
+        return time.perf_counter() - started
+
+    def run(self, duration):
+        """Гонять сообщения duration секунд, затем дождаться хвоста подтверждений"""
+        # Реалистичный текст - повторяющиеся 'x' сжимались бы нечестно хорошо
+        payloads = [text.encode('utf-8') for text in chat_corpus(256, self.size)]
+        interval = 1.0 / self.rate if self.rate > 0 else None
+        now = time.perf_counter()
+        if interval:
+            # Разносим клиентов по интервалу, чтобы не слать все разом
+            for i, client in enumerate(self.clients):
+                client.next_send = now + interval * i / max(1, len(self.clients))
+
+        started = now
+        stop_sending = started + duration
+        drain_deadline = stop_sending + 5.0
+        while True:
+            now = time.perf_counter()
+            if now >= stop_sending and (self.acked >= self.sent or now >= drain_deadline):
+                break
+
+            if interval and now < stop_sending:
+                for client in self.clients:
+                    if client.ready and now >= client.next_send:
+                        client.next_send += interval
+                        client.sent_times.append(now)
+                        data = client.encode(payloads[self.sent % len(payloads)])
+                        client.outbuf += data
+                        self.bytes_sent += len(data)
+                        self.sent += 1
+                        self._want_write(client)
+
+            for key, mask in self.selector.select(timeout=0.005):
+                client = key.data
+                if client is None:
+                    continue
+                if mask & selectors.EVENT_WRITE:
+                    self._write(client)
+                if mask & selectors.EVENT_READ:
+                    self._read(client)
+        return time.perf_counter() - started
+
+    def _want_write(self, client):
+        if not client.events & selectors.EVENT_WRITE:
+            client.events |= selectors.EVENT_WRITE
+            self.selector.modify(client.sock, client.events, client)
+
+    def _write(self, client):
+        try:
+            sent = client.sock.send(client.outbuf)
+            del client.outbuf[:sent]
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.errors += 1
+            return
+        if not client.outbuf:
+            client.events = selectors.EVENT_READ
+            self.selector.modify(client.sock, client.events, client)
+
+    def _read(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.errors += 1
+            return
+        if not data:
+            return
+        self.reads += 1
+        now = time.perf_counter()
+        client.buffer += data
+        for _ in range(client.take_acks()):
+            if client.sent_times:
+                self.latencies.append(now - client.sent_times.popleft())
+                self.acked += 1
+
+    def close(self):
+        for client in self.clients:
+            try:
+                self.selector.unregister(client.sock)
+            except (KeyError, ValueError):
+                pass
+            client.sock.close()
+        self.selector.close()
+
+
+def benchmark_mode(args):
+    """Название режима протокола для отчета"""
+    if args.raw:
+        return 'raw'
+    mode = 'binary' if args.binary else 'framed'
+    if args.batch_ack:
+        mode += ',batch_ack'
+    if args.compress:
+        mode += f',deflate>={args.compress}'
+    return mode
+
+
+def run_chat_benchmark(args):
+    """Основной сценарий: подключения + поток сообщений"""
+    store_dir = tempfile.mkdtemp(prefix='bench-store-')
+    options = {'engine': args.engine, 'store_dir': store_dir}
+    with LocalServer(options) as server:
+        time.sleep(0.3)
+        rss_before = read_rss(server.pid)
+
+        generator = LoadGenerator('127.0.0.1', server.port, args.clients, args.rate,
+                                  args.size, not args.raw, args.connect_batch,
+                                  args.batch_ack, args.binary, args.compress)
+        connect_time = generator.connect_all()
+        # Даем серверу принять и поприветствовать всех
+        time.sleep(1.0)
+        rss_after = read_rss(server.pid)
+
+        elapsed = generator.run(args.duration)
+        generator.close()
+    shutil.rmtree(store_dir, ignore_errors=True)
+
+    latencies = sorted(generator.latencies)
+    connected = len(generator.clients)
+    report = {
+        'engine': args.engine,
+        'mode': benchmark_mode(args),
+        'clients': connected,
+        'connect_per_sec': connected / connect_time if connect_time else 0.0,
+        'sent': generator.sent,
+        'acked': generator.acked,
+        'messages_per_sec': generator.acked / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] * 1000) if latencies else 0.0,
+        'errors': generator.errors,
+        'bytes_per_message': generator.bytes_sent / generator.sent if generator.sent else 0.0,
+        'reads_per_message': generator.reads / generator.sent if generator.sent else 0.0,
+        'memory_per_conn': None
+    }
+    if rss_before and rss_after and connected:
+        report['memory_per_conn'] = (rss_after - rss_before) / connected
+    return report
+
+
+CHAT_WORDS = ("привет как дела что нового сегодня завтра вечером встреча через час "
+              "давай позвони потом хорошо понял ладно спасибо пока фото файл "
+              "hello ok thanks see you soon call me later yes no where when").split()
+
+
+def chat_corpus(count, size, seed=1):
+    """Сообщения, похожие на переписку: разной длины, русский и английский,
+    иногда ссылки и JSON. size - средняя длина в байтах"""
+    rng = random.Random(seed)
+    messages = []
+    for _ in range(count):
+        length = max(2, int(rng.lognormvariate(0, 0.8) * size))
+        words = []
+        while sum(len(word.encode('utf-8')) + 1 for word in words) < length:
+            words.append(rng.choice(CHAT_WORDS))
+        text = ' '.join(words)
+        kind = rng.random()
+        if kind < 0.05:
+            text += f" https://example.com/photo/{rng.randrange(10 ** 6)}.jpg"
+        elif kind < 0.10:
+            text = f'{{"type":"text","text":"{text}"}}'
+        messages.append(text)
+    return messages
+
+
+def run_compression_benchmark(args):
+    """Сжатие: CPU на сообщение против сэкономленных байт"""
+    corpus = [text.encode('utf-8') for text in chat_corpus(20000, args.size)]
+    total = sum(len(data) for data in corpus)
+
+    def measure(name, func):
+        started = time.perf_counter()
+        size = sum(len(func(data)) for data in corpus)
+        elapsed = time.perf_counter() - started
+        return (name, size / total, elapsed / len(corpus) * 1e6)
+
+    def plain_deflate(data):
+        compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+        return compressor.compress(data) + compressor.flush()
+
+    stream = zlib.compressobj(6, zlib.DEFLATED, -15)
+
+    def streaming(data):
+        # Один контекст на подключение: лучше сжатие, но своя память
+        # у каждого клиента и рассылку нельзя сжать один раз на всех
+        return stream.compress(data) + stream.flush(zlib.Z_SYNC_FLUSH)
+
+    results = [
+        measure('без сжатия', lambda data: data),
+        measure('deflate', plain_deflate),
+        measure('поток на подключение', streaming),
+        measure('словарь (сервер)', compression.compress),
+    ]
+    for threshold in (64, 128, 256):
+        results.append(measure(f'словарь, порог {threshold}',
+                               lambda data, threshold=threshold:
+                               compression.maybe_compress(data, threshold) or data))
+
+    packed = [compression.compress(data) for data in corpus]
+    started = time.perf_counter()
+    for data in packed:
+        compression.decompress(data, 1024 * 1024)
+    unpack_us = (time.perf_counter() - started) / len(packed) * 1e6
+    return {'messages': len(corpus), 'average': total / len(corpus),
+            'results': results, 'decompress_us': unpack_us}
+
+
+def print_compression_report(report):
+    """Печать результатов сжатия"""
+    print("=" * 60)
+    print(f"[BENCH] Сжатие: {report['messages']} сообщений, "
+          f"в среднем {report['average']:.0f} байт")
+    print("-" * 60)
+    for name, ratio, cpu_us in report['results']:
+        print(f"[ZLIB] {name:<24} {ratio * 100:5.1f}% размера, {cpu_us:6.1f} мкс/сообщение")
+    print(f"[UNZIP] Распаковка со словарем: {report['decompress_us']:.1f} мкс/сообщение")
+    print("=" * 60)
+
+
+def time_handshakes(port, context, count, resume):
+    """Время TLS рукопожатий в секундах и сколько сессий возобновлено"""
+    times = []
+    reused = 0
+    session = None
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        started = time.perf_counter()
+        tls = context.wrap_socket(sock, session=session if resume else None)
+        times.append(time.perf_counter() - started)
+        reused += tls.session_reused
+        # Билет TLS 1.3 приходит после рукопожатия - вместе с приветствием
+        tls.recv(1024)
+        if resume:
+            session = tls.session
+        tls.close()
+    return sorted(times), reused
+
+
+def steady_throughput(port, context, count, size):
+    """Сообщений в секунду по одному подключению (пачками по 100)"""
+    sock = socket.create_connection(('127.0.0.1', port))
+    if context:
+        sock = context.wrap_socket(sock)
+    sock.recv(1024)
+    sock.sendall(b'PROTO|framed\n')
+    reply = b''
+    while b'\n' not in reply:
+        reply += sock.recv(1024)
+    frame = FRAME_HEADER.pack(size) + b'x' * size
+    started = time.perf_counter()
+    acked = 0
+    tail = b''
+    while acked < count:
+        batch = min(100, count - acked)
+        sock.sendall(frame * batch)
+        received = 0
+        while received < batch:
+            data = tail + sock.recv(65536)
+            received += data.count(ACK_MARKER)
+            tail = data[-(len(ACK_MARKER) - 1):]
+        acked += received
+    elapsed = time.perf_counter() - started
+    sock.close()
+    return count / elapsed
+
+
+def run_tls_benchmark(args):
+    """TLS: полное и возобновленное рукопожатие, поток сообщений с TLS и без"""
+    directory = tempfile.mkdtemp(prefix='bench-tls-')
+    cert = os.path.join(directory, 'server.crt')
+    key = os.path.join(directory, 'server.key')
+    count = max(100, int(args.rate * args.duration * args.clients))
+    try:
+        ensure_certificate(cert, key)
+        context = make_client_context(cert)
+        options = {'engine': 'selectors', 'tls_cert': cert, 'tls_key': key}
+        with LocalServer(options) as server:
+            full, _ = time_handshakes(server.port, context, args.clients, False)
+            resumed, reused = time_handshakes(server.port, context, args.clients, True)
+            tls_rate = steady_throughput(server.port, context, count, args.size)
+        with LocalServer({'engine': 'selectors'}) as server:
+            plain_rate = steady_throughput(server.port, None, count, args.size)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'handshakes': args.clients,
+        'full_p50_ms': percentile(full, 0.5) * 1000,
+        'full_p99_ms': percentile(full, 0.99) * 1000,
+        'resumed_p50_ms': percentile(resumed, 0.5) * 1000,
+        'resumed_p99_ms': percentile(resumed, 0.99) * 1000,
+        'reused': reused,
+        'messages': count,
+        'tls_rate': tls_rate,
+        'plain_rate': plain_rate
+    }
+
+
+def print_tls_report(report):
+    """Печать результатов TLS"""
+    print("=" * 60)
+    print(f"[BENCH] TLS: {report['handshakes']} рукопожатий, {report['messages']} сообщений")
+    print("-" * 60)
+    print(f"[FULL] Полное рукопожатие: p50 {report['full_p50_ms']:.2f} мс, "
+          f"p99 {report['full_p99_ms']:.2f} мс")
+    print(f"[RESUME] С билетом сессии: p50 {report['resumed_p50_ms']:.2f} мс, "
+          f"p99 {report['resumed_p99_ms']:.2f} мс, "
+          f"возобновлено {report['reused']}/{report['handshakes']}")
+    print(f"[STEADY] TLS {report['tls_rate']:.0f} сообщений/сек, "
+          f"без TLS {report['plain_rate']:.0f} сообщений/сек "
+          f"({report['tls_rate'] / report['plain_rate'] * 100:.0f}%)")
+    print("=" * 60)
+
+
+def connect_storm(port, count, timeout=30.0):
+    """Все подключения разом (точка доступа перезагрузилась).
+    Вернуть отсортированные времена до приветствия и число неудач"""
+    selector = selectors.DefaultSelector()
+    started = time.perf_counter()
+    failures = 0
+    for _ in range(count):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        if sock.connect_ex(('127.0.0.1', port)) not in (0, errno.EINPROGRESS):
+            failures += 1
+            sock.close()
+            continue
+        selector.register(sock, selectors.EVENT_READ)
+
+    times = []
+    done = []
+    deadline = started + timeout
+    while selector.get_map() and time.perf_counter() < deadline:
+        for key, _ in selector.select(timeout=0.1):
+            sock = key.fileobj
+            selector.unregister(sock)
+            done.append(sock)
+            try:
+                data = sock.recv(256)
+            except OSError:
+                data = b''
+            if data.startswith(b'SERVER_CONNECTED'):
+                times.append(time.perf_counter() - started)
+            else:
+                failures += 1
+    # Не дождались приветствия за timeout
+    for key in list(selector.get_map().values()):
+        failures += 1
+        done.append(key.fileobj)
+    selector.close()
+    for sock in done:
+        sock.close()
+    return sorted(times), failures
+
+
+def run_storm_benchmark(args):
+    """Шторм подключений: за сколько сервер примет и поприветствует всех"""
+    from messenger_server import DEFAULT_BACKLOG
+
+    raise_fd_limit()
+    backlogs = [args.backlog] if args.backlog else [5, DEFAULT_BACKLOG]
+    results = []
+    for backlog in backlogs:
+        options = {'engine': args.engine, 'backlog': backlog}
+        with LocalServer(options) as server:
+            time.sleep(0.3)
+            times, failures = connect_storm(server.port, args.clients)
+        # Время восстановления имеет смысл, только если приняты все
+        complete = not failures and len(times) == args.clients
+        results.append({
+            'backlog': backlog,
+            'welcomed': len(times),
+            'failures': failures,
+            'complete': complete,
+            'p50_ms': percentile(times, 0.5) * 1000,
+            'p99_ms': percentile(times, 0.99) * 1000,
+            'recovery_s': times[-1] if complete else None
+        })
+    return {'engine': args.engine, 'clients': args.clients, 'results': results}
+
+
+def print_storm_report(report):
+    """Печать результатов шторма подключений"""
+    print("=" * 60)
+    print(f"[BENCH] Шторм подключений: {report['clients']} клиентов разом, "
+          f"движок {report['engine']}")
+    print("-" * 60)
+    for result in report['results']:
+        if result['complete']:
+            outcome = f"все приняты за {result['recovery_s']:.2f} сек"
+        else:
+            outcome = "ПРОВАЛ - приняты не все"
+        print(f"[BACKLOG {result['backlog']}] Приняты: {result['welcomed']}, "
+              f"неудач: {result['failures']}, {outcome}")
+        print(f"   До приветствия: p50 {result['p50_ms']:.1f} мс, p99 {result['p99_ms']:.1f} мс")
+    print("=" * 60)
+
+
+def run_store_benchmark(args):
+    """Журнал сообщений: скорость append и догрузки FETCH"""
+    from message_store import MessageStore
+
+    count = max(1, int(args.rate * args.duration * args.clients))
+    text = 'x' * args.size
+    directory = tempfile.mkdtemp(prefix='bench-store-')
+    try:
+        store = MessageStore(directory)
+        started = time.perf_counter()
+        for _ in range(count):
+            store.append(text, 'bench', '*')
+        append_time = time.perf_counter() - started
+        store.sync()
+        sync_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        fetched = 0
+        after = 0
+        while True:
+            batch = store.read_after(after, 1000)
+            if not batch:
+                break
+            fetched += len(batch)
+            after = batch[-1][0]
+        fetch_time = time.perf_counter() - started
+        store.close()
+
+        # Перезапуск: восстановление индекса с диска
+        started = time.perf_counter()
+        MessageStore(directory, readonly=True)
+        reopen_time = time.perf_counter() - started
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return {
+        'count': count,
+        'appends_per_sec': count / append_time if append_time else 0.0,
+        'durable_per_sec': count / sync_time if sync_time else 0.0,
+        'fetch_per_sec': fetched / fetch_time if fetch_time else 0.0,
+        'reopen_ms': reopen_time * 1000
+    }
+
+
+def print_store_report(report):
+    """Печать результатов журнала"""
+    print("=" * 60)
+    print(f"[BENCH] Журнал сообщений: {report['count']} записей")
+    print("-" * 60)
+    print(f"[APPEND] {report['appends_per_sec']:.0f} записей/сек")
+    print(f"[FSYNC] {report['durable_per_sec']:.0f} записей/сек с учетом fsync")
+    print(f"[FETCH] {report['fetch_per_sec']:.0f} записей/сек при догрузке")
+    print(f"[REOPEN] Индекс восстановлен за {report['reopen_ms']:.1f} мс")
+    print("=" * 60)
+
+
+def print_report(report):
+    """Печать результатов"""
+    print("=" * 60)
+    print(f"[BENCH] Движок: {report['engine']}, режим: {report['mode']}")
+    print("-" * 60)
+    print(f"[CONNECT] Клиентов: {report['clients']}, "
+          f"{report['connect_per_sec']:.0f} подключений/сек")
+    print(f"[MESSAGES] Отправлено: {report['sent']}, подтверждено: {report['acked']}")
+    print(f"[THROUGHPUT] {report['messages_per_sec']:.0f} сообщений/сек")
+    print(f"[PACKETS] {report['reads_per_message']:.2f} ответов сервера на сообщение, "
+          f"{report['bytes_per_message']:.0f} байт на сообщение от клиента")
+    print(f"[LATENCY] p50 {report['p50_ms']:.2f} мс, p99 {report['p99_ms']:.2f} мс, "
+          f"max {report['max_ms']:.2f} мс")
+    if report['memory_per_conn'] is not None:
+        print(f"[MEMORY] {report['memory_per_conn'] / 1024:.1f} КБ на подключение")
+    else:
+        print("[MEMORY] Нет данных (нужен /proc или psutil)")
+    print(f"[ERRORS] Ошибок: {report['errors']}")
+    print("=" * 60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Simple Test Server")
+    parser.add_argument('--scenario', choices=('chat', 'store', 'compression', 'tls', 'storm'),
+                        default='chat',
+                        help="chat - клиенты и сообщения, store - журнал сообщений, "
+                             "compression - цена и выгода сжатия, tls - цена TLS, "
+                             "storm - все клиенты подключаются разом")
+    parser.add_argument('--engine', choices=('threads', 'selectors'), default='selectors',
+                        help="движок сервера")
+    parser.add_argument('--clients', type=int, default=200, help="число клиентов")
+    parser.add_argument('--rate', type=float, default=5.0,
+                        help="сообщений в секунду от каждого клиента")
+    parser.add_argument('--size', type=int, default=64, help="размер сообщения в байтах")
+    parser.add_argument('--duration', type=float, default=10.0,
+                        help="длительность отправки в секундах")
+    parser.add_argument('--raw', action='store_true',
+                        help="старый raw режим вместо length-prefixed кадров")
+    parser.add_argument('--binary', action='store_true',
+                        help="бинарный протокол v1 вместо текстовых кадров")
+    parser.add_argument('--compress', type=int, default=0,
+                        help="сжимать сообщения клиентов от стольких байт (deflate)")
+    parser.add_argument('--batch-ack', action='store_true',
+                        help="накопительные ACK вместо RECEIVED| на каждое сообщение")
+    parser.add_argument('--connect-batch', type=int, default=64,
+                        help="сколько подключений открывать одновременно")
+    parser.add_argument('--backlog', type=int, default=0,
+                        help="очередь подключений сервера для storm (0 - сравнить 5 и по умолчанию)")
+    args = parser.parse_args()
+
+    if args.scenario == 'store':
+        print_store_report(run_store_benchmark(args))
+    elif args.scenario == 'compression':
+        print_compression_report(run_compression_benchmark(args))
+    elif args.scenario == 'tls':
+        print_tls_report(run_tls_benchmark(args))
+    elif args.scenario == 'storm':
+        print_storm_report(run_storm_benchmark(args))
+    else:
+        print_report(run_chat_benchmark(args))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Бинарный протокол (версия 1)
+Кадр: заголовок !IBI (длина тела, код операции, время epoch в секундах) + тело.
+Согласуется рукопожатием "PROTO|binary[,v1]"; текстовый протокол остается.
+"""
+
+import struct
+import time
+
+from compression import OPCODE_FLAG, maybe_compress
+
+BINARY_VERSIONS = ('v1',)
+
+# Длина тела, код операции, время отправки (целые секунды epoch)
+BINARY_HEADER = struct.Struct('!IBI')
+LENGTH = struct.Struct('!I')
+SEQ = struct.Struct('!Q')
+
+# Коды операций
+OP_TEXT = 1       # сообщение или текстовая команда (FETCH|, ROOM|, MSG| ...)
+OP_RECEIVED = 2   # подтверждение одного сообщения, тело - длина сообщения !I
+OP_ACK = 3        # накопительное подтверждение, тело - seq !Q
+OP_PING = 4
+OP_PONG = 5
+# Старший бит кода (OPCODE_FLAG) - тело сжато, см. compression.py
+
+# Текстовые служебные сообщения, у которых есть свой код
+CONTROL_OPCODES = {'PING': OP_PING, 'PONG': OP_PONG, 'ACK': OP_ACK}
+
+
+def pack_frame(opcode, body=b'', timestamp=None):
+    """Собрать кадр"""
+    if timestamp is None:
+        timestamp = int(time.time())
+    return BINARY_HEADER.pack(len(body), opcode, timestamp) + body
+
+
+def encode_received(length, timestamp):
+    """Подтверждение приема сообщения длиной length"""
+    return BINARY_HEADER.pack(LENGTH.size, OP_RECEIVED, timestamp) + LENGTH.pack(length)
+
+
+def encode_text(text, compress=0):
+    """Текст сервера -> кадр; PING|, PONG| и ACK| получают свой код.
+    compress - порог сжатия тела TEXT (0 - без сжатия)"""
+    name, separator, argument = text.partition('|')
+    opcode = CONTROL_OPCODES.get(name) if separator else None
+    if opcode == OP_ACK:
+        return pack_frame(OP_ACK, SEQ.pack(int(argument)))
+    if opcode is not None:
+        return pack_frame(opcode, timestamp=int(argument))
+    body = text.encode('utf-8')
+    compressed = maybe_compress(body, compress)
+    if compressed is not None:
+        return pack_frame(OP_TEXT | OPCODE_FLAG, compressed)
+    return pack_frame(OP_TEXT, body)
+
+
+def decode_frame(opcode, body):
+    """Кадр клиента -> текст для обработки сервером (None - пропустить)"""
+    if opcode == OP_TEXT:
+        return str(body, 'utf-8')
+    if opcode == OP_PING:
+        return 'PING'
+    if opcode == OP_PONG:
+        return 'PONG'
+    return None
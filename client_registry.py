@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Реестр подключенных клиентов
+Компактные записи (__slots__), поиск за O(1), снимки для обхода без блокировки
+"""
+
+import threading
+import time
+
+
+class ClientRecord:
+    """Запись об одном клиенте"""
+
+    __slots__ = ('client_id', 'socket', 'address', 'connected', 'decoder', 'queue',
+                 'bytes_in', 'messages_in', 'messages_out', 'last_activity', 'events',
+                 'ack_seq', 'ack_pending', 'ack_flushed', 'handshaking', 'bucket', 'paused_until',
+                 'backpressure')
+
+    def __init__(self, client_id, sock, address, decoder, queue):
+        self.client_id = client_id
+        self.socket = sock
+        self.address = address
+        self.connected = time.time()
+        self.decoder = decoder
+        self.queue = queue
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        # time.monotonic() последнего приема (для heartbeat)
+        self.last_activity = 0.0
+        # Маска событий selectors (используется только движком selectors)
+        self.events = 0
+        # Накопительные подтверждения: принято сообщений / еще не подтверждено
+        self.ack_seq = 0
+        self.ack_pending = 0
+        # ACK, отправленные таймером AckBatcher. Отдельно от messages_out:
+        # тот счетчик меняет поток клиента без блокировки, этот - только
+        # таймер под блокировкой AckBatcher
+        self.ack_flushed = 0
+        # Идет TLS рукопожатие - данные приложения еще не отправляются
+        self.handshaking = False
+        # Лимит сообщений (rate_limit.TokenBucket или None) и паузы чтения:
+        # до какого time.monotonic() клиент превысил лимит / очередь заполнена
+        self.bucket = None
+        self.paused_until = 0.0
+        self.backpressure = False
+
+    @property
+    def bytes_out(self):
+        """Сколько байт реально ушло в сокет"""
+        return self.queue.bytes_sent
+
+
+class ClientRegistry:
+    """Потокобезопасный реестр клиентов.
+
+    Изменения идут под блокировкой. Чтение для обхода (рассылка, статистика)
+    берет неизменяемый снимок-кортеж: он пересобирается только после изменений,
+    поэтому обход никогда не видит "dictionary changed size during iteration".
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = {}
+        self._snapshot = ()
+        self._dirty = False
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, client_id):
+        return client_id in self.records
+
+    def __bool__(self):
+        return bool(self.records)
+
+    def get(self, client_id):
+        """Запись по client_id или None"""
+        return self.records.get(client_id)
+
+    def add(self, record):
+        """Добавить клиента"""
+        with self.lock:
+            self.records[record.client_id] = record
+            self._dirty = True
+
+    def remove(self, client_id):
+        """Удалить клиента, вернуть запись (None если уже удален)"""
+        with self.lock:
+            record = self.records.pop(client_id, None)
+            if record is not None:
+                self._dirty = True
+            return record
+
+    def snapshot(self):
+        """Кортеж всех записей на текущий момент"""
+        if self._dirty:
+            with self.lock:
+                if self._dirty:
+                    self._snapshot = tuple(self.records.values())
+                    self._dirty = False
+        return self._snapshot
+
+    def ids(self):
+        """Список client_id на текущий момент"""
+        return [record.client_id for record in self.snapshot()]
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Сжатие сообщений (функция "deflate" в рукопожатии)
+Raw deflate каждого сообщения отдельно с общим словарем: без состояния
+на подключение, рассылка сжимается один раз для всех получателей
+"""
+
+import zlib
+
+# Окно 4 КБ и memLevel 5: создание контекста в разы дешевле, чем по умолчанию,
+# а для коротких сообщений со словарем сжатие то же самое
+LEVEL = 6
+WBITS = -12
+MEM_LEVEL = 5
+
+# Сообщения короче порога не сжимаются (служебные ответы, короткие реплики)
+DEFAULT_THRESHOLD = 128
+
+# Флаг сжатого кадра: старший бит длины (framed) или кода операции (binary)
+FRAMED_FLAG = 0x80000000
+OPCODE_FLAG = 0x80
+
+# Словарь v1 - его же должен знать клиент. Частые строки ближе к концу.
+DICTIONARY = (
+    "https:// http:// .jpg .png .mp4 {\"type\":\"text\",\"text\":\"\"} "
+    "thanks thank you please sorry what where when today tomorrow tonight "
+    "hello hi ok okay yes no see you soon call me later message file photo "
+    "спасибо пожалуйста извини почему когда где сегодня завтра вечером утром "
+    "позвони напиши потом фото файл сообщение встреча через час минут "
+    "как дела что нового нормально хорошо давай понял ладно можно нужно "
+    "ROOM| DM| MSG| FETCH| JOIN| LOGIN| SERVER: "
+    "привет пока да нет это что как все уже еще только тоже очень "
+    " и в не на я что он с по а то как но это ты мы вы "
+).encode('utf-8')
+
+
+class CompressionError(Exception):
+    """Битые сжатые данные или превышен размер после распаковки"""
+
+
+def compress(data):
+    """Сжать одно сообщение"""
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WBITS, MEM_LEVEL, zdict=DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data, max_size):
+    """Распаковать одно сообщение не больше max_size байт"""
+    decompressor = zlib.decompressobj(WBITS, zdict=DICTIONARY)
+    try:
+        result = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise CompressionError(f"Битые сжатые данные: {e}")
+    if decompressor.unconsumed_tail:
+        raise CompressionError(f"Сообщение больше {max_size} байт после распаковки")
+    if not decompressor.eof:
+        raise CompressionError("Сжатые данные оборваны")
+    return result
+
+
+def maybe_compress(payload, threshold):
+    """Сжатые данные или None, если сжимать не стоит"""
+    if not threshold or len(payload) < threshold:
+        return None
+    compressed = compress(payload)
+    return compressed if len(compressed) < len(payload) else None
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Heartbeat клиентов
+PING после простоя, отключение мертвых клиентов по колесу таймеров
+"""
+
+import socket
+import threading
+import time
+
+from timer_wheel import TimerWheel
+from message_framing import MODE_RAW
+
+DEFAULT_PING_INTERVAL = 30.0
+DEFAULT_IDLE_TIMEOUT = 90.0
+
+# Сообщения протокола heartbeat
+PING = 'PING'
+PONG = 'PONG'
+
+
+def enable_keepalive(sock, idle_timeout):
+    """TCP keepalive - ядро само найдет пропавший телефон (для raw клиентов)"""
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle_timeout)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except OSError:
+        pass
+
+
+class Heartbeat:
+    """Слежение за простоем клиентов.
+
+    Активность клиента - только запись record.last_activity, колесо при этом
+    не трогается. Таймер клиента при срабатывании сам решает: клиент был
+    активен - перепланировать, молчит ping_interval - отправить PING,
+    молчит idle_timeout - отключить. Старым raw клиентам PING не шлется
+    (они показали бы его как сообщение), их проверяет TCP keepalive.
+    """
+
+    def __init__(self, server, ping_interval=DEFAULT_PING_INTERVAL,
+                 idle_timeout=DEFAULT_IDLE_TIMEOUT, tick=1.0):
+        self.server = server
+        self.ping_interval = ping_interval
+        self.idle_timeout = max(idle_timeout, ping_interval)
+        self.wheel = TimerWheel(tick)
+        # client_id -> его единственный живой таймер. client_id (ip:port)
+        # может достаться новому подключению - старый таймер отменяется,
+        # иначе он сработал бы по новому клиенту раньше срока
+        self.timers = {}
+        self.lock = threading.Lock()
+        self.pings_sent = 0
+        self.evicted = 0
+
+    def track(self, record):
+        """Начать следить за новым клиентом"""
+        record.last_activity = time.monotonic()
+        enable_keepalive(record.socket, self.idle_timeout)
+        with self.lock:
+            old = self.timers.pop(record.client_id, None)
+            if old is not None:
+                self.wheel.cancel(old)
+            self.timers[record.client_id] = self.wheel.schedule(record.client_id,
+                                                                self.ping_interval)
+
+    def untrack(self, client_id):
+        """Клиент отключился - снять его таймер"""
+        with self.lock:
+            timer = self.timers.pop(client_id, None)
+            if timer is not None:
+                self.wheel.cancel(timer)
+
+    def _reschedule(self, client_id, delay):
+        with self.lock:
+            # Пока шла проверка, id занял новый клиент - у него свой таймер
+            if client_id not in self.timers:
+                self.timers[client_id] = self.wheel.schedule(client_id, delay)
+
+    def tick(self, now=None):
+        """Обработать сработавшие таймеры (дешево, если тик еще не наступил)"""
+        now = time.monotonic() if now is None else now
+        for timer in self.wheel.advance(now):
+            with self.lock:
+                if self.timers.get(timer.key) is not timer:
+                    continue
+                del self.timers[timer.key]
+            record = self.server.clients.get(timer.key)
+            if record is None:
+                continue
+            self._check(record, now)
+
+    def _check(self, record, now):
+        idle = now - record.last_activity
+        if record.handshaking:
+            # TLS рукопожатие занимает миллисекунды - застрявшее не ждем
+            self.evicted += 1
+            self.server.metrics.error('tls')
+            self.server.log.info('IDLE', "Клиент %s не завершил TLS рукопожатие - отключаю",
+                                 record.client_id)
+            self.server.disconnect_client(record.client_id)
+            return
+        if record.decoder.mode in (None, MODE_RAW):
+            # Raw клиент: только перепланировать, решает TCP keepalive
+            self._reschedule(record.client_id, max(self.ping_interval - idle, self.wheel.tick))
+            return
+
+        if idle >= self.idle_timeout:
+            self.evicted += 1
+            self.server.metrics.error('idle_timeout')
+            self.server.log.info('IDLE', "Клиент %s молчит %.0f сек - отключаю",
+                                 record.client_id, idle)
+            self.server.disconnect_client(record.client_id)
+        elif idle >= self.ping_interval:
+            self.pings_sent += 1
+            self.server.send_control(record, f"{PING}|{int(time.time())}")
+            self._reschedule(record.client_id, self.idle_timeout - idle)
+        else:
+            self._reschedule(record.client_id, self.ping_interval - idle)
+
+    def run(self):
+        """Поток тиков для движка threads"""
+        while self.server.server_running:
+            time.sleep(self.wheel.tick)
+            self.tick()
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Горячий перезапуск
+Новый процесс забирает у старого слушающий сокет и подключения клиентов
+(передача дескрипторов через Unix сокет) - телефоны не переподключаются
+"""
+
+import base64
+import json
+import os
+import socket
+import struct
+import threading
+
+# send_fds/recv_fds есть только на Unix (Python 3.9+)
+HANDOFF_SUPPORTED = hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+REQUEST = b'TAKEOVER\n'
+HEADER = struct.Struct('!I')
+
+# Дескрипторов в одном сообщении (предел ядра Linux SCM_MAX_FD = 253)
+MAX_FDS = 200
+
+# Сколько новый процесс ждет старый (передача и отправка очередей остальным)
+TAKEOVER_TIMEOUT = 30.0
+
+
+class HandoffError(Exception):
+    """Передача сокетов не удалась"""
+
+
+class Inherited:
+    """Что новый процесс получил от старого"""
+
+    def __init__(self, listener):
+        self.listener = listener
+        # (сокет, состояние клиента)
+        self.clients = []
+
+
+def _json_default(value):
+    if isinstance(value, bytes):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError(f"Не сериализуется: {type(value).__name__}")
+
+
+def _json_object(value):
+    if '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def _send(channel, payload, fds=()):
+    """Сообщение: длина !I + JSON, дескрипторы - вместе с первым байтом"""
+    body = json.dumps(payload, default=_json_default).encode('utf-8')
+    data = HEADER.pack(len(body)) + body
+    sent = socket.send_fds(channel, [data], list(fds)) if fds else channel.send(data)
+    if sent < len(data):
+        channel.sendall(data[sent:])
+
+
+def _recv_exact(channel, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = channel.recv(size - len(data))
+        if not chunk:
+            raise HandoffError("Старый процесс закрыл соединение")
+        data += chunk
+    return bytes(data)
+
+
+def _recv(channel):
+    """Прочитать одно сообщение, вернуть (payload, список дескрипторов)"""
+    header, fds, _, _ = socket.recv_fds(channel, HEADER.size, MAX_FDS)
+    if not header:
+        raise HandoffError("Старый процесс закрыл соединение")
+    header += _recv_exact(channel, HEADER.size - len(header))
+    (length,) = HEADER.unpack(header)
+    payload = json.loads(_recv_exact(channel, length), object_hook=_json_object)
+    return payload, fds
+
+
+def send_handoff(channel, listener, clients):
+    """Старый процесс: отдать слушающий сокет и клиентов [(сокет, состояние)]"""
+    _send(channel, {'port': listener.getsockname()[1], 'clients': len(clients)},
+          [listener.fileno()])
+    for start in range(0, len(clients), MAX_FDS):
+        batch = clients[start:start + MAX_FDS]
+        _send(channel, {'clients': [state for _, state in batch]},
+              [sock.fileno() for sock, _ in batch])
+
+
+def finish_handoff(channel):
+    """Старый процесс: журналы закрыты, новый может начинать"""
+    try:
+        _send(channel, {'done': True})
+    finally:
+        channel.close()
+
+
+def take_over(path, timeout=TAKEOVER_TIMEOUT):
+    """Новый процесс: забрать сокеты у процесса, слушающего path.
+    None - старого процесса нет (обычный запуск)."""
+    channel = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    channel.settimeout(timeout)
+    try:
+        channel.connect(path)
+    except FileNotFoundError:
+        channel.close()
+        return None
+    except ConnectionRefusedError:
+        # Файл остался от упавшего процесса
+        channel.close()
+        os.unlink(path)
+        return None
+
+    try:
+        channel.sendall(REQUEST)
+        payload, fds = _recv(channel)
+        if len(fds) != 1:
+            raise HandoffError("Не получен слушающий сокет")
+        inherited = Inherited(socket.socket(fileno=fds[0]))
+        expected = payload['clients']
+        while len(inherited.clients) < expected:
+            payload, fds = _recv(channel)
+            states = payload.get('clients', ())
+            if len(fds) != len(states):
+                for fd in fds:
+                    os.close(fd)
+                raise HandoffError("Число сокетов не совпадает с описанием клиентов")
+            inherited.clients.extend((socket.socket(fileno=fd), state)
+                                     for fd, state in zip(fds, states))
+        payload, _ = _recv(channel)
+        if not payload.get('done'):
+            raise HandoffError("Старый процесс не завершил передачу")
+        return inherited
+    finally:
+        channel.close()
+
+
+class HandoffListener:
+    """Старый процесс: ждет на Unix сокете запроса от нового процесса"""
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.sock = None
+        self.thread = None
+
+    def start(self):
+        """Открыть Unix сокет (права только для владельца)"""
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen(1)
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                channel, _ = self.sock.accept()
+            except OSError:
+                return
+            try:
+                channel.settimeout(5.0)
+                if _recv_exact(channel, len(REQUEST)) != REQUEST:
+                    channel.close()
+                    continue
+                channel.settimeout(None)
+            except (OSError, HandoffError):
+                channel.close()
+                continue
+            # При успехе сервер остановится сам, иначе ждем следующий запрос
+            if self.server.hand_off(channel):
+                return
+
+    def close(self):
+        """Закрыть Unix сокет и удалить файл"""
+        if self.sock is None:
+            return
+        try:
+            # shutdown будит поток, заблокированный в accept
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
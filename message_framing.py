@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Разбиение потока TCP на сообщения
+Поддержка length-prefixed кадров и старого raw режима
+"""
+
+import codecs
+import struct
+
+from binary_protocol import BINARY_HEADER, BINARY_VERSIONS, decode_frame, encode_text
+from compression import (CompressionError, FRAMED_FLAG, OPCODE_FLAG, DEFAULT_THRESHOLD,
+                         decompress, maybe_compress)
+
+# Размер чтения из сокета (сообщения могут быть больше 1 КБ)
+RECV_SIZE = 65536
+
+# Максимальный размер одного кадра
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Рукопожатие: клиент первым делом шлет "PROTO|framed\n",
+# сервер отвечает "PROTO_OK|framed\n" и дальше все идет кадрами.
+# Старые клиенты ничего не шлют - остаются в raw режиме.
+HANDSHAKE_PREFIX = b'PROTO|'
+HANDSHAKE_REPLY = 'PROTO_OK'
+MAX_HANDSHAKE_SIZE = 256
+
+MODE_RAW = 'raw'
+MODE_FRAMED = 'framed'
+MODE_BINARY = 'binary'
+SUPPORTED_MODES = (MODE_FRAMED, MODE_BINARY)
+
+# Дополнительные функции после режима: "PROTO|framed,batch_ack"
+FEATURE_BATCH_ACK = 'batch_ack'
+FEATURE_DEFLATE = 'deflate'
+SUPPORTED_FEATURES = (FEATURE_BATCH_ACK, FEATURE_DEFLATE)
+
+HEADER = struct.Struct('!I')
+
+
+class FrameError(Exception):
+    """Ошибка разбора потока (слишком большой кадр, битый UTF-8)"""
+
+
+class FrameDecoder:
+    """Декодер сообщений для одного подключения"""
+
+    def __init__(self, max_frame=MAX_FRAME_SIZE, compress_threshold=DEFAULT_THRESHOLD):
+        self.mode = None
+        self.features = ()
+        self.max_frame = max_frame
+        self.compress_threshold = compress_threshold
+        # Порог сжатия исходящих для этого клиента (0 - не сжимать)
+        self.compress = 0
+        self.buffer = bytearray()
+        self.handshake_done = False
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def feed(self, data):
+        """Добавить принятые байты, вернуть список готовых сообщений"""
+        if self.mode is None:
+            self.buffer += data
+            if (len(self.buffer) < len(HANDSHAKE_PREFIX)
+                    and HANDSHAKE_PREFIX.startswith(self.buffer)):
+                # Рукопожатие могло прийти по частям - ждем остаток префикса
+                return []
+            if not self.buffer.startswith(HANDSHAKE_PREFIX):
+                # Старый клиент - весь первый кусок считаем raw сообщением
+                self.mode = MODE_RAW
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return self._feed_raw(data)
+            if not self._read_handshake():
+                return []
+            if self.mode == MODE_RAW:
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return self._feed_raw(data) if data else []
+        elif self.mode == MODE_RAW:
+            return self._feed_raw(data)
+        else:
+            self.buffer += data
+
+        if self.mode == MODE_BINARY:
+            return self._parse_binary()
+        return self._parse_frames()
+
+    def encode(self, text):
+        """Закодировать сообщение для этого клиента (режим и сжатие)"""
+        return encode_message(text, self.mode, self.compress)
+
+    def export_state(self):
+        """Состояние декодера для передачи другому процессу (горячий перезапуск)"""
+        pending, _ = self.text_decoder.getstate()
+        return {
+            'mode': self.mode,
+            'features': list(self.features),
+            'compress': self.compress,
+            'buffer': bytes(self.buffer),
+            'text_pending': pending
+        }
+
+    def restore_state(self, state):
+        """Продолжить разбор с места, где остановился другой процесс"""
+        self.mode = state['mode']
+        self.features = tuple(state['features'])
+        self.compress = state['compress']
+        self.buffer = bytearray(state['buffer'])
+        self.text_decoder.setstate((state['text_pending'], 0))
+
+    def take_handshake_reply(self):
+        """Ответ на рукопожатие (один раз), иначе None"""
+        if self.handshake_done:
+            self.handshake_done = False
+            reply = ','.join((self.mode,) + self.features)
+            return f"{HANDSHAKE_REPLY}|{reply}\n".encode()
+        return None
+
+    def _read_handshake(self):
+        """Разобрать строку PROTO|mode[,feature...]"""
+        end = self.buffer.find(b'\n')
+        if end < 0:
+            if len(self.buffer) > MAX_HANDSHAKE_SIZE:
+                raise FrameError("Слишком длинное рукопожатие")
+            return False
+
+        line = bytes(self.buffer[len(HANDSHAKE_PREFIX):end]).decode('ascii', 'replace').strip()
+        del self.buffer[:end + 1]
+
+        parts = [p.strip() for p in line.split(',') if p.strip()]
+        requested = parts[0] if parts else MODE_RAW
+        self.mode = requested if requested in SUPPORTED_MODES else MODE_RAW
+        if self.mode == MODE_RAW:
+            self.features = ()
+        else:
+            self.features = tuple(p for p in parts[1:] if p in SUPPORTED_FEATURES)
+        if self.mode == MODE_BINARY:
+            # Версия протокола: запрошенная клиентом, если знаем ее, иначе новейшая
+            versions = [p for p in parts[1:] if p in BINARY_VERSIONS]
+            self.features = (versions[0] if versions else BINARY_VERSIONS[-1],) + self.features
+        if FEATURE_DEFLATE in self.features:
+            if self.compress_threshold:
+                self.compress = self.compress_threshold
+            else:
+                # Сжатие выключено на сервере - не подтверждаем функцию
+                self.features = tuple(p for p in self.features if p != FEATURE_DEFLATE)
+        self.handshake_done = True
+        return True
+
+    def _feed_raw(self, data):
+        """Raw режим: каждый кусок - одно сообщение (как раньше)"""
+        try:
+            text = self.text_decoder.decode(bytes(data))
+        except UnicodeDecodeError as e:
+            raise FrameError(f"Битый UTF-8: {e}")
+        message = text.strip()
+        return [message] if message else []
+
+    def _parse_frames(self):
+        """Достать все целые кадры из буфера (pipelining)"""
+        messages = []
+        buffer = self.buffer
+        view = memoryview(buffer)
+        offset = 0
+        try:
+            while len(buffer) - offset >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer, offset)
+                compressed = self.compress and length & FRAMED_FLAG
+                if compressed:
+                    length &= ~FRAMED_FLAG
+                if length > self.max_frame:
+                    raise FrameError(f"Кадр слишком большой: {length} байт")
+                end = offset + HEADER.size + length
+                if end > len(buffer):
+                    break
+                # Срез передается без сохранения: иначе буфер нельзя будет сжать
+                messages.append(self._decode_text(view[offset + HEADER.size:end], compressed))
+                offset = end
+        finally:
+            view.release()
+        if offset:
+            del buffer[:offset]
+        return messages
+
+    def _decode_text(self, body, compressed, opcode=None):
+        """Тело кадра -> текст (opcode - для бинарного режима)"""
+        try:
+            if compressed:
+                body = decompress(body, self.max_frame)
+            if opcode is None:
+                return str(body, 'utf-8')
+            return decode_frame(opcode, body)
+        except UnicodeDecodeError as e:
+            raise FrameError(f"Битый UTF-8: {e}")
+        except CompressionError as e:
+            raise FrameError(str(e))
+
+    def _parse_binary(self):
+        """Достать все целые бинарные кадры из буфера"""
+        messages = []
+        buffer = self.buffer
+        view = memoryview(buffer)
+        offset = 0
+        try:
+            while len(buffer) - offset >= BINARY_HEADER.size:
+                length, opcode, _ = BINARY_HEADER.unpack_from(buffer, offset)
+                if length > self.max_frame:
+                    raise FrameError(f"Кадр слишком большой: {length} байт")
+                start = offset + BINARY_HEADER.size
+                end = start + length
+                if end > len(buffer):
+                    break
+                compressed = self.compress and opcode & OPCODE_FLAG
+                if compressed:
+                    opcode &= ~OPCODE_FLAG
+                message = self._decode_text(view[start:end], compressed, opcode)
+                if message is not None:
+                    messages.append(message)
+                offset = end
+        finally:
+            view.release()
+        if offset:
+            del buffer[:offset]
+        return messages
+
+
+def encode_message(text, mode, compress=0):
+    """Закодировать сообщение для клиента в его режиме.
+    compress - порог сжатия в байтах (0 - без сжатия)"""
+    if mode == MODE_BINARY:
+        return encode_text(text, compress)
+    payload = text.encode('utf-8')
+    if mode == MODE_FRAMED:
+        compressed = maybe_compress(payload, compress)
+        if compressed is not None:
+            return HEADER.pack(len(compressed) | FRAMED_FLAG) + compressed
+        return HEADER.pack(len(payload)) + payload
+    return payload
+
+
+class EncodedCache:
+    """Кодирует одно сообщение один раз для каждого режима"""
+
+    def __init__(self, text, texts=None):
+        self.text = text
+        # Свой текст для отдельных режимов: {режим: текст}
+        self.texts = texts or {}
+        self.encoded = {}
+
+    def get(self, mode, compress=0):
+        key = (mode, compress)
+        data = self.encoded.get(key)
+        if data is None:
+            data = encode_message(self.texts.get(mode, self.text), mode, compress)
+            self.encoded[key] = data
+        return data
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Постоянное хранилище сообщений
+Append-only сегменты на диске, индекс смещений в памяти, пакетный fsync
+"""
+
+import heapq
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import islice
+
+# Заголовок записи: crc32, длина тела, seq, время
+RECORD_HEADER = struct.Struct('!IIQd')
+# Тело: длины отправителя и канала, затем отправитель, канал, текст
+BODY_HEADER = struct.Struct('!HH')
+
+SEGMENT_SUFFIX = '.log'
+DEFAULT_SEGMENT_BYTES = 16 * 1024 * 1024
+DEFAULT_FSYNC_INTERVAL = 0.05
+# Сколько сегментов хранить сервером по умолчанию (64 x 16 МБ = 1 ГБ на журнал)
+DEFAULT_MAX_SEGMENTS = 64
+WRITE_BUFFER = 1024 * 1024
+
+
+class Segment:
+    """Один файл сегмента и смещения его записей"""
+
+    def __init__(self, base_seq, path):
+        self.base_seq = base_seq
+        self.path = path
+        # offsets[i] - смещение записи с seq = base_seq + i
+        self.offsets = array('Q')
+        self.size = 0
+
+    @property
+    def last_seq(self):
+        return self.base_seq + len(self.offsets) - 1
+
+
+def encode_record(seq, timestamp, sender, channel, text):
+    """Байты одной записи"""
+    sender_bytes = sender.encode('utf-8')
+    channel_bytes = channel.encode('utf-8')
+    body = (BODY_HEADER.pack(len(sender_bytes), len(channel_bytes))
+            + sender_bytes + channel_bytes + text.encode('utf-8'))
+    crc = zlib.crc32(struct.pack('!Qd', seq, timestamp) + body)
+    return RECORD_HEADER.pack(crc, len(body), seq, timestamp) + body
+
+
+def decode_body(body):
+    """Тело записи -> (отправитель, канал, текст)"""
+    sender_len, channel_len = BODY_HEADER.unpack_from(body)
+    start = BODY_HEADER.size
+    sender = body[start:start + sender_len].decode('utf-8')
+    start += sender_len
+    channel = body[start:start + channel_len].decode('utf-8')
+    start += channel_len
+    return sender, channel, body[start:].decode('utf-8')
+
+
+class MessageStore:
+    """Журнал сообщений с последовательными номерами (seq с 1).
+
+    append только пишет в буфер файла, на диск (flush + fsync) данные
+    уходят пачкой из фонового потока раз в fsync_interval секунд.
+    readonly - просмотр журнала, который ведет другой процесс (воркеры).
+    shared - у журнала есть такие читатели: каждая запись сразу уходит
+    в ОС (flush без fsync), чтобы FETCH в воркере ее увидел.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES,
+                 fsync_interval=DEFAULT_FSYNC_INTERVAL, max_segments=0, readonly=False,
+                 shared=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_interval = fsync_interval
+        self.max_segments = max_segments
+        self.readonly = readonly
+        self.shared = shared
+        self.segments = []
+        self.bases = []
+        # Канал -> seq его записей по возрастанию (FETCH по каналам без полного скана)
+        self.channels = {}
+        self.next_seq = 1
+        self.file = None
+        self.dirty = False
+        self.closed = False
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+        self.flusher = None
+        if not readonly:
+            self._open_active()
+            self.flusher = threading.Thread(target=self._flush_loop, name='message-store')
+            self.flusher.daemon = True
+            self.flusher.start()
+
+    @property
+    def last_seq(self):
+        return self.next_seq - 1
+
+    def _segment_path(self, base_seq):
+        return os.path.join(self.directory, f"{base_seq:020d}{SEGMENT_SUFFIX}")
+
+    def _load(self):
+        """Прочитать сегменты с диска и построить индекс"""
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.endswith(SEGMENT_SUFFIX))
+        for name in names:
+            try:
+                base_seq = int(name[:-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            if any(segment.base_seq == base_seq for segment in self.segments):
+                continue
+            segment = Segment(base_seq, os.path.join(self.directory, name))
+            self.segments.append(segment)
+            self.bases.append(base_seq)
+            self._scan(segment)
+        if self.segments:
+            self.next_seq = self.segments[-1].base_seq + len(self.segments[-1].offsets)
+
+    def _scan(self, segment):
+        """Дочитать записи сегмента начиная с segment.size"""
+        with open(segment.path, 'rb') as f:
+            f.seek(segment.size)
+            data = f.read()
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            crc, length, seq, timestamp = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if end > len(data):
+                break
+            body = data[offset + RECORD_HEADER.size:end]
+            if (zlib.crc32(struct.pack('!Qd', seq, timestamp) + body) != crc
+                    or seq != segment.base_seq + len(segment.offsets)):
+                break
+            segment.offsets.append(segment.size + offset)
+            self._index_channel(body, seq)
+            offset = end
+        valid_end = segment.size + offset
+
+        if not self.readonly and offset < len(data):
+            # Оборванный хвост после сбоя - отрезаем
+            with open(segment.path, 'r+b') as f:
+                f.truncate(valid_end)
+        segment.size = valid_end
+
+    def _index_channel(self, body, seq):
+        sender_len, channel_len = BODY_HEADER.unpack_from(body)
+        start = BODY_HEADER.size + sender_len
+        channel = bytes(body[start:start + channel_len]).decode('utf-8')
+        self.channels.setdefault(channel, array('Q')).append(seq)
+
+    def _open_active(self):
+        """Открыть последний сегмент на дозапись (или создать новый)"""
+        if not self.segments:
+            self._new_segment()
+            return
+        segment = self.segments[-1]
+        self.file = open(segment.path, 'ab', buffering=WRITE_BUFFER)
+        self._apply_retention()
+
+    def _new_segment(self):
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+        segment = Segment(self.next_seq, self._segment_path(self.next_seq))
+        self.file = open(segment.path, 'ab', buffering=WRITE_BUFFER)
+        self.segments.append(segment)
+        self.bases.append(segment.base_seq)
+        self._apply_retention()
+
+    def _apply_retention(self):
+        """Удалить самые старые сегменты сверх max_segments"""
+        if not self.max_segments or len(self.segments) <= self.max_segments:
+            return
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.pop(0)
+            self.bases.pop(0)
+            try:
+                os.remove(segment.path)
+            except OSError:
+                pass
+        self._trim_channels()
+
+    def _trim_channels(self):
+        """Убрать из индекса каналов seq удаленных сегментов"""
+        first = self.bases[0] if self.bases else self.next_seq
+        for channel in list(self.channels):
+            seqs = self.channels[channel]
+            cut = bisect_left(seqs, first)
+            if cut == len(seqs):
+                del self.channels[channel]
+            elif cut:
+                del seqs[:cut]
+
+    def append(self, text, sender='', channel='', timestamp=None):
+        """Добавить сообщение, вернуть его seq"""
+        if self.readonly:
+            raise RuntimeError("Хранилище открыто только для чтения")
+        timestamp = time.time() if timestamp is None else timestamp
+        with self.lock:
+            seq = self.next_seq
+            record = encode_record(seq, timestamp, sender, channel, text)
+            segment = self.segments[-1]
+            if segment.size and segment.size + len(record) > self.segment_bytes:
+                self._new_segment()
+                segment = self.segments[-1]
+            self.file.write(record)
+            if self.shared:
+                self.file.flush()
+            segment.offsets.append(segment.size)
+            segment.size += len(record)
+            self.channels.setdefault(channel, array('Q')).append(seq)
+            self.next_seq += 1
+            self.dirty = True
+        return seq
+
+    def refresh(self):
+        """Подхватить записи, добавленные другим процессом (для readonly)"""
+        with self.lock:
+            # Сегменты, удаленные ротацией у писателя
+            dropped = False
+            while self.segments and not os.path.exists(self.segments[0].path):
+                self.segments.pop(0)
+                self.bases.pop(0)
+                dropped = True
+            if dropped:
+                self._trim_channels()
+            if self.segments:
+                self._scan(self.segments[-1])
+            self._load()
+            if self.segments:
+                last = self.segments[-1]
+                self.next_seq = last.base_seq + len(last.offsets)
+
+    def read_after(self, after_seq, limit=100, channels=None):
+        """Сообщения с seq > after_seq: список (seq, время, отправитель, канал, текст)"""
+        with self.lock:
+            if self.file and self.dirty:
+                # Читателю нужны данные из буфера записи
+                self.file.flush()
+            start = max(after_seq + 1, self.bases[0] if self.bases else 1)
+            if channels is None:
+                seqs = range(start, min(self.next_seq, start + limit))
+            else:
+                # Слияние индексов нужных каналов - читаются только их записи
+                sources = []
+                for channel in channels:
+                    seqs = self.channels.get(channel)
+                    if seqs:
+                        sources.append(islice(seqs, bisect_left(seqs, start), None))
+                seqs = list(islice(heapq.merge(*sources), limit))
+            return self._read_seqs(seqs)
+
+    def _read_seqs(self, seqs):
+        """Прочитать записи по возрастающим seq, один open на сегмент"""
+        result = []
+        current = None
+        f = None
+        try:
+            for seq in seqs:
+                index = bisect_right(self.bases, seq) - 1
+                if index < 0:
+                    continue
+                segment = self.segments[index]
+                if seq > segment.last_seq:
+                    continue
+                if segment is not current:
+                    if f:
+                        f.close()
+                    current = segment
+                    f = open(segment.path, 'rb')
+                f.seek(segment.offsets[seq - segment.base_seq])
+                _, length, _, timestamp = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                sender, channel, text = decode_body(f.read(length))
+                result.append((seq, timestamp, sender, channel, text))
+        finally:
+            if f:
+                f.close()
+        return result
+
+    def sync(self):
+        """Сбросить буфер и сделать fsync прямо сейчас"""
+        with self.lock:
+            if not self.file or not self.dirty:
+                return
+            self.file.flush()
+            self.dirty = False
+            # Копия дескриптора: смена сегмента может закрыть файл, пока
+            # идет fsync вне замка, а номер fd тут же займет другой файл
+            fd = os.dup(self.file.fileno())
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def _flush_loop(self):
+        """Групповой fsync: одна синхронизация на все записи за интервал"""
+        while not self.closed:
+            self.wakeup.wait(self.fsync_interval)
+            self.sync()
+
+    def close(self):
+        """Дописать все на диск и закрыть"""
+        if self.closed:
+            return
+        self.closed = True
+        self.wakeup.set()
+        if self.flusher:
+            self.flusher.join(2.0)
+        self.sync()
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
@@ -8,45 +8,301 @@ import socket
 import threading
 import time
 import os
+import random
+import signal
+import argparse
 from datetime import datetime
 
+from selector_engine import SelectorEngine, ACCEPT_BATCH
+from worker_pool import WorkerPool, reuse_port_supported
+from server_log import ServerLog, LEVELS
+from client_registry import ClientRecord, ClientRegistry
+import network_info
+from heartbeat import Heartbeat, PING, PONG, DEFAULT_PING_INTERVAL, DEFAULT_IDLE_TIMEOUT
+from server_metrics import (ServerMetrics, MetricsEndpoint, merge_snapshots,
+                            latency_percentile)
+from message_framing import (FrameDecoder, EncodedCache, RECV_SIZE, MODE_RAW,
+                             MODE_FRAMED, MODE_BINARY, FEATURE_BATCH_ACK)
+from binary_protocol import encode_received
+from compression import DEFAULT_THRESHOLD
+from tls_support import DEFAULT_CERT, DEFAULT_KEY, ensure_certificate, make_server_context
+from ack_batcher import AckBatcher, DEFAULT_ACK_DELAY, DEFAULT_ACK_BATCH
+from message_store import MessageStore, DEFAULT_MAX_SEGMENTS
+from subscriptions import SubscriptionIndex, valid_name
+from rate_limit import RateLimiter, DEFAULT_CLIENT_RATE, DEFAULT_IP_RATE, DEFAULT_ACCEPT_RATE
+from port_mapping import LeaseManager, METHODS as MAPPING_METHODS, DEFAULT_LIFETIME
+from hot_restart import (HANDOFF_SUPPORTED, HandoffError, HandoffListener, finish_handoff,
+                         send_handoff, take_over)
+from outbound_queue import (OutboundQueue, QueueOverflow, POLICIES, POLICY_DROP,
+                            DEFAULT_MAX_BYTES, MAX_BATCH_CHUNKS)
+
+ENGINES = ('threads', 'selectors')
+
+# Каналы журнала: рассылки всем и входящие сообщения клиентов
+CHANNEL_BROADCAST = '*'
+CHANNEL_INBOX = 'inbox'
+# Комнаты и личные сообщения хранятся в каналах '#комната' и '@пользователь'
+ROOM_PREFIX = '#'
+USER_PREFIX = '@'
+ROUTING_COMMANDS = ('LOGIN|', 'JOIN|', 'LEAVE|', 'ROOM|', 'DM|')
+DEFAULT_STORE_DIR = 'messages'
+FETCH_LIMIT = 100
+MAX_FETCH_LIMIT = 1000
+
+# Плавная остановка: сколько ждать отправки очередей и в каком окне
+# клиентам раздается задержка переподключения RECONNECT|<мс>
+DEFAULT_DRAIN_TIMEOUT = 5.0
+DEFAULT_RECONNECT_SPREAD = 10.0
+RECONNECT = 'RECONNECT'
+
+# Очередь ядра для еще не принятых подключений: после перезагрузки точки
+# доступа сотни телефонов переподключаются разом (ядро урежет до somaxconn)
+DEFAULT_BACKLOG = 1024
+
+def format_stored(seq, sender, channel, text):
+    """Сообщение канала в виде для клиента"""
+    if channel.startswith(ROOM_PREFIX):
+        return f"ROOM|{seq}|{channel[1:]}|{sender}|{text}"
+    if channel.startswith(USER_PREFIX):
+        return f"DM|{seq}|{sender}|{text}"
+    return f"MSG|{seq}|{text}"
+
 class SimpleTestServer:
-    def __init__(self, port=8888):
+    def __init__(self, port=8888, engine='threads', queue_limit=DEFAULT_MAX_BYTES,
+                 slow_policy=POLICY_DROP, workers=1, reuse_port=False,
+                 log_level='info', log_file=None, quiet=False, metrics_port=0,
+                 ping_interval=DEFAULT_PING_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 store_dir=None, store_readonly=False, inbox_name='inbox',
+                 store_max_segments=DEFAULT_MAX_SEGMENTS,
+                 ack_delay=DEFAULT_ACK_DELAY, ack_batch=DEFAULT_ACK_BATCH, nodelay=True,
+                 compress_threshold=DEFAULT_THRESHOLD, tls_cert=None, tls_key=None,
+                 drain_timeout=DEFAULT_DRAIN_TIMEOUT,
+                 reconnect_spread=DEFAULT_RECONNECT_SPREAD, handoff_path=None, inherited=None,
+                 client_rate=DEFAULT_CLIENT_RATE, ip_rate=DEFAULT_IP_RATE,
+                 accept_rate=DEFAULT_ACCEPT_RATE, backlog=DEFAULT_BACKLOG,
+                 port_mapping=None, mapping_lifetime=DEFAULT_LIFETIME):
+        if engine not in ENGINES:
+            raise ValueError(f"Неизвестный движок: {engine}")
+        if slow_policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика: {slow_policy}")
+        if tls_cert and engine != 'selectors':
+            # В движке threads сокет читают и пишут два потока, а объект
+            # TLS соединения нельзя использовать из двух потоков сразу
+            raise ValueError("TLS работает только с движком selectors")
         self.port = port
-        self.clients = {}
+        self.backlog = backlog
+        self.clients = ClientRegistry()
         self.server_running = False
+        # Плавная остановка: новые подключения не принимаются,
+        # очереди клиентов дописываются до drain_timeout
+        self.draining = False
+        self.drain_started = threading.Event()
+        self.drain_timeout = drain_timeout
+        self.reconnect_spread = reconnect_spread
+        # Адрес подключения, которым stop_accepting будит поток в accept
+        self.waker_address = None
+        # Горячий перезапуск: Unix сокет для передачи порта и клиентов
+        # новому процессу; inherited - то, что получено от старого
+        self.handoff_path = handoff_path
+        self.handoff = None
+        self.inherited = inherited
+        # Проброс порта на роутере (NAT-PMP/UPnP) с продлением аренды в фоне;
+        # держит главный процесс, воркерам он не нужен
+        self.port_mapping = port_mapping
+        self.mapping_lifetime = mapping_lifetime
+        self.leases = None
+        # Консоль в главном потоке (ее нужно будить при остановке из другого потока)
+        self.interactive = False
         self.server_socket = None
         self.start_time = None
+        self.engine_name = engine
+        self.engine = None
+        self.accept_thread = None
+        self.queue_limit = queue_limit
+        self.slow_policy = slow_policy
+        # Многопроцессный режим: главный процесс держит pool,
+        # каждый воркер - bus для связи с остальными
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.pool = None
+        self.bus = None
+        # Все события горячего пути идут в фоновый лог
+        self.log_level = log_level
+        self.log_file = log_file
+        self.quiet = quiet
+        self.log = ServerLog(log_level, log_file, quiet)
+        self.metrics = ServerMetrics()
+        self.metrics_port = metrics_port
+        self.metrics_endpoint = None
+        # Heartbeat: PING после простоя, отключение молчащих (0 - выключен)
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.heartbeat = Heartbeat(self, ping_interval, idle_timeout) if idle_timeout > 0 else None
+        # Накопительные ACK для клиентов с batch_ack; TCP_NODELAY - свои
+        # записи сервер склеивает сам, ждать Nagle незачем
+        self.ack_delay = ack_delay
+        self.ack_batch = ack_batch
+        self.acks = AckBatcher(self, ack_delay, ack_batch)
+        self.nodelay = nodelay
+        # Лимиты входящих сообщений (клиент, IP) и новых подключений
+        self.client_rate = client_rate
+        self.ip_rate = ip_rate
+        self.accept_rate = accept_rate
+        self.limits = RateLimiter(self.metrics, client_rate, ip_rate, accept_rate)
+        # Сжатие для клиентов с функцией deflate: сообщения от порога (0 - выключено)
+        self.compress_threshold = compress_threshold
+        # TLS (None - обычный TCP)
+        self.tls_cert = tls_cert
+        self.tls_key = tls_key
+        self.ssl_context = make_server_context(tls_cert, tls_key) if tls_cert else None
+        # Кэш строки HH:MM:SS - strftime не чаще раза в секунду
+        self.clock = (0, '')
+        # Комнаты и пользователи этого процесса
+        self.subscriptions = SubscriptionIndex()
+        # Журнал сообщений: рассылки с seq для догрузки после переподключения.
+        # Журнал рассылок ведет один процесс, воркеры только читают его;
+        # входящие сообщения у каждого процесса в своем журнале.
+        self.store_dir = store_dir
+        self.store_max_segments = store_max_segments
+        self.store = None
+        self.inbox = None
+        if store_dir:
+            self.store = MessageStore(os.path.join(store_dir, 'broadcast'),
+                                      max_segments=store_max_segments,
+                                      readonly=store_readonly, shared=workers > 1)
+            if workers <= 1:
+                self.inbox = MessageStore(os.path.join(store_dir, inbox_name),
+                                          max_segments=store_max_segments)
+        
+    def server_options(self):
+        """Настройки, которые передаются процессам-воркерам"""
+        return {
+            'engine': self.engine_name,
+            'queue_limit': self.queue_limit,
+            'slow_policy': self.slow_policy,
+            'log_level': self.log_level,
+            'log_file': self.log_file,
+            'quiet': self.quiet,
+            'ping_interval': self.ping_interval,
+            'idle_timeout': self.idle_timeout,
+            'store_dir': self.store_dir,
+            'store_max_segments': self.store_max_segments,
+            'ack_delay': self.ack_delay,
+            'ack_batch': self.ack_batch,
+            'nodelay': self.nodelay,
+            'compress_threshold': self.compress_threshold,
+            'tls_cert': self.tls_cert,
+            'tls_key': self.tls_key,
+            'client_rate': self.client_rate,
+            'ip_rate': self.ip_rate,
+            'accept_rate': self.accept_rate,
+            'backlog': self.backlog,
+            'drain_timeout': self.drain_timeout,
+            'reconnect_spread': self.reconnect_spread
+        }
         
     def start(self):
         """Запуск сервера"""
         try:
             self.start_time = datetime.now()
             
-            # Создаем сервер
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.server_socket.bind(('0.0.0.0', self.port))
-            self.server_socket.listen(5)
-            
-            self.server_running = True
+            if self.workers > 1:
+                # Воркеры сами слушают порт через SO_REUSEPORT
+                self.pool = WorkerPool(self.port, self.workers, self.server_options(),
+                                       on_broadcast=self.broadcast_to_all,
+                                       on_publish=self.publish)
+                self.pool.start()
+                self.server_running = True
+            else:
+                self.listen()
+                self.start_engine()
+                if self.handoff_path:
+                    self.handoff = HandoffListener(self, self.handoff_path)
+                    self.handoff.start()
+                
+            if self.port_mapping:
+                self.leases = LeaseManager([self.port], method=self.port_mapping,
+                                           lifetime=self.mapping_lifetime, log=self.log)
+                self.leases.start()
+                
+            if self.metrics_port:
+                self.metrics_endpoint = MetricsEndpoint(self.metrics_snapshot, self.metrics_port)
+                self.metrics_endpoint.start()
             
             # Показываем информацию
             self.clear_screen()
             self.show_header()
             
-            # Запускаем поток для принятия подключений
-            accept_thread = threading.Thread(target=self.accept_connections)
-            accept_thread.daemon = True
-            accept_thread.start()
-            
             # Консоль управления
+            self.interactive = True
             self.start_console()
             
         except Exception as e:
             print(f"[ERROR] Ошибка запуска: {e}")
             print(f"[DEBUG] Детали: {type(e).__name__}: {e}")
             
+    def listen(self):
+        """Создать слушающий сокет"""
+        self.start_time = self.start_time or datetime.now()
+        if self.inherited:
+            # Порт уже слушается - сокет получен от старого процесса
+            self.server_socket = self.inherited.listener
+            self.server_socket.setblocking(True)
+            self.port = self.server_socket.getsockname()[1]
+            self.server_running = True
+            return
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.server_socket.bind(('0.0.0.0', self.port))
+        self.server_socket.listen(self.backlog)
+        
+        self.server_running = True
+        
+    def start_engine(self):
+        """Запустить поток для принятия подключений (или цикл selectors)"""
+        if self.engine_name == 'selectors':
+            self.engine = SelectorEngine(self)
+            target = self.engine.run
+        else:
+            target = self.accept_connections
+            # В движке selectors тики идут прямо в цикле
+            for timer in (self.heartbeat, self.acks):
+                if timer:
+                    timer_thread = threading.Thread(target=timer.run)
+                    timer_thread.daemon = True
+                    timer_thread.start()
+        self.accept_thread = threading.Thread(target=target)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        if self.inherited:
+            self.adopt_clients(self.inherited.clients)
+            self.inherited = None
+        
+    def count_clients(self):
+        """Количество клиентов (во всех воркерах)"""
+        if self.pool:
+            return sum(len(snapshot['clients']) for snapshot in self.pool.collect().values())
+        return len(self.clients)
+        
+    def snapshot(self):
+        """Снимок состояния для главного процесса"""
+        return {
+            'pid': os.getpid(),
+            'clients': [(record.client_id, datetime.fromtimestamp(record.connected),
+                         (record.messages_in, record.messages_out + record.ack_flushed,
+                          record.bytes_in, record.bytes_out))
+                        for record in self.clients.snapshot()],
+            'metrics': self.metrics.snapshot(self.clients)
+        }
+        
+    def metrics_snapshot(self):
+        """Метрики этого процесса или сумма по всем воркерам"""
+        if self.pool:
+            return merge_snapshots(snapshot['metrics'] for snapshot in self.pool.collect().values())
+        return self.metrics.snapshot(self.clients)
+        
     def clear_screen(self):
         """Очистка экрана"""
         os.system('cls' if os.name == 'nt' else 'clear')
@@ -57,7 +313,19 @@ class SimpleTestServer:
         print("=" * 60)
         print(f"[PORT] Сервер на порту: {self.port}")
         print(f"[IP] Локальный IP: {self.get_local_ip()}")
-        print(f"[CLIENTS] Подключений: {len(self.clients)}")
+        print(f"[ENGINE] Движок: {self.engine_name}")
+        if self.ssl_context:
+            print(f"[TLS] Включен, сертификат: {self.tls_cert}")
+        if self.handoff:
+            print(f"[HANDOFF] Горячий перезапуск через {self.handoff_path}")
+        if self.leases:
+            print(f"[PORTMAP] Проброс порта на роутере ({self.port_mapping}), "
+                  f"аренда {self.mapping_lifetime} сек с продлением")
+        if self.pool:
+            print(f"[WORKERS] Процессов: {self.pool.size} (SO_REUSEPORT)")
+        if self.metrics_endpoint:
+            print(f"[METRICS] http://127.0.0.1:{self.metrics_endpoint.port}/metrics")
+        print(f"[CLIENTS] Подключений: {self.count_clients()}")
         print("=" * 60)
         print("[ANDROID] Для подключения Android:")
         print(f"   IP: {self.get_local_ip()}")
@@ -66,12 +334,18 @@ class SimpleTestServer:
         print("[DEBUG] Отладочная информация:")
         print("   - Сервер слушает ВСЕ интерфейсы (0.0.0.0)")
         print("   - Порт переиспользуется (SO_REUSEADDR)")
-        print("   - Таймауты отключены для стабильности")
+        if self.heartbeat:
+            print(f"   - Heartbeat: PING через {self.ping_interval:g} сек простоя, "
+                  f"отключение через {self.heartbeat.idle_timeout:g} сек")
+        else:
+            print("   - Таймауты отключены для стабильности")
+        print(f"   - Лимиты сообщений: {self.limits.describe()}")
         print("   - Логирование всех подключений")
         print("=" * 60)
         print("[COMMANDS] Команды:")
         print("   status  - показать статус")
         print("   clients - список клиентов")
+        print("   metrics - метрики сервера")
         print("   test    - тест подключения")
         print("   clear   - очистить экран")
         print("   stop    - остановить сервер")
@@ -79,120 +353,366 @@ class SimpleTestServer:
         print("=" * 60)
         
     def get_local_ip(self):
-        """Получить локальный IP"""
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
+        """Получить локальный IP (из общего кэша network_info)"""
+        return network_info.get_local_ip()
             
     def accept_connections(self):
         """Принятие подключений"""
-        print(f"[LISTEN] Слушаю порт {self.port} на всех интерфейсах...")
-        while self.server_running:
+        self.log.info('LISTEN', "Слушаю порт %d на всех интерфейсах (очередь %d)...",
+                      self.port, self.backlog)
+        while self.server_running and not self.draining:
             try:
-                # Без таймаута для максимальной совместимости
-                client_socket, client_address = self.server_socket.accept()
-                
-                print(f"\n[CONNECT] === НОВОЕ ПОДКЛЮЧЕНИЕ ===")
-                print(f"[CLIENT] IP: {client_address[0]}")
-                print(f"[PORT] Порт: {client_address[1]}")
-                print(f"[TIME] Время: {datetime.now().strftime('%H:%M:%S')}")
-                print(f"[INFO] Всего клиентов: {len(self.clients) + 1}")
-                print("=" * 40)
-                
-                client_id = f"{client_address[0]}:{client_address[1]}"
-                
-                self.clients[client_id] = {
-                    'socket': client_socket,
-                    'address': client_address,
-                    'connected': datetime.now()
-                }
-                
-                # Отправляем приветствие
+                # Ждем первое подключение, остальные из очереди ядра забираем без ожидания
+                batch = [self.server_socket.accept()]
+                delay = self.limits.accept_delay()
+                self.server_socket.setblocking(False)
                 try:
-                    welcome = f"SERVER_CONNECTED|{datetime.now().strftime('%H:%M:%S')}"
-                    client_socket.send(welcome.encode())
-                    print(f"[SENT] Отправлено приветствие клиенту")
-                except Exception as e:
-                    print(f"[ERROR] Ошибка отправки приветствия: {e}")
+                    while not delay and len(batch) < ACCEPT_BATCH:
+                        batch.append(self.server_socket.accept())
+                        delay = self.limits.accept_delay()
+                except (BlockingIOError, InterruptedError):
+                    pass
+                finally:
+                    self.server_socket.setblocking(True)
+                
+                for client_socket, client_address in batch:
+                    if client_address == self.waker_address:
+                        # Не клиент - только разбудил accept при остановке
+                        client_socket.close()
+                        continue
+                    record = self.register_client(client_socket, client_address)
+                    # Приветствие отправит поток-писатель - accept не ждет сокет клиента
+                    record.queue.push(self.make_welcome().encode(), force=True)
+                    self.start_client_threads(client_socket, client_address, record)
                 
-                # Запускаем обработку клиента
-                client_thread = threading.Thread(
-                    target=self.handle_client,
-                    args=(client_socket, client_address, client_id)
-                )
-                client_thread.daemon = True
-                client_thread.start()
+                # Лимит подключений: остальные подождут в очереди ядра (backlog)
+                if delay:
+                    self.log.debug('LIMIT', "Прием подключений приостановлен на %.3f сек", delay)
+                    time.sleep(delay)
                     
             except Exception as e:
+                if self.draining:
+                    break
                 if self.server_running:
-                    print(f"[ERROR] Ошибка принятия подключения: {e}")
-                    print(f"[DEBUG] {type(e).__name__}: {e}")
+                    self.metrics.error('accept')
+                    self.log.error('ERROR', "Ошибка принятия подключения: %s: %s",
+                                   type(e).__name__, e)
                 time.sleep(0.1)
                     
-    def handle_client(self, client_socket, client_address, client_id):
+    def start_client_threads(self, client_socket, client_address, record):
+        """Потоки читателя и писателя клиента (движок threads)"""
+        # Запускаем обработку клиента
+        client_thread = threading.Thread(
+            target=self.handle_client,
+            args=(client_socket, client_address, record)
+        )
+        client_thread.daemon = True
+        client_thread.start()
+        
+        # Отдельный писатель - медленный клиент не тормозит остальных
+        writer_thread = threading.Thread(
+            target=self.client_writer,
+            args=(client_socket, record)
+        )
+        writer_thread.daemon = True
+        writer_thread.start()
+                    
+    def register_client(self, client_socket, client_address, adopted=False):
+        """Регистрация нового клиента (общая для всех движков).
+        adopted - клиент получен от старого процесса, а не подключился сейчас"""
+        client_id = f"{client_address[0]}:{client_address[1]}"
+        if not adopted:
+            self.log.info('CONNECT', "Новое подключение %s (всего клиентов: %d)",
+                          client_id, len(self.clients) + 1, client=client_id)
+        
+        if self.nodelay:
+            try:
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass
+        record = ClientRecord(client_id, client_socket, client_address, FrameDecoder(compress_threshold=self.compress_threshold),
+                              OutboundQueue(self.queue_limit, self.slow_policy))
+        self.limits.attach(record)
+        self.clients.add(record)
+        if not adopted:
+            self.metrics.connections_accepted += 1
+        if self.heartbeat:
+            self.heartbeat.track(record)
+        return record
+        
+    def clock_text(self, now=None):
+        """Текущее время HH:MM:SS (форматируется раз в секунду)"""
+        second = int(time.time() if now is None else now)
+        if second != self.clock[0]:
+            self.clock = (second, time.strftime('%H:%M:%S', time.localtime(second)))
+        return self.clock[1]
+        
+    def make_welcome(self):
+        """Приветствие для нового клиента"""
+        return f"SERVER_CONNECTED|{self.clock_text()}"
+        
+    def process_data(self, record, data):
+        """Разбор принятых байт на сообщения, возвращает байты ответа"""
+        client_id = record.client_id
+        decoder = record.decoder
+        record.bytes_in += len(data)
+        record.last_activity = time.monotonic()
+        messages = decoder.feed(data)
+        record.messages_in += len(messages)
+        
+        out = []
+        reply = decoder.take_handshake_reply()
+        if reply:
+            self.log.info('PROTO', "Клиент %s перешел в режим: %s", client_id, decoder.mode)
+            out.append(reply)
+            
+        batched = FEATURE_BATCH_ACK in decoder.features
+        binary = decoder.mode == MODE_BINARY
+        acked = 0
+        now = int(time.time())
+        for message in messages:
+            response = self.process_message(client_id, message)
+            if not response:
+                continue
+            if response is True:
+                # Обычное подтверждение: пачкой или RECEIVED| на сообщение
+                if batched:
+                    acked += 1
+                    continue
+                record.messages_out += 1
+                if binary:
+                    # Бинарный клиент: готовый кадр без форматирования строк
+                    out.append(encode_received(len(message), now))
+                    continue
+                response = f"RECEIVED|{self.clock_text(now)}|{len(message)}"
+                out.append(decoder.encode(response))
+                continue
+            # FETCH отвечает сразу несколькими сообщениями
+            for text in (response if isinstance(response, list) else (response,)):
+                out.append(decoder.encode(text))
+                record.messages_out += 1
+        if acked:
+            ack = self.acks.received(record, acked)
+            if ack:
+                out.append(decoder.encode(ack))
+                record.messages_out += 1
+        return b''.join(out)
+        
+    def process_message(self, client_id, message):
+        """Обработка сообщения клиента: ответ, список ответов,
+        True (подтвердить прием) или None"""
+        if not message:
+            return None
+            
+        # Heartbeat не подтверждается и не логируется как сообщение
+        if message == PONG or message.startswith(PONG + '|'):
+            return None
+        if message == PING or message.startswith(PING + '|'):
+            return f"{PONG}|{int(time.time())}"
+        if message.startswith('FETCH|'):
+            return self.fetch_messages(client_id, message)
+        if message.startswith(ROUTING_COMMANDS):
+            return self.process_routing(client_id, message)
+            
+        self.log.info('MESSAGE', "%s: %s", client_id, message, client=client_id)
+        if self.inbox:
+            self.inbox.append(message, client_id, CHANNEL_INBOX)
+        
+        return True
+        
+    def process_routing(self, client_id, message):
+        """LOGIN|имя, JOIN|комната, LEAVE|комната, ROOM|комната|текст, DM|имя|текст"""
+        command, _, rest = message.partition('|')
+        if command == 'LOGIN':
+            if not valid_name(rest):
+                return "ERROR|bad name"
+            self.subscriptions.login(client_id, rest)
+            self.log.info('LOGIN', "Клиент %s вошел как %s", client_id, rest, client=client_id)
+            return f"LOGIN_OK|{rest}"
+        if command == 'JOIN':
+            if not valid_name(rest):
+                return "ERROR|bad room"
+            members = self.subscriptions.join(client_id, rest)
+            return f"JOINED|{rest}|{members}"
+        if command == 'LEAVE':
+            self.subscriptions.leave(client_id, rest)
+            return f"LEFT|{rest}"
+            
+        target, separator, text = rest.partition('|')
+        if not separator or not valid_name(target):
+            return "ERROR|bad target"
+        sender = self.subscriptions.user_of(client_id) or client_id
+        if command == 'ROOM':
+            if target not in self.subscriptions.rooms_of(client_id):
+                return f"ERROR|not in room {target}"
+            self.publish(ROOM_PREFIX + target, sender, text, client_id)
+        else:
+            self.publish(USER_PREFIX + target, sender, text, client_id)
+        self.log.info('ROUTE', "%s -> %s: %s", sender, target, text, client=client_id)
+        return True
+        
+    def publish(self, channel, sender, text, origin=None):
+        """Сообщение в комнату или пользователю: журнал, затем доставка"""
+        if self.bus:
+            # Получатели могут быть в других воркерах - через главный процесс
+            self.bus.publish(channel, sender, text, origin)
+            return
+        seq = self.store.append(text, sender, channel) if self.store else 0
+        if self.pool:
+            self.pool.deliver(channel, seq, sender, text, origin)
+            return
+        self.deliver_local(channel, seq, sender, text, origin)
+        
+    def deliver_local(self, channel, seq, sender, text, origin=None):
+        """Доставка только подписчикам канала в этом процессе"""
+        name = channel[1:]
+        if channel.startswith(ROOM_PREFIX):
+            client_ids = self.subscriptions.room_members(name)
+        else:
+            client_ids = self.subscriptions.user_connections(name)
+        records = [record for record in map(self.clients.get, client_ids)
+                   if record is not None and record.client_id != origin]
+        if records:
+            payload = EncodedCache(format_stored(seq, sender, channel, text))
+            self.send_to_records(payload, records)
+            
+    def fetch_messages(self, client_id, message):
+        """FETCH|<после seq>[|лимит] -> пропущенные сообщения и FETCH_END|<последний seq>"""
+        if not self.store:
+            return "FETCH_END|0"
+        parts = message.split('|')
+        try:
+            after_seq = int(parts[1])
+            limit = int(parts[2]) if len(parts) > 2 else FETCH_LIMIT
+        except ValueError:
+            return "FETCH_ERROR|bad request"
+        limit = max(1, min(limit, MAX_FETCH_LIMIT))
+        if self.store.readonly:
+            self.store.refresh()
+        # Рассылки всем + комнаты клиента + его личные сообщения
+        channels = [CHANNEL_BROADCAST]
+        channels.extend(ROOM_PREFIX + room for room in self.subscriptions.rooms_of(client_id))
+        user = self.subscriptions.user_of(client_id)
+        if user:
+            channels.append(USER_PREFIX + user)
+        found = self.store.read_after(after_seq, limit, channels)
+        response = [format_stored(seq, sender, channel, text)
+                    for seq, _, sender, channel, text in found]
+        last_seq = found[-1][0] if len(found) == limit else self.store.last_seq
+        response.append(f"FETCH_END|{last_seq}")
+        return response
+        
+    def send_control(self, record, text):
+        """Служебное сообщение клиенту (в его режиме, мимо лимита очереди)"""
+        data = record.decoder.encode(text)
+        if self.engine:
+            self.engine.send(record, data)
+        else:
+            record.queue.push(data, force=True)
+            
+    def handle_client(self, client_socket, client_address, record):
         """Обработка клиента"""
-        print(f"[THREAD] Запущен поток для клиента {client_id}")
+        client_id = record.client_id
+        self.log.debug('THREAD', "Запущен поток для клиента %s", client_id)
         
         try:
+            # Простой отслеживает heartbeat, таймаут на recv не нужен
+            client_socket.settimeout(None)
+            
             # Главный цикл приема сообщений
             while self.server_running:
                 try:
-                    # Устанавливаем таймаут
-                    client_socket.settimeout(30.0)
+                    if record.queue.is_full():
+                        # Клиент не успевает читать ответы - не читаем и его
+                        self.metrics.backpressure_pauses += 1
+                        self.log.debug('LIMIT', "Очередь %s заполнена, чтение приостановлено",
+                                       client_id)
+                        while (self.server_running and not record.queue.closed
+                               and not record.queue.is_low()):
+                            record.queue.wait_low(1.0)
                     
-                    data = client_socket.recv(1024)
+                    data = client_socket.recv(RECV_SIZE)
                     if not data:
-                        print(f"[DISCONNECT] Клиент {client_id} отключился (нет данных)")
+                        self.log.info('DISCONNECT', "Клиент %s отключился (нет данных)", client_id)
                         break
                         
-                    message = data.decode('utf-8').strip()
-                    if message:
-                        timestamp = datetime.now().strftime("%H:%M:%S")
-                        print(f"\n[MESSAGE] === ПОЛУЧЕНО СООБЩЕНИЕ ===")
-                        print(f"[FROM] Клиент: {client_id}")
-                        print(f"[TIME] Время: {timestamp}")
-                        print(f"[TEXT] Сообщение: {message}")
-                        print("=" * 40)
-                        
-                        # Отправляем подтверждение
-                        try:
-                            response = f"RECEIVED|{timestamp}|{len(message)}"
-                            client_socket.send(response.encode())
-                            print(f"[SENT] Отправлено подтверждение")
-                        except Exception as e:
-                            print(f"[ERROR] Ошибка отправки подтверждения: {e}")
+                    received = time.perf_counter()
+                    acks = record.messages_out
+                    messages = record.messages_in
+                    response = self.process_data(record, data)
+                    if response:
+                        # Подтверждение уходит через очередь писателя
+                        record.queue.push(response, force=True)
+                        self.metrics.ack_latency.observe(time.perf_counter() - received,
+                                                         record.messages_out - acks)
+                        self.log.debug('SENT', "Подтверждение для %s поставлено в очередь", client_id)
+                    
+                    delay = self.limits.charge(record, record.messages_in - messages)
+                    if delay:
+                        # Превышен лимит - TCP притормозит клиента, пока поток спит
+                        self.log.debug('LIMIT', "Клиент %s превысил лимит, пауза %.3f сек",
+                                       client_id, delay)
+                        time.sleep(delay)
                         
-                except socket.timeout:
-                    print(f"[TIMEOUT] Таймаут клиента {client_id}, продолжаем...")
-                    continue
                 except Exception as e:
-                    print(f"[ERROR] Ошибка приема от {client_id}: {e}")
+                    self.metrics.error('recv')
+                    self.log.error('ERROR', "Ошибка приема от %s: %s", client_id, e)
                     break
                     
         except Exception as e:
-            print(f"[ERROR] Ошибка обработки клиента {client_id}: {e}")
+            self.log.error('ERROR', "Ошибка обработки клиента %s: %s", client_id, e)
         finally:
             self.disconnect_client(client_id)
             
+    def client_writer(self, client_socket, record):
+        """Поток-писатель: отправляет очередь клиента целиком (sendall)"""
+        client_id = record.client_id
+        queue = record.queue
+        try:
+            while self.server_running and not queue.closed:
+                # Все, что накопилось, уходит одним sendall
+                chunk = queue.pop(timeout=1.0, max_chunks=MAX_BATCH_CHUNKS)
+                if chunk is not None:
+                    client_socket.sendall(chunk)
+                    queue.bytes_sent += len(chunk)
+        except Exception as e:
+            if not queue.closed:
+                self.metrics.error('send')
+                self.log.error('ERROR', "Ошибка отправки %s: %s", client_id, e)
+                self.disconnect_client(client_id)
+            
     def disconnect_client(self, client_id):
         """Отключение клиента"""
-        if client_id in self.clients:
-            client_info = self.clients[client_id]
+        if self.engine:
+            # Сокеты принадлежат циклу selectors - закрываем из его потока
+            self.engine.call_soon(self.engine.close_client, client_id)
+            return
+        self.unregister_client(client_id)
+        
+    def unregister_client(self, client_id):
+        """Закрытие сокета и удаление клиента из списка"""
+        # remove атомарен - читатель и писатель могут отключать клиента одновременно
+        record = self.clients.remove(client_id)
+        if record:
+            if self.heartbeat:
+                self.heartbeat.untrack(client_id)
+            self.subscriptions.remove_client(client_id)
+            self.limits.detach(record)
+            record.queue.close()
+            self.metrics.record_closed(record)
             
             try:
-                client_info['socket'].close()
-                print(f"[CLOSE] Сокет клиента {client_id} закрыт")
+                # shutdown будит поток, заблокированный в recv на этом сокете
+                record.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                record.socket.close()
             except Exception as e:
-                print(f"[ERROR] Ошибка закрытия сокета: {e}")
+                self.log.error('ERROR', "Ошибка закрытия сокета %s: %s", client_id, e)
                 
-            del self.clients[client_id]
-            print(f"[DISCONNECTED] Клиент {client_id} отключен")
-            print(f"[REMAINING] Осталось клиентов: {len(self.clients)}")
+            self.log.info('DISCONNECTED', "Клиент %s отключен, осталось клиентов: %d",
+                          client_id, len(self.clients), client=client_id)
             
     def start_console(self):
         """Консоль управления"""
@@ -208,6 +728,8 @@ class SimpleTestServer:
                     self.show_status()
                 elif command.lower() == 'clients':
                     self.show_clients()
+                elif command.lower() == 'metrics':
+                    self.show_metrics()
                 elif command.lower() == 'test':
                     self.test_connection()
                 elif command.lower() == 'clear':
@@ -222,23 +744,56 @@ class SimpleTestServer:
                     self.broadcast_to_all(f"SERVER: {command}")
                     
             except KeyboardInterrupt:
-                print("\n[STOP] Остановка сервера...")
-                self.stop()
+                if self.server_running:
+                    print("\n[STOP] Остановка сервера...")
+                    self.stop()
                 break
             except EOFError:
                 break
                 
     def broadcast_to_all(self, message):
         """Рассылка сообщения всем клиентам"""
-        print(f"[BROADCAST] Отправка сообщения: {message}")
+        if self.bus:
+            # Воркер: рассылка идет через главный процесс на весь парк
+            self.bus.publish_broadcast(message)
+            return
+        # Сначала в журнал - телефоны не в сети догрузят по seq
+        seq = self.store.append(message, 'SERVER', CHANNEL_BROADCAST) if self.store else None
+        if self.pool:
+            print(f"[BROADCAST] Отправка сообщения всем воркерам: {message}")
+            self.pool.broadcast(message, seq)
+            return
+        self.broadcast_local(message, seq)
+        
+    def broadcast_local(self, message, seq=None):
+        """Рассылка клиентам этого процесса"""
+        self.log.info('BROADCAST', "Отправка сообщения: %s", message)
+        
+        # Старые raw клиенты получают текст как раньше, framed/binary - с номером
+        if seq is not None:
+            numbered = f"MSG|{seq}|{message}"
+            texts = {MODE_FRAMED: numbered, MODE_BINARY: numbered}
+        else:
+            texts = None
+        self.send_to_records(EncodedCache(message, texts))
+        
+    def send_to_records(self, payload, records=None):
+        """Поставить сообщение в очереди клиентов (None - всем)"""
+        if self.engine:
+            self.engine.call_soon(self.engine.broadcast, payload, records)
+            return
         
         disconnected = []
-        for client_id, client_info in self.clients.items():
+        for record in (self.clients.snapshot() if records is None else records):
+            client_id = record.client_id
             try:
-                client_info['socket'].send(message.encode())
-                print(f"[SENT] Отправлено клиенту {client_id}")
-            except Exception as e:
-                print(f"[ERROR] Ошибка отправки {client_id}: {e}")
+                if record.queue.push(payload.get(record.decoder.mode, record.decoder.compress)):
+                    self.log.debug('SENT', "Поставлено в очередь клиенту %s", client_id)
+                else:
+                    self.log.warning('DROP', "Очередь %s заполнена, сообщение пропущено", client_id)
+            except QueueOverflow as e:
+                self.metrics.error('slow_consumer')
+                self.log.warning('SLOW', "Медленный клиент %s: %s", client_id, e)
                 disconnected.append(client_id)
                 
         for client_id in disconnected:
@@ -284,30 +839,98 @@ class SimpleTestServer:
         print("-" * 50)
         print(f"[PORT] Порт: {self.port}")
         print(f"[IP] Локальный IP: {self.get_local_ip()}")
-        print(f"[CLIENTS] Подключено: {len(self.clients)}")
+        if self.pool:
+            snapshots = self.pool.collect()
+            total = sum(len(snapshot['clients']) for snapshot in snapshots.values())
+            print(f"[CLIENTS] Подключено: {total}")
+            print(f"[WORKERS] Процессов: {self.pool.alive_count()}/{self.pool.size}")
+            for worker_id in sorted(snapshots):
+                snapshot = snapshots[worker_id]
+                print(f"   #{worker_id} pid {snapshot['pid']}: {len(snapshot['clients'])} клиентов")
+        else:
+            print(f"[CLIENTS] Подключено: {len(self.clients)}")
+        rooms, users = self.subscriptions.counts()
+        if not self.pool:
+            print(f"[ROOMS] Комнат: {rooms}, пользователей в сети: {users}")
+        if self.store:
+            print(f"[STORE] Журнал: {self.store.directory}, последний seq: {self.store.last_seq}")
+        counters = self.metrics_snapshot()['counters']
+        print(f"[LIMITS] Пауз по лимиту клиента: {counters['rate_limited']}, "
+              f"по лимиту IP: {counters['ip_rate_limited']}, "
+              f"отложенных подключений: {counters['accepts_delayed']}, "
+              f"по заполненной очереди: {counters['backpressure_pauses']}")
+        if self.leases:
+            print(f"[PORTMAP] Проброс: {self.leases.describe()}")
         print(f"[UPTIME] Время работы: {self.get_uptime()}")
         print(f"[STATE] Статус: {'Активен' if self.server_running else 'Остановлен'}")
         print("-" * 50)
         
     def show_clients(self):
         """Показать клиентов"""
-        print(f"\n[CLIENTS] ПОДКЛЮЧЕННЫЕ КЛИЕНТЫ ({len(self.clients)})")
+        if self.pool:
+            clients = [(f"{client_id} (#{worker_id})", connected, stats)
+                       for worker_id, snapshot in sorted(self.pool.collect().items())
+                       for client_id, connected, stats in snapshot['clients']]
+        else:
+            clients = self.snapshot()['clients']
+            
+        print(f"\n[CLIENTS] ПОДКЛЮЧЕННЫЕ КЛИЕНТЫ ({len(clients)})")
         print("-" * 60)
         
-        if not self.clients:
+        if not clients:
             print("[EMPTY] Нет подключенных клиентов")
         else:
-            for i, (client_id, client_info) in enumerate(self.clients.items(), 1):
-                connected_time = datetime.now() - client_info['connected']
+            for i, (client_id, connected, stats) in enumerate(clients, 1):
+                connected_time = datetime.now() - connected
                 minutes = int(connected_time.total_seconds() / 60)
                 seconds = int(connected_time.total_seconds() % 60)
                 
                 print(f"{i:2d}. [CLIENT] {client_id}")
                 print(f"     [TIME] Подключен: {minutes:02d}:{seconds:02d} назад")
+                print(f"     [STATS] Сообщений: {stats[0]} / {stats[1]}, "
+                      f"байт: {stats[2]} / {stats[3]} (принято / отправлено)")
                 print()
                 
         print("-" * 60)
         
+    def show_metrics(self):
+        """Показать метрики"""
+        snapshot = self.metrics_snapshot()
+        counters = snapshot['counters']
+        gauges = snapshot['gauges']
+        latency = snapshot['ack_latency']
+        accept_rate, message_rate, byte_rate = self.metrics.rates(snapshot)
+        
+        print(f"\n[METRICS] МЕТРИКИ СЕРВЕРА")
+        print("-" * 60)
+        print(f"[CONN] Принято: {counters['connections_accepted']}, "
+              f"закрыто: {counters['connections_closed']}, сейчас: {gauges['clients']}")
+        print(f"[RATE] {accept_rate:.1f} подключений/сек, {message_rate:.1f} сообщений/сек, "
+              f"{byte_rate / 1024:.1f} КБ/сек (с прошлого вызова)")
+        print(f"[IN] Сообщений: {counters['messages_in']}, байт: {counters['bytes_in']}")
+        print(f"[OUT] Сообщений: {counters['messages_out']}, байт: {counters['bytes_out']}, "
+              f"пропущено: {counters['messages_dropped']}, "
+              f"записей в сокет: {counters['socket_writes']}")
+        print(f"[QUEUE] В очередях: {gauges['queue_bytes']} байт, "
+              f"максимум у клиента: {gauges['queue_max_bytes']} байт")
+        if latency['count']:
+            print(f"[LATENCY] Подтверждения: {latency['count']}, "
+                  f"среднее {latency['sum'] / latency['count'] * 1000:.3f} мс, "
+                  f"p50 <= {latency_percentile(latency, 0.5) * 1000:g} мс, "
+                  f"p99 <= {latency_percentile(latency, 0.99) * 1000:g} мс")
+        if self.ssl_context:
+            print(f"[TLS] Рукопожатий: {counters['tls_handshakes']}, "
+                  f"возобновлено сессий: {counters['tls_resumed']}")
+        errors = ', '.join(f"{kind}: {value}" for kind, value in sorted(snapshot['errors'].items()))
+        print(f"[ERRORS] {errors or 'нет'}")
+        
+        top = sorted(snapshot['clients'], key=lambda client: client[1] + client[2], reverse=True)[:5]
+        if top:
+            print("[TOP] Самые активные клиенты (байт принято / отправлено, очередь):")
+            for client_id, bytes_in, bytes_out, _, _, depth in top:
+                print(f"   {client_id}: {bytes_in} / {bytes_out}, очередь {depth}")
+        print("-" * 60)
+        
     def show_help(self):
         """Показать справку"""
         print(f"\n[HELP] СПРАВКА ТЕСТОВОГО СЕРВЕРА")
@@ -320,11 +943,23 @@ class SimpleTestServer:
         print("[COMMANDS] Команды:")
         print("   status  - показать статус сервера")
         print("   clients - список подключенных клиентов")
+        print("   metrics - метрики (трафик, задержки, очереди, ошибки)")
         print("   test    - тест подключения")
         print("   clear   - очистить экран")
         print("   stop    - остановить сервер")
         print("   help    - показать эту справку")
         print()
+        print("[ROOMS] Комнаты и личные сообщения (от клиента):")
+        print("   LOGIN|имя, JOIN|комната, LEAVE|комната")
+        print("   ROOM|комната|текст, DM|имя|текст")
+        print()
+        print("[STORE] Пропущенные рассылки:")
+        print("   клиент шлет FETCH|<последний seq>[|лимит],")
+        print("   сервер отвечает MSG|seq|текст ... и FETCH_END|<seq>")
+        print()
+        print("[STOP] При остановке клиент получает RECONNECT|<мс>:")
+        print("   переподключиться через указанную задержку")
+        print()
         print("[DEBUG] Если не подключается:")
         print("   1. Проверьте IP адрес в приложении")
         print("   2. Проверьте порт в приложении")
@@ -341,12 +976,226 @@ class SimpleTestServer:
             return f"{hours:02d}:{minutes:02d}"
         return "00:00"
         
+    def stop_accepting(self, close=True):
+        """Перестать принимать подключения. close=False - слушающий сокет
+        остается открытым для передачи новому процессу"""
+        self.draining = True
+        if self.engine:
+            # Сокет зарегистрирован в цикле selectors - снимаем его там же
+            self.engine.call_soon(self.engine.stop_accepting, close)
+            return
+        if not close:
+            # shutdown закрыл бы порт и для нового процесса -
+            # поток в accept будим подключением к самому себе. Адрес
+            # известен до connect: цикл приема узнает и закроет его.
+            waker = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                waker.settimeout(1.0)
+                waker.bind(('127.0.0.1', 0))
+                self.waker_address = waker.getsockname()
+                waker.connect(('127.0.0.1', self.port))
+            except OSError:
+                waker.close()
+                waker = None
+            if self.accept_thread:
+                self.accept_thread.join(1.0)
+            if waker:
+                waker.close()
+            if not (self.accept_thread and self.accept_thread.is_alive()):
+                self.waker_address = None
+            return
+        if self.server_socket:
+            try:
+                # shutdown будит поток, заблокированный в accept
+                self.server_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                self.server_socket.close()
+            except OSError:
+                pass
+                
+    def resume_accepting(self):
+        """Снова принимать подключения (передача новому процессу не удалась)"""
+        self.draining = False
+        if self.engine:
+            self.engine.call_soon(self.engine.resume_accepting)
+            return
+        self.accept_thread = threading.Thread(target=self.accept_connections)
+        self.accept_thread.daemon = True
+        self.accept_thread.start()
+        
+    def detach_clients(self, timeout=5.0):
+        """Снять с цикла клиентов для передачи новому процессу.
+        Передаются только клиенты selectors без TLS: потоки движка threads
+        заблокированы в recv, а состояние TLS соединения не переносится."""
+        if not self.engine or self.ssl_context:
+            return []
+        detached = []
+        done = threading.Event()
+        
+        def detach():
+            try:
+                # Накопленные ACK попадут в очередь и уйдут уже из нового процесса
+                self.acks.flush()
+                detached.extend(self.engine.detach(record) for record in self.clients.snapshot())
+            finally:
+                done.set()
+                
+        self.engine.call_soon(detach)
+        done.wait(timeout)
+        return detached
+        
+    def export_client(self, record):
+        """Состояние клиента для нового процесса"""
+        client_id = record.client_id
+        state = {
+            'address': list(record.address),
+            'connected': record.connected,
+            'decoder': record.decoder.export_state(),
+            'output': record.queue.take_pending(),
+            'bytes_in': record.bytes_in,
+            'bytes_out': record.bytes_out,
+            'messages_in': record.messages_in,
+            'messages_out': record.messages_out + record.ack_flushed,
+            'ack_seq': record.ack_seq,
+            'user': self.subscriptions.user_of(client_id),
+            'rooms': list(self.subscriptions.rooms_of(client_id))
+        }
+        self.subscriptions.remove_client(client_id)
+        self.limits.detach(record)
+        record.queue.close()
+        return state
+        
+    def adopt_clients(self, clients):
+        """Продолжить обслуживание клиентов, полученных от старого процесса"""
+        for sock, state in clients:
+            record = self.register_client(sock, tuple(state['address']), adopted=True)
+            client_id = record.client_id
+            record.connected = state['connected']
+            record.decoder.restore_state(state['decoder'])
+            record.bytes_in = state['bytes_in']
+            record.queue.bytes_sent = state['bytes_out']
+            record.messages_in = state['messages_in']
+            record.messages_out = state['messages_out']
+            record.ack_seq = state['ack_seq']
+            if state['user']:
+                self.subscriptions.login(client_id, state['user'])
+            for room in state['rooms']:
+                self.subscriptions.join(client_id, room)
+            if state['output']:
+                record.queue.push(state['output'], force=True)
+            if self.engine:
+                self.engine.call_soon(self.engine.adopt, record)
+            else:
+                self.start_client_threads(sock, record.address, record)
+        if clients:
+            print(f"[HANDOFF] Принято клиентов от старого процесса: {len(clients)}")
+            
+    def hand_off(self, channel):
+        """Горячий перезапуск: отдать порт и клиентов новому процессу и остановиться.
+        False - передача не удалась, сервер работает дальше."""
+        print("\n[HANDOFF] Новый процесс забирает порт и подключения...")
+        self.stop_accepting(close=False)
+        records = self.detach_clients()
+        clients = [(record.socket, self.export_client(record)) for record in records]
+        try:
+            send_handoff(channel, self.server_socket, clients)
+        except OSError as e:
+            print(f"[HANDOFF] Передача не удалась: {e} - продолжаю работу")
+            channel.close()
+            # Новый процесс мог успеть получить часть сокетов - надежнее
+            # отключить этих клиентов, они переподключатся
+            for record in records:
+                self.metrics.record_closed(record)
+                try:
+                    record.socket.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                record.socket.close()
+            self.resume_accepting()
+            return False
+            
+        # Сокеты живут в новом процессе - здесь закрываем только дескрипторы
+        for record in records:
+            record.socket.close()
+        print(f"[HANDOFF] Передано клиентов: {len(records)}")
+        if self.leases:
+            # Проброс остается на роутере - его продлевает новый процесс
+            self.leases.stop(remove=False)
+        # Остальные (TLS, движок threads) получают RECONNECT, журналы закрываются
+        self.stop()
+        finish_handoff(channel)
+        if self.interactive:
+            # Консоль ждет ввода в главном потоке - будим ее
+            signal.pthread_kill(threading.main_thread().ident, signal.SIGINT)
+        return True
+        
+    def begin_drain(self):
+        """Отправить накопленные ACK и подсказку переподключения клиентам.
+        Задержка у каждого своя - телефоны не вернутся все в одну секунду.
+        Старые raw клиенты показали бы RECONNECT как сообщение в чате - им
+        ничего не шлется, их сокеты закрываются после дописывания очередей."""
+        try:
+            self.acks.flush()
+            for record in self.clients.snapshot():
+                if record.decoder.mode in (None, MODE_RAW):
+                    continue
+                delay = int(random.uniform(0, self.reconnect_spread) * 1000)
+                self.send_control(record, f"{RECONNECT}|{delay}")
+                record.messages_out += 1
+        finally:
+            self.drain_started.set()
+            
+    def drain(self, timeout):
+        """Дождаться отправки очередей всех клиентов, вернуть число не успевших"""
+        deadline = time.monotonic() + timeout
+        if self.engine:
+            self.engine.call_soon(self.begin_drain)
+        else:
+            self.begin_drain()
+        self.drain_started.wait(timeout)
+        while True:
+            pending = sum(1 for record in self.clients.snapshot() if len(record.queue))
+            if not pending or time.monotonic() >= deadline:
+                return pending
+            time.sleep(0.02)
+            
     def stop(self):
-        """Остановка сервера"""
+        """Остановка сервера: прием закрывается, очереди дописываются, затем все закрывается"""
         print("\n[STOP] Остановка тестового сервера...")
+        
+        if self.handoff:
+            self.handoff.close()
+            
+        if self.server_running and not self.pool and self.drain_timeout > 0:
+            if not self.draining:
+                self.stop_accepting()
+            clients = len(self.clients)
+            if clients:
+                started = time.monotonic()
+                pending = self.drain(self.drain_timeout)
+                print(f"[DRAIN] Клиентов: {clients}, дописывание очередей: "
+                      f"{time.monotonic() - started:.2f} сек"
+                      + (f", не успели: {pending}" if pending else ""))
         self.server_running = False
         
-        for client_id in list(self.clients.keys()):
+        if self.leases:
+            self.leases.stop()
+        
+        if self.metrics_endpoint:
+            self.metrics_endpoint.stop()
+        
+        if self.pool:
+            # Воркеры дописывают очереди параллельно, каждый в пределах drain_timeout
+            self.pool.stop(timeout=self.drain_timeout + 5.0)
+            print("[WORKERS] Воркеры остановлены")
+        
+        if self.engine:
+            # Цикл сам закроет всех клиентов
+            self.engine.stop()
+        
+        for client_id in self.clients.ids():
             self.disconnect_client(client_id)
             
         if self.server_socket:
@@ -356,13 +1205,132 @@ class SimpleTestServer:
             except:
                 pass
                 
+        for store in (self.store, self.inbox):
+            if store:
+                store.close()
+                
         print("[STOPPED] Тестовый сервер остановлен")
+        self.log.close()
 
 def main():
+    parser = argparse.ArgumentParser(description="Simple Test Server")
+    parser.add_argument('--port', type=int, default=8888, help="порт сервера")
+    parser.add_argument('--engine', choices=ENGINES, default='threads',
+                        help="threads - поток на клиента, selectors - один цикл на всех")
+    parser.add_argument('--queue-limit', type=int, default=DEFAULT_MAX_BYTES,
+                        help="лимит исходящей очереди клиента в байтах")
+    parser.add_argument('--slow-policy', choices=POLICIES, default=POLICY_DROP,
+                        help="что делать с медленным клиентом: drop, disconnect, coalesce")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="число процессов на одном порту (SO_REUSEPORT)")
+    parser.add_argument('--log-level', choices=list(LEVELS), default='info',
+                        help="уровень логирования")
+    parser.add_argument('--log-file', default=None,
+                        help="файл лога (JSON строки, ротация по 5 МБ)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="тихий режим: в консоль только предупреждения и ошибки")
+    parser.add_argument('--metrics-port', type=int, default=0,
+                        help="порт HTTP endpoint /metrics на 127.0.0.1 (0 - выключен)")
+    parser.add_argument('--ping-interval', type=float, default=DEFAULT_PING_INTERVAL,
+                        help="через сколько секунд простоя слать клиенту PING")
+    parser.add_argument('--idle-timeout', type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help="через сколько секунд тишины отключать клиента (0 - никогда)")
+    parser.add_argument('--store-dir', default=DEFAULT_STORE_DIR,
+                        help="каталог журнала сообщений ('' - не сохранять)")
+    parser.add_argument('--store-max-segments', type=int, default=DEFAULT_MAX_SEGMENTS,
+                        help="сколько сегментов журнала по 16 МБ хранить (0 - без ограничения)")
+    parser.add_argument('--ack-delay', type=float, default=DEFAULT_ACK_DELAY,
+                        help="задержка накопительного ACK для клиентов с batch_ack (сек)")
+    parser.add_argument('--ack-batch', type=int, default=DEFAULT_ACK_BATCH,
+                        help="слать ACK сразу после стольких сообщений")
+    parser.add_argument('--no-nodelay', action='store_true',
+                        help="не выставлять TCP_NODELAY (оставить алгоритм Nagle)")
+    parser.add_argument('--compress-threshold', type=int, default=DEFAULT_THRESHOLD,
+                        help="сжимать сообщения от стольких байт для клиентов с deflate (0 - нет)")
+    parser.add_argument('--tls', action='store_true',
+                        help="TLS на порту сервера (самоподписанный сертификат создается сам)")
+    parser.add_argument('--tls-cert', default=DEFAULT_CERT, help="файл сертификата")
+    parser.add_argument('--tls-key', default=DEFAULT_KEY, help="файл ключа")
+    parser.add_argument('--client-rate', type=float, default=DEFAULT_CLIENT_RATE,
+                        help="сообщений в секунду от одного клиента (0 - без лимита)")
+    parser.add_argument('--ip-rate', type=float, default=DEFAULT_IP_RATE,
+                        help="сообщений в секунду со всех подключений одного IP (0 - без лимита)")
+    parser.add_argument('--accept-rate', type=float, default=DEFAULT_ACCEPT_RATE,
+                        help="новых подключений в секунду (0 - без лимита)")
+    parser.add_argument('--backlog', type=int, default=DEFAULT_BACKLOG,
+                        help="очередь ядра для еще не принятых подключений")
+    parser.add_argument('--drain-timeout', type=float, default=DEFAULT_DRAIN_TIMEOUT,
+                        help="сколько секунд при остановке дописывать очереди клиентов (0 - сразу)")
+    parser.add_argument('--handoff', default=None, metavar='PATH',
+                        help="Unix сокет горячего перезапуска: новый процесс с тем же "
+                             "путем забирает порт и клиентов у старого")
+    parser.add_argument('--reconnect-spread', type=float, default=DEFAULT_RECONNECT_SPREAD,
+                        help="окно случайной задержки переподключения клиентов (сек)")
+    parser.add_argument('--port-mapping', choices=MAPPING_METHODS, default=None,
+                        help="открыть порт на роутере (NAT-PMP/UPnP) и продлевать аренду")
+    parser.add_argument('--mapping-lifetime', type=int, default=DEFAULT_LIFETIME,
+                        help="срок аренды проброса в секундах (продление на половине)")
+    args = parser.parse_args()
+    
+    if args.workers > 1 and not reuse_port_supported():
+        print("[WORKERS] SO_REUSEPORT недоступен на этой ОС - запускаю один процесс")
+        args.workers = 1
+    
+    if args.tls:
+        if args.engine != 'selectors':
+            print("[TLS] TLS работает только с движком selectors - переключаюсь на него")
+            args.engine = 'selectors'
+        if ensure_certificate(args.tls_cert, args.tls_key):
+            print(f"[TLS] Создан самоподписанный сертификат: {args.tls_cert}")
+    
+    inherited = None
+    if args.handoff:
+        if not HANDOFF_SUPPORTED:
+            print("[HANDOFF] Передача сокетов недоступна на этой ОС - обычный запуск")
+            args.handoff = None
+        elif args.workers > 1:
+            print("[HANDOFF] Горячий перезапуск работает с одним процессом - обычный запуск")
+            args.handoff = None
+        else:
+            try:
+                inherited = take_over(args.handoff)
+            except (OSError, HandoffError) as e:
+                print(f"[HANDOFF] Не удалось забрать сокеты у старого процесса: {e}")
+            if inherited:
+                print(f"[HANDOFF] Порт {inherited.listener.getsockname()[1]} получен "
+                      f"от старого процесса, клиентов: {len(inherited.clients)}")
+    
     print("[TEST] Simple Test Server - Максимально простой")
     print("=" * 60)
     
-    server = SimpleTestServer(port=8888)
+    server = SimpleTestServer(port=args.port, engine=args.engine,
+                              queue_limit=args.queue_limit,
+                              slow_policy=args.slow_policy,
+                              workers=args.workers,
+                              log_level=args.log_level,
+                              log_file=args.log_file,
+                              quiet=args.quiet,
+                              metrics_port=args.metrics_port,
+                              ping_interval=args.ping_interval,
+                              idle_timeout=args.idle_timeout,
+                              store_dir=args.store_dir or None,
+                              store_max_segments=args.store_max_segments,
+                              ack_delay=args.ack_delay,
+                              ack_batch=args.ack_batch,
+                              nodelay=not args.no_nodelay,
+                              compress_threshold=args.compress_threshold,
+                              tls_cert=args.tls_cert if args.tls else None,
+                              tls_key=args.tls_key if args.tls else None,
+                              client_rate=args.client_rate,
+                              ip_rate=args.ip_rate,
+                              accept_rate=args.accept_rate,
+                              backlog=args.backlog,
+                              drain_timeout=args.drain_timeout,
+                              reconnect_spread=args.reconnect_spread,
+                              handoff_path=args.handoff,
+                              inherited=inherited,
+                              port_mapping=args.port_mapping,
+                              mapping_lifetime=args.mapping_lifetime)
     
     try:
         server.start()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Кэш сетевой информации
+Локальный IP и список интерфейсов без обращения к 8.8.8.8 (работает офлайн)
+"""
+
+import ipaddress
+import socket
+import struct
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+DEFAULT_TTL = 60.0
+# Как часто сверять список интерфейсов (сброс кэша при смене сети)
+CHECK_INTERVAL = 2.0
+SIOCGIFADDR = 0x8915
+FALLBACK_IP = "127.0.0.1"
+# Адрес за маршрутом по умолчанию (TEST-NET-2). UDP connect только выбирает
+# маршрут в ядре и ничего не отправляет - работает без интернета, если
+# маршрут по умолчанию есть, и на любой ОС
+ROUTE_PROBE_ADDRESS = ("198.51.100.1", 9)
+
+
+def read_default_routes(path='/proc/net/route'):
+    """Маршруты по умолчанию из таблицы ядра Linux: список (интерфейс, шлюз)"""
+    routes = []
+    try:
+        with open(path, encoding='ascii') as f:
+            next(f, None)
+            for line in f:
+                fields = line.split()
+                if len(fields) < 8 or fields[1] != '00000000':
+                    continue
+                flags = int(fields[3], 16)
+                if not flags & 0x2:  # RTF_GATEWAY
+                    continue
+                gateway = socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+                routes.append((fields[0], gateway))
+    except (OSError, ValueError):
+        pass
+    return routes
+
+
+def default_route_ip():
+    """Локальный адрес, с которого ядро отправило бы пакет по маршруту по умолчанию"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(ROUTE_PROBE_ADDRESS)
+        ip = sock.getsockname()[0]
+    except OSError:
+        return None
+    finally:
+        sock.close()
+    return None if ip == '0.0.0.0' else ip
+
+
+def _interface_names():
+    """Имена интерфейсов (дешево - используется для проверки изменений)"""
+    try:
+        return tuple(name for _, name in socket.if_nameindex())
+    except (AttributeError, OSError):
+        return ()
+
+
+def _ioctl_address(name):
+    """IPv4 адрес интерфейса через ioctl (Linux)"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packed = fcntl.ioctl(sock.fileno(), SIOCGIFADDR,
+                             struct.pack('256s', name.encode('utf-8')[:15]))
+        return socket.inet_ntoa(packed[20:24])
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
+
+def enumerate_interfaces():
+    """Все IPv4 адреса машины: список (интерфейс, ip)"""
+    try:
+        import psutil
+        return [(name, address.address)
+                for name, addresses in psutil.net_if_addrs().items()
+                for address in addresses if address.family == socket.AF_INET]
+    except ImportError:
+        pass
+
+    if fcntl is not None:
+        found = []
+        for name in _interface_names():
+            ip = _ioctl_address(name)
+            if ip:
+                found.append((name, ip))
+        if found:
+            return found
+
+    # Windows без psutil: адреса, привязанные к имени хоста
+    try:
+        infos = socket.getaddrinfo(socket.gethostname(), None, socket.AF_INET)
+        return [('', info[4][0]) for info in infos]
+    except OSError:
+        return []
+
+
+def _rank(interface, default_ifaces, route_ip=None):
+    """Чем меньше, тем лучше подходит для показа Android клиенту.
+    Главный признак - адрес маршрута по умолчанию (есть на любой ОС),
+    без него - интерфейс из /proc/net/route, затем частные адреса."""
+    name, ip = interface
+    address = ipaddress.ip_address(ip)
+    if address.is_loopback:
+        return 5
+    if address.is_link_local:
+        return 4
+    if ip == route_ip:
+        return 0
+    if name in default_ifaces:
+        return 1
+    if address.is_private:
+        return 2
+    return 3
+
+
+class NetworkInfo:
+    """Кэш сетевых данных с TTL и сбросом при смене интерфейсов"""
+
+    def __init__(self, ttl=DEFAULT_TTL, check_interval=CHECK_INTERVAL):
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.next_check = 0.0
+        self.lock = threading.Lock()
+        self.interfaces = []
+        self.local_ip = FALLBACK_IP
+        self.signature = None
+        self.expires = 0.0
+
+    def invalidate(self):
+        """Сбросить кэш (например, после переподключения Wi-Fi)"""
+        with self.lock:
+            self.expires = 0.0
+
+    def _refresh_if_needed(self):
+        with self.lock:
+            now = time.monotonic()
+            if now < self.expires:
+                if now < self.next_check:
+                    return
+                # Между истечениями TTL сверяем только имена интерфейсов:
+                # перебор адресов и проба маршрута - только при их смене
+                self.next_check = now + self.check_interval
+                if _interface_names() == self.signature:
+                    return
+            self.signature = _interface_names()
+            interfaces = enumerate_interfaces()
+            route_ip = default_route_ip()
+            default_ifaces = {name for name, _ in read_default_routes()}
+            candidates = sorted(interfaces,
+                                key=lambda item: _rank(item, default_ifaces, route_ip))
+            self.interfaces = interfaces
+            if candidates and _rank(candidates[0], default_ifaces, route_ip) == 0:
+                self.local_ip = candidates[0][1]
+            elif route_ip and not ipaddress.ip_address(route_ip).is_loopback:
+                # Адреса маршрута нет в списке (Windows без psutil) - он все равно вернее
+                self.local_ip = route_ip
+            else:
+                self.local_ip = candidates[0][1] if candidates else FALLBACK_IP
+            self.next_check = now + self.check_interval
+            self.expires = now + self.ttl
+
+    def get_local_ip(self):
+        """Основной локальный IP"""
+        self._refresh_if_needed()
+        return self.local_ip
+
+    def get_interfaces(self):
+        """Список (интерфейс, ip)"""
+        self._refresh_if_needed()
+        return list(self.interfaces)
+
+
+# Общий кэш для сервера и настройки port forwarding
+_shared = NetworkInfo()
+
+
+def get_local_ip():
+    """Локальный IP из общего кэша"""
+    return _shared.get_local_ip()
+
+
+def get_interfaces():
+    """Интерфейсы из общего кэша"""
+    return _shared.get_interfaces()
+
+
+def invalidate():
+    """Сбросить общий кэш"""
+    _shared.invalidate()
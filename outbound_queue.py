@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Очередь исходящих сообщений клиента
+Ограниченный размер и политика для медленных клиентов
+"""
+
+import ssl
+import threading
+from collections import deque
+from itertools import islice
+
+# Политики для медленного клиента, когда очередь заполнена
+POLICY_DROP = 'drop'              # новое сообщение выбрасывается
+POLICY_DISCONNECT = 'disconnect'  # клиент отключается
+POLICY_COALESCE = 'coalesce'      # старые неотправленные сообщения заменяются новыми
+POLICIES = (POLICY_DROP, POLICY_DISCONNECT, POLICY_COALESCE)
+
+DEFAULT_MAX_BYTES = 256 * 1024
+
+# Сколько кусков очереди отправлять одним системным вызовом
+MAX_BATCH_CHUNKS = 64
+
+
+class QueueOverflow(Exception):
+    """Очередь переполнена при политике disconnect"""
+
+
+class OutboundQueue:
+    """Очередь байт для отправки с семантикой sendall"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES, policy=POLICY_DROP):
+        if policy not in POLICIES:
+            raise ValueError(f"Неизвестная политика: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.chunks = deque()
+        self.size = 0
+        # Сколько байт первого куска уже ушло в сокет
+        self.offset = 0
+        self.dropped = 0
+        self.bytes_sent = 0
+        # Число системных вызовов записи (пакетов на сообщение)
+        self.writes = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        # Читатель ждет здесь, пока заполненная очередь не опустеет наполовину
+        self.writable = threading.Condition(self.lock)
+
+    def __len__(self):
+        return self.size - self.offset
+
+    def is_full(self):
+        """Очередь заполнена"""
+        return self.size - self.offset >= self.max_bytes
+
+    def is_low(self):
+        """Очередь опустела до половины - можно снова читать клиента"""
+        return self.size - self.offset <= self.max_bytes // 2
+
+    def wait_low(self, timeout=None):
+        """Подождать, пока очередь не опустеет до половины (движок threads)"""
+        with self.writable:
+            if not self.closed and not self.is_low():
+                self.writable.wait(timeout)
+
+    def push(self, data, force=False):
+        """Добавить данные. force - служебные ответы, лимит не применяется.
+        Возвращает False если сообщение выброшено."""
+        with self.lock:
+            if self.closed:
+                return False
+            if not force and self.size - self.offset + len(data) > self.max_bytes:
+                if self.policy == POLICY_DISCONNECT:
+                    raise QueueOverflow(f"Очередь переполнена ({self.size} байт)")
+                if self.policy == POLICY_COALESCE:
+                    self._drop_oldest(len(data))
+                if self.size - self.offset + len(data) > self.max_bytes:
+                    self.dropped += 1
+                    return False
+            self.chunks.append(data)
+            self.size += len(data)
+            self.ready.notify()
+            return True
+
+    def _drop_oldest(self, needed):
+        """Выбросить самые старые сообщения, которые еще не начали отправляться"""
+        keep = 1 if self.offset else 0
+        while len(self.chunks) > keep and self.size - self.offset + needed > self.max_bytes:
+            chunk = self.chunks[keep]
+            del self.chunks[keep]
+            self.size -= len(chunk)
+            self.dropped += 1
+
+    def pop(self, timeout=None, max_chunks=1):
+        """Забрать до max_chunks кусков одним блоком (для потока-писателя).
+        None - нет данных"""
+        with self.ready:
+            if not self.chunks and not self.closed:
+                self.ready.wait(timeout)
+            if not self.chunks:
+                return None
+            if max_chunks == 1 or len(self.chunks) == 1:
+                chunk = self.chunks.popleft()
+            else:
+                chunk = b''.join(self.chunks.popleft()
+                                 for _ in range(min(max_chunks, len(self.chunks))))
+            self.size -= len(chunk)
+            self.writes += 1
+            if self.is_low():
+                self.writable.notify_all()
+            return chunk
+
+    def send_nonblocking(self, sock):
+        """Отправить сколько примет сокет. True - очередь пуста.
+        Накопленные куски уходят одним sendmsg (scatter-gather).
+        Ошибки сокета (кроме BlockingIOError) пробрасываются."""
+        with self.lock:
+            while self.chunks:
+                first = memoryview(self.chunks[0])[self.offset:]
+                try:
+                    if len(self.chunks) == 1:
+                        wanted = len(first)
+                        sent = sock.send(first)
+                    else:
+                        buffers = [first]
+                        buffers.extend(islice(self.chunks, 1, MAX_BATCH_CHUNKS))
+                        wanted = sum(len(buffer) for buffer in buffers)
+                        if hasattr(sock, 'sendmsg') and not isinstance(sock, ssl.SSLSocket):
+                            sent = sock.sendmsg(buffers)
+                        else:  # Windows и TLS - sendmsg нет
+                            sent = sock.send(b''.join(buffers))
+                except (BlockingIOError, InterruptedError,
+                        ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                    return False
+                self.writes += 1
+                self._consume(sent)
+                if sent < wanted:
+                    return False
+            return True
+
+    def _consume(self, sent):
+        """Убрать из очереди sent отправленных байт"""
+        self.bytes_sent += sent
+        while sent:
+            chunk = self.chunks[0]
+            rest = len(chunk) - self.offset
+            if sent < rest:
+                self.offset += sent
+                return
+            sent -= rest
+            self.chunks.popleft()
+            self.size -= len(chunk)
+            self.offset = 0
+
+    def take_pending(self):
+        """Забрать все неотправленные байты (горячий перезапуск)"""
+        with self.lock:
+            data = b''.join(self.chunks)[self.offset:]
+            self.chunks.clear()
+            self.size = 0
+            self.offset = 0
+            return data
+
+    def close(self):
+        """Закрыть очередь и разбудить писателя"""
+        with self.lock:
+            self.closed = True
+            self.chunks.clear()
+            self.size = 0
+            self.offset = 0
+            self.ready.notify_all()
+            self.writable.notify_all()
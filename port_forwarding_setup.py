@@ -5,203 +5,162 @@
 Максимально простая настройка роутера
 """
 
+import argparse
 import socket
 import subprocess
+import threading
 import urllib.request
-import requests
 import json
 import time
 from datetime import datetime
 
+import network_info
+import router_discovery
+import router_fingerprint
+import setup_stages
+import port_mapping
+
+# Пауза после добавления правила, прежде чем проверять порт снаружи
+MAPPING_SETTLE = 1.0
+# Срок аренды NAT-PMP (продлевает сервер с --port-mapping)
+NATPMP_LIFETIME = 3600
+
 class AutoPortForwarding:
-    def __init__(self, port=8888):
-        self.port = port
+    def __init__(self, port=8888, ports=None, protocols=('TCP',)):
+        # Несколько шардов - несколько портов; тест доступности идет по первому
+        self.ports = list(ports) if ports else [port]
+        self.port = self.ports[0]
+        self.protocols = tuple(protocols)
+        # Сеансы с роутером: найденный IGD и шлюз NAT-PMP живут до конца настройки
+        self.upnp = port_mapping.UpnpMapper()
+        self.natpmp = port_mapping.NatPmpMapper()
+        self.mappers = {self.upnp.name: self.upnp, self.natpmp.name: self.natpmp}
+        # Отчеты пишут фоновые этапы - доступ только под замком
+        self.mapping_lock = threading.Lock()
+        self.mapping_reports = {}
+        # Победивший способ; mapping_done останавливает второй
+        self.mapping_winner = None
+        self.mapping_done = threading.Event()
         self.local_ip = self.get_local_ip()
         self.public_ip = None
         self.router_ip = None
         self.router_info = {}
         
+    def ports_text(self):
+        """Порты одной строкой: подряд идущие - диапазоном (8888-8891,9000)"""
+        parts = []
+        for port in sorted(self.ports):
+            if parts and parts[-1][1] == port - 1:
+                parts[-1][1] = port
+            else:
+                parts.append([port, port])
+        return ','.join(str(first) if first == last else f"{first}-{last}"
+                        for first, last in parts)
+        
     def get_local_ip(self):
-        """Получить локальный IP"""
-        try:
-            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            s.connect(("8.8.8.8", 80))
-            ip = s.getsockname()[0]
-            s.close()
-            return ip
-        except:
-            return "127.0.0.1"
+        """Получить локальный IP (из общего кэша network_info)"""
+        return network_info.get_local_ip()
             
-    def get_public_ip(self):
+    def get_public_ip(self, timeout=5):
         """Получить публичный IP"""
         try:
-            ip = urllib.request.urlopen('https://api.ipify.org').read().decode()
+            ip = urllib.request.urlopen('https://api.ipify.org', timeout=timeout).read().decode()
             return ip
         except:
             return None
             
     def find_router_ip(self):
-        """Найти IP роутера"""
-        try:
-            result = subprocess.run(['ipconfig'], capture_output=True, text=True)
-            
-            for line in result.stdout.split('\n'):
-                if 'Default Gateway' in line:
-                    parts = line.split(':')
-                    if len(parts) > 1:
-                        gateway = parts[1].strip()
-                        if gateway and gateway != '0.0.0.0':
-                            return gateway
-        except:
-            pass
-            
-        # Стандартные IP роутеров
-        common_ips = ['192.168.1.1', '192.168.0.1', '192.168.1.254', '192.168.0.254']
-        
-        for ip in common_ips:
-            try:
-                test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_socket.settimeout(1)
-                result = test_socket.connect_ex((ip, 80))
-                test_socket.close()
-                
-                if result == 0:
-                    return ip
-            except:
-                continue
-                
-        return "192.168.1.1"
+        """Найти IP роутера: шлюз ОС и типичные адреса проверяются одновременно"""
+        router_ip, source = router_discovery.discover_router()
+        print(f"[ROUTER] Роутер: {router_ip} ({source})")
+        return router_ip
         
-    def detect_router_model(self):
-        """Определить модель роутера"""
+    def detect_router_model(self, timeout=5):
+        """Определить модель роутера (по кэшу или по первым байтам его страницы)"""
         print("[DETECT] Определение модели роутера...")
         
         try:
-            # Пытаемся получить информацию с роутера
-            response = requests.get(f"http://{self.router_ip}", timeout=5)
-            
-            # Анализируем ответ для определения модели
-            content = response.text.lower()
-            
-            if 'tp-link' in content:
-                self.router_info = {
-                    'brand': 'TP-Link',
-                    'login_url': f"http://{self.router_ip}",
-                    'login_field': 'password',
-                    'port_forwarding_path': '/userRpm/NatPortMappingRpm.htm'
-                }
-            elif 'd-link' in content:
-                self.router_info = {
-                    'brand': 'D-Link',
-                    'login_url': f"http://{self.router_ip}",
-                    'login_field': 'password',
-                    'port_forwarding_path': '/PortForwarding/PortForwarding.html'
-                }
-            elif 'asus' in content:
-                self.router_info = {
-                    'brand': 'ASUS',
-                    'login_url': f"http://{self.router_ip}",
-                    'login_field': 'login_authorization',
-                    'port_forwarding_path': '/Advanced_VirtualServer_Content.asp'
-                }
-            elif 'netgear' in content:
-                self.router_info = {
-                    'brand': 'Netgear',
-                    'login_url': f"http://{self.router_ip}",
-                    'login_field': 'password',
-                    'port_forwarding_path': '/PORT_forwarding.htm'
-                }
-            else:
-                self.router_info = {
-                    'brand': 'Unknown',
-                    'login_url': f"http://{self.router_ip}",
-                    'login_field': 'password',
-                    'port_forwarding_path': '/port_forwarding'
-                }
-                
-            print(f"[DETECTED] Роутер: {self.router_info['brand']}")
+            self.router_info, source = router_fingerprint.detect_router(self.router_ip, timeout)
+            print(f"[DETECTED] Роутер: {self.router_info['brand']} ({source})")
             return True
             
         except Exception as e:
             print(f"[ERROR] Не удалось определить роутер: {e}")
-            self.router_info = {
-                'brand': 'Unknown',
-                'login_url': f"http://{self.router_ip}",
-                'login_field': 'password',
-                'port_forwarding_path': '/port_forwarding'
-            }
+            self.router_info = router_fingerprint.router_info(None, self.router_ip)
             return False
             
     def auto_setup_upnp(self):
-        """Автоматическая настройка через UPnP"""
+        """Автоматическая настройка через UPnP (все порты одним сеансом с IGD)"""
         print("[UPNP] Пробую автоматическую настройку через UPnP...")
         
-        try:
-            # Используем miniupnpc для автоматической настройки
-            import miniupnpc
-            
-            upnp = miniupnpc.UPnP()
-            upnp.discover()
-            upnp.selectigd()
-            
-            # Добавляем порт
-            result = upnp.addportmapping(
-                self.port,
-                'TCP',
-                self.local_ip,
-                self.port,
-                'AndroidChatServer',
-                ''
-            )
-            
-            if result:
-                print(f"[UPNP_SUCCESS] Порт {self.port} добавлен через UPnP")
-                return True
-            else:
-                print("[UPNP_FAIL] UPnP не сработал")
-                return False
-                
-        except ImportError:
-            print("[UPNP_INFO] Библиотека miniupnpc не установлена")
-            print("[UPNP_INFO] Установите: pip install miniupnpc")
-            return False
-        except Exception as e:
-            print(f"[UPNP_ERROR] Ошибка UPnP: {e}")
-            return False
+        # Срок 0 - бессрочное правило, как раньше
+        return self.run_mapping('UPNP', self.upnp, lifetime=0)
             
     def auto_setup_natpmp(self):
         """Автоматическая настройка через NAT-PMP"""
         print("[NATPMP] Пробую автоматическую настройку через NAT-PMP...")
         
-        try:
-            # Используем natpmp для автоматической настройки
-            import natpmp
-            
-            nat = natpmp.NATPMP()
-            nat.init()
-            
-            # Добавляем порт
-            result = nat.request_port_mapping(
-                self.port,
-                self.port,
-                natpmp.NATPMP_PROTOCOL_TCP,
-                3600  # 1 час
-            )
-            
-            if result:
-                print(f"[NATPMP_SUCCESS] Порт {self.port} добавлен через NAT-PMP")
-                return True
-            else:
-                print("[NATPMP_FAIL] NAT-PMP не сработал")
-                return False
-                
-        except ImportError:
-            print("[NATPMP_INFO] Библиотека natpmp не установлена")
-            print("[NATPMP_INFO] Установите: pip install natpmp")
+        return self.run_mapping('NATPMP', self.natpmp, lifetime=NATPMP_LIFETIME)
+        
+    def run_mapping(self, tag, mapper, lifetime):
+        """Пробросить все порты одним способом; True - проброшены все.
+        UPnP и NAT-PMP идут параллельно: первый полностью успешный способ
+        побеждает, второй останавливается и снимает уже сделанные пробросы,
+        чтобы на роутере не оставалось правил, о которых никто не знает."""
+        if self.mapping_done.is_set():
+            print(f"[{tag}_SKIP] Порты уже проброшены через {self.mapping_winner}")
             return False
-        except Exception as e:
-            print(f"[NATPMP_ERROR] Ошибка NAT-PMP: {e}")
+        report = port_mapping.map_ports(mapper, self.ports, self.protocols, lifetime,
+                                        cancel=self.mapping_done)
+        undo = []
+        winner = None
+        with self.mapping_lock:
+            if report.complete and self.mapping_winner is None:
+                self.mapping_winner = report.method
+                self.mapping_done.set()
+                # Частичные пробросы проигравшего, закончившего раньше
+                undo = list(self.mapping_reports.values())
+                self.mapping_reports = {report.method: report}
+                winner = report
+            elif self.mapping_winner is not None:
+                undo = [report]
+                winner = self.mapping_reports[self.mapping_winner]
+            else:
+                self.mapping_reports[report.method] = report
+        for loser in undo:
+            # Порты победителя не снимаем: правило в таблице роутера может быть общим
+            removed = port_mapping.undo_mappings(self.mappers[loser.method], loser,
+                                                 keep=winner)
+            if removed:
+                print(f"[MAPPING] {loser.method}: снято лишних пробросов: {removed} "
+                      f"(сработал {self.mapping_winner})")
+        if report.method != self.mapping_winner and self.mapping_winner is not None:
             return False
+        return self.show_mapping_result(tag, report)
+        
+    def show_mapping_result(self, tag, report):
+        """Коротко сообщить итог способа; True - проброшены все порты"""
+        if report.complete:
+            print(f"[{tag}_SUCCESS] {report.summary()}")
+            return True
+        if report.succeeded:
+            print(f"[{tag}_PARTIAL] {report.summary()}")
+        elif report.failed:
+            print(f"[{tag}_FAIL] {report.failed[0].error}")
+        else:
+            print(f"[{tag}_FAIL] Не проброшено ни одного порта ({report.summary()})")
+        return False
+        
+    def remove_port_forwarding(self):
+        """Снять пробросы всех портов через UPnP и NAT-PMP"""
+        print("[REMOVE] Снимаю пробросы портов...")
+        reports = [port_mapping.unmap_ports(mapper, self.ports, self.protocols)
+                   for mapper in (self.upnp, self.natpmp)]
+        for report in reports:
+            print(f"[REMOVE] {report.summary()}")
+            for line in report.lines():
+                print(line)
+        return any(report.succeeded for report in reports)
             
     def setup_firewall(self):
         """Автоматическая настройка файрвола"""
@@ -218,12 +177,16 @@ class AutoPortForwarding:
             subprocess.run(['netsh', 'advfirewall', 'firewall', 'delete', 'rule', 
                           'name="AndroidChatServer"'], capture_output=True)
             
-            # Добавляем новое правило
-            cmd = f'netsh advfirewall firewall add rule name="AndroidChatServer" dir=in action=allow protocol=TCP localport={self.port}'
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+            # Добавляем новое правило (netsh понимает списки и диапазоны портов)
+            ports = self.ports_text()
+            for protocol in self.protocols:
+                cmd = f'netsh advfirewall firewall add rule name="AndroidChatServer" dir=in action=allow protocol={protocol} localport={ports}'
+                result = subprocess.run(cmd, shell=True, capture_output=True, text=True)
+                if result.returncode != 0:
+                    break
             
             if result.returncode == 0:
-                print(f"[FIREWALL_OK] Порт {self.port} добавлен в файрвол")
+                print(f"[FIREWALL_OK] Порты {ports} добавлены в файрвол")
                 return True
             else:
                 print(f"[FIREWALL_ERROR] Ошибка добавления порта")
@@ -233,14 +196,14 @@ class AutoPortForwarding:
             print(f"[FIREWALL_ERROR] Ошибка настройки файрвола: {e}")
             return False
             
-    def test_port_forwarding(self):
+    def test_port_forwarding(self, timeout=10):
         """Тест Port Forwarding"""
         print("[TEST] Тест Port Forwarding...")
         
         # Тест локального подключения
         try:
             test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            test_socket.settimeout(5)
+            test_socket.settimeout(min(5, timeout))
             result = test_socket.connect_ex((self.local_ip, self.port))
             test_socket.close()
             
@@ -255,7 +218,7 @@ class AutoPortForwarding:
         if self.public_ip:
             try:
                 test_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                test_socket.settimeout(10)
+                test_socket.settimeout(timeout)
                 result = test_socket.connect_ex((self.public_ip, self.port))
                 test_socket.close()
                 
@@ -271,48 +234,72 @@ class AutoPortForwarding:
                 
         return False
         
-    def auto_setup_all(self):
+    def auto_setup_all(self, timeout=setup_stages.DEFAULT_SETUP_TIMEOUT):
         """Полная автоматическая настройка"""
         print("="*70)
         print("[AUTO] АВТОМАТИЧЕСКАЯ НАСТРОЙКА PORT FORWARDING")
         print("="*70)
         
-        # Получаем информацию
-        self.public_ip = self.get_public_ip()
-        self.router_ip = self.find_router_ip()
+        with self.mapping_lock:
+            self.mapping_reports = {}
+            self.mapping_winner = None
+            self.mapping_done = threading.Event()
+        
+        # Независимые этапы - все сразу, под одним общим сроком
+        runner = setup_stages.StageRunner(timeout)
+        print("[PARALLEL] Одновременно: публичный IP, роутер, файрвол, UPnP, NAT-PMP")
+        print(f"[PARALLEL] Общий срок: {timeout:g} сек")
+        print()
+        runner.start('публичный IP', self.get_public_ip, runner.remaining())
+        runner.start('роутер', self.find_router_ip)
+        runner.start('файрвол', self.setup_firewall)
+        runner.start('UPnP', self.auto_setup_upnp)
+        runner.start('NAT-PMP', self.auto_setup_natpmp)
+        
+        # Модель роутера нужна только для ручной инструкции - ее не ждем
+        self.router_ip = runner.wait('роутер') or router_discovery.FALLBACK_ROUTER_IP
+        runner.start('модель роутера', self.detect_router_model,
+                     max(0.5, min(5, runner.remaining())))
+        
+        # Хватает одного способа: второй дальше не ждем
+        mapped = runner.wait_first(['UPnP', 'NAT-PMP'])
+        self.public_ip = runner.wait('публичный IP')
+        print()
         
         print(f"[INFO] Информация о сети:")
         print(f"   Локальный IP: {self.local_ip}")
         print(f"   Публичный IP: {self.public_ip}")
         print(f"   IP роутера: {self.router_ip}")
-        print(f"   Порт: {self.port}")
-        print()
-        
-        # Шаг 1: Настройка файрвола
-        print("[STEP1] Настройка файрвола Windows")
-        firewall_ok = self.setup_firewall()
+        print(f"   Порты: {self.ports_text()} ({', '.join(self.protocols)})")
+        if mapped:
+            print(f"   Проброс: {mapped}")
+        else:
+            print("   Проброс: ни UPnP, ни NAT-PMP не сработали")
         print()
         
-        # Шаг 2: Определение роутера
-        print("[STEP2] Определение модели роутера")
-        self.detect_router_model()
-        print()
+        if mapped:
+            time.sleep(min(MAPPING_SETTLE, runner.remaining()))  # Даем роутеру применить правило
+        tested = runner.run('тест', self.test_port_forwarding, max(1.0, runner.remaining()))
+        if not tested:
+            # Для ручной инструкции нужна модель роутера - ждем, но не дольше общего срока
+            runner.wait('модель роутера')
         
-        # Шаг 3: Автоматическая настройка UPnP
-        print("[STEP3] Автоматическая настройка UPnP")
-        upnp_ok = self.auto_setup_upnp()
         print()
-        
-        # Шаг 4: Автоматическая настройка NAT-PMP
-        print("[STEP4] Автоматическая настройка NAT-PMP")
-        natpmp_ok = self.auto_setup_natpmp()
+        print("[TIMING] Время этапов:")
+        for line in runner.report():
+            print(line)
         print()
         
-        # Шаг 5: Тест
-        print("[STEP5] Тест подключения")
-        time.sleep(2)  # Даем время на настройку
+        with self.mapping_lock:
+            reports = list(self.mapping_reports.values())
+        for report in reports:
+            print(f"[MAPPING] {report.summary()}")
+            for line in report.lines():
+                print(line)
+        if reports:
+            print()
         
-        if self.test_port_forwarding():
+        if tested:
             print("="*70)
             print("[SUCCESS] ✅ Port Forwarding настроен АВТОМАТИЧЕСКИ!")
             print("="*70)
@@ -326,24 +313,47 @@ class AutoPortForwarding:
             print("="*70)
             print("[AUTO_FAIL] ❌ Автоматическая настройка не сработала")
             print("="*70)
+            # Модель роутера могла не успеть определиться
+            login_url = self.router_info.get('login_url', f"http://{self.router_ip}")
             print("[MANUAL] Требуется ручная настройка:")
-            print(f"   1. Откройте: {self.router_info['login_url']}")
+            print(f"   1. Откройте: {login_url}")
             print(f"   2. Логин: admin, Пароль: admin/password")
             print(f"   3. Найдите: Port Forwarding")
             print(f"   4. Создайте правило:")
             print(f"      - Имя: AndroidChatServer")
-            print(f"      - Внешний порт: {self.port}")
-            print(f"      - Внутренний порт: {self.port}")
+            print(f"      - Внешний порт: {self.ports_text()}")
+            print(f"      - Внутренний порт: {self.ports_text()}")
             print(f"      - Внутренний IP: {self.local_ip}")
-            print(f"      - Протокол: TCP")
+            print(f"      - Протокол: {', '.join(self.protocols)}")
             print("="*70)
             return False
 
 def main():
+    parser = argparse.ArgumentParser(description="Автоматическая настройка Port Forwarding")
+    parser.add_argument('--ports', default='8888',
+                        help="порты сервера: список и диапазоны, например 8888-8891,9000")
+    parser.add_argument('--protocols', default='tcp',
+                        help="tcp, udp или tcp,udp")
+    parser.add_argument('--remove', action='store_true',
+                        help="снять пробросы этих портов и выйти")
+    args = parser.parse_args()
+    
+    try:
+        ports = port_mapping.parse_ports(args.ports)
+        protocols = [name.strip().upper() for name in args.protocols.split(',') if name.strip()]
+        if not ports or not protocols or any(p not in port_mapping.PROTOCOLS for p in protocols):
+            raise ValueError(f"Неверные порты или протоколы: {args.ports} {args.protocols}")
+    except ValueError as e:
+        parser.error(str(e))
+    
     print("[AUTO_PORT_FORWARDING] Автоматическая настройка")
     print("="*50)
     
-    auto = AutoPortForwarding(port=8888)
+    auto = AutoPortForwarding(ports=ports, protocols=protocols)
+    
+    if args.remove:
+        auto.remove_port_forwarding()
+        return
     
     # Проверяем права администратора
     try:
@@ -0,0 +1,542 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Аренда проброса портов на роутере
+NAT-PMP (RFC 6886, свой клиент без библиотек) и UPnP (miniupnpc).
+LeaseManager продлевает аренду в фоне и снимает проброс при остановке.
+"""
+
+import socket
+import struct
+import threading
+import time
+
+import router_discovery
+
+METHOD_AUTO = 'auto'
+METHOD_NATPMP = 'natpmp'
+METHOD_UPNP = 'upnp'
+METHODS = (METHOD_AUTO, METHOD_NATPMP, METHOD_UPNP)
+PROTOCOLS = ('TCP', 'UDP')
+
+# Срок аренды, который просим у роутера (сек)
+DEFAULT_LIFETIME = 3600
+# Продлевать на половине срока (так советует RFC 6886)
+RENEW_FRACTION = 0.5
+# Повтор после неудачного продления
+RETRY_INTERVAL = 30.0
+
+DESCRIPTION = 'AndroidChatServer'
+
+NATPMP_PORT = 5351
+NATPMP_VERSION = 0
+NATPMP_OP_EXTERNAL = 0
+NATPMP_OPCODES = {'UDP': 1, 'TCP': 2}
+# Первая попытка ждет 250 мс, каждая следующая - вдвое дольше
+NATPMP_TIMEOUT = 0.25
+NATPMP_TRIES = 3
+
+NATPMP_REQUEST = struct.Struct('!BBHHHI')
+NATPMP_HEADER = struct.Struct('!BBHI')
+NATPMP_MAPPING = struct.Struct('!HHI')
+
+NATPMP_RESULTS = {
+    1: 'версия не поддерживается',
+    2: 'запрещено настройками роутера',
+    3: 'сеть роутера недоступна',
+    4: 'нет свободных ресурсов',
+    5: 'операция не поддерживается',
+}
+
+# Задержка поиска IGD в miniupnpc (мс)
+UPNP_DISCOVER_DELAY = 200
+
+
+class MappingError(Exception):
+    """Роутер отказал в пробросе или не ответил"""
+
+
+class NatPmpMapper:
+    """NAT-PMP клиент: UDP запросы на порт 5351 шлюза"""
+
+    name = 'NAT-PMP'
+
+    def __init__(self, gateway=None, port=NATPMP_PORT, timeout=NATPMP_TIMEOUT,
+                 tries=NATPMP_TRIES):
+        # Шлюз, заданный явно, не забывается при reset
+        self.configured = gateway
+        self.gateway = gateway
+        self.port = port
+        self.timeout = timeout
+        self.tries = tries
+        # Время работы роутера по его часам: если уменьшилось - роутер
+        # перезагрузился и забыл все пробросы
+        self.epoch = None
+        self.rebooted = False
+
+    def reset(self):
+        """Забыть найденный шлюз (после ошибки - найти заново)"""
+        self.gateway = self.configured
+        self.epoch = None
+
+    def _gateway(self):
+        if self.gateway is None:
+            gateways = router_discovery.default_gateways()
+            if not gateways:
+                raise MappingError("Шлюз по умолчанию не найден")
+            self.gateway = gateways[0]
+        return self.gateway
+
+    def _request(self, payload, opcode, size):
+        """Отправить запрос с повторами, вернуть тело ответа после заголовка"""
+        gateway = self._gateway()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.connect((gateway, self.port))
+            timeout = self.timeout
+            for _ in range(self.tries):
+                sock.send(payload)
+                sock.settimeout(timeout)
+                deadline = time.monotonic() + timeout
+                while True:
+                    try:
+                        data = sock.recv(64)
+                    except socket.timeout:
+                        break
+                    except ConnectionRefusedError:
+                        raise MappingError(f"{gateway} не поддерживает NAT-PMP")
+                    if (len(data) >= size and data[0] == NATPMP_VERSION
+                            and data[1] == opcode + 128):
+                        return self._check(data, size)
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    sock.settimeout(remaining)
+                timeout *= 2
+        finally:
+            sock.close()
+        raise MappingError(f"{gateway} не ответил на NAT-PMP")
+
+    def _check(self, data, size):
+        _, _, result, epoch = NATPMP_HEADER.unpack_from(data)
+        if result:
+            reason = NATPMP_RESULTS.get(result, f"код {result}")
+            raise MappingError(f"NAT-PMP отказ: {reason}")
+        if self.epoch is not None and epoch < self.epoch:
+            self.rebooted = True
+        self.epoch = epoch
+        return data[NATPMP_HEADER.size:size]
+
+    def external_ip(self):
+        """Внешний IP роутера"""
+        body = self._request(struct.pack('!BB', NATPMP_VERSION, NATPMP_OP_EXTERNAL),
+                             NATPMP_OP_EXTERNAL, NATPMP_HEADER.size + 4)
+        return socket.inet_ntoa(body)
+
+    def add(self, protocol, external_port, internal_port, lifetime):
+        """Создать или продлить проброс, вернуть (внешний порт, выданный срок)"""
+        opcode = NATPMP_OPCODES[protocol]
+        body = self._request(NATPMP_REQUEST.pack(NATPMP_VERSION, opcode, 0, internal_port,
+                                                 external_port, lifetime),
+                             opcode, NATPMP_HEADER.size + NATPMP_MAPPING.size)
+        _, mapped_port, granted = NATPMP_MAPPING.unpack(body)
+        return mapped_port, granted
+
+    def remove(self, protocol, external_port, internal_port):
+        """Снять проброс (срок 0)"""
+        opcode = NATPMP_OPCODES[protocol]
+        self._request(NATPMP_REQUEST.pack(NATPMP_VERSION, opcode, 0, internal_port, 0, 0),
+                      opcode, NATPMP_HEADER.size + NATPMP_MAPPING.size)
+
+
+class UpnpMapper:
+    """UPnP IGD через miniupnpc. Найденный IGD запоминается: продление
+    не повторяет discover() и selectigd(), которые идут секундами."""
+
+    name = 'UPnP'
+
+    def __init__(self, description=DESCRIPTION, discover_delay=UPNP_DISCOVER_DELAY):
+        self.description = description
+        self.discover_delay = discover_delay
+        self.upnp = None
+        self.rebooted = False
+
+    def reset(self):
+        """Забыть IGD (после ошибки - искать заново)"""
+        self.upnp = None
+
+    def _igd(self):
+        if self.upnp is None:
+            try:
+                import miniupnpc
+            except ImportError:
+                raise MappingError("Библиотека miniupnpc не установлена "
+                                   "(pip install miniupnpc)")
+            upnp = miniupnpc.UPnP()
+            upnp.discoverdelay = self.discover_delay
+            if not upnp.discover():
+                raise MappingError("UPnP устройства не найдены")
+            try:
+                upnp.selectigd()
+            except Exception as e:
+                raise MappingError(f"UPnP IGD не найден: {e}")
+            self.upnp = upnp
+        return self.upnp
+
+    def external_ip(self):
+        """Внешний IP роутера"""
+        upnp = self._igd()
+        try:
+            return upnp.externalipaddress()
+        except Exception as e:
+            raise MappingError(f"UPnP: нет внешнего IP: {e}")
+
+    def add(self, protocol, external_port, internal_port, lifetime):
+        """Создать или продлить проброс, вернуть (внешний порт, выданный срок).
+        Срок 0 - роутер держит проброс бессрочно (много IGD не умеют аренду)."""
+        upnp = self._igd()
+        args = (external_port, protocol, upnp.lanaddr, internal_port, self.description, '')
+        try:
+            try:
+                result = upnp.addportmapping(*args, lifetime)
+            except TypeError:
+                # Старый miniupnpc без параметра срока
+                result, lifetime = upnp.addportmapping(*args), 0
+        except Exception as e:
+            if not lifetime:
+                raise MappingError(f"UPnP отказ: {e}")
+            # 725 OnlyPermanentLeasesSupported
+            try:
+                result, lifetime = upnp.addportmapping(*args), 0
+            except Exception as e:
+                raise MappingError(f"UPnP отказ: {e}")
+        if not result:
+            raise MappingError("UPnP отказ: роутер не добавил проброс")
+        return external_port, lifetime
+
+    def remove(self, protocol, external_port, internal_port):
+        """Снять проброс"""
+        try:
+            self._igd().deleteportmapping(external_port, protocol)
+        except Exception as e:
+            raise MappingError(f"UPnP: не удалось снять проброс: {e}")
+
+
+def parse_ports(text):
+    """Список портов из строки вида "8888-8891,9000" (без повторов, по порядку)"""
+    ports = []
+    for part in text.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, _, last = part.partition('-')
+        start, end = int(first), int(last or first)
+        if not 0 < start <= end <= 65535:
+            raise ValueError(f"Неверный диапазон портов: {part}")
+        ports.extend(port for port in range(start, end + 1) if port not in ports)
+    return ports
+
+
+class MappingResult:
+    """Итог по одному порту"""
+
+    __slots__ = ('protocol', 'port', 'mapped_port', 'lifetime', 'error')
+
+    def __init__(self, protocol, port, mapped_port=None, lifetime=0, error=None):
+        self.protocol = protocol
+        self.port = port
+        self.mapped_port = mapped_port
+        self.lifetime = lifetime
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class MappingReport:
+    """Итог пакетного проброса или снятия: что получилось, что нет"""
+
+    def __init__(self, method, removing=False):
+        self.method = method
+        self.removing = removing
+        self.results = []
+        self.external_ip = None
+        self.elapsed = 0.0
+        # Пакет прерван (проброс уже сделал другой способ)
+        self.cancelled = False
+
+    @property
+    def succeeded(self):
+        return [result for result in self.results if result.ok]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if not result.ok]
+
+    @property
+    def complete(self):
+        """Все порты обработаны успешно"""
+        return bool(self.results) and not self.failed and not self.cancelled
+
+    def summary(self):
+        action = 'снято' if self.removing else 'проброшено'
+        cancelled = ', прервано' if self.cancelled else ''
+        return (f"{self.method}: {action} {len(self.succeeded)} из {len(self.results)} "
+                f"за {self.elapsed:.2f} сек{cancelled}")
+
+    def lines(self):
+        """Строки отчета по каждому порту"""
+        lines = []
+        for result in self.results:
+            name = f"{result.port}/{result.protocol}"
+            if not result.ok:
+                lines.append(f"   {name:<12} ошибка: {result.error}")
+            elif self.removing:
+                lines.append(f"   {name:<12} снят")
+            else:
+                lease = f"аренда {result.lifetime} сек" if result.lifetime else 'бессрочно'
+                lines.append(f"   {name:<12} -> {self.external_ip}:{result.mapped_port} ({lease})")
+        return lines
+
+
+def _batch(mapper, ports, protocols, removing, action, cancel=None):
+    """Общая часть map_ports/unmap_ports: один сеанс с роутером на все порты.
+    cancel - threading.Event: если выставлен, следующие порты не трогаются."""
+    report = MappingReport(mapper.name, removing)
+    started = time.monotonic()
+    try:
+        # Поиск роутера (для UPnP - discover и selectigd) один раз на весь пакет
+        report.external_ip = mapper.external_ip()
+    except (MappingError, OSError) as e:
+        mapper.reset()
+        report.results = [MappingResult(protocol, port, error=str(e))
+                          for port in ports for protocol in protocols]
+        report.elapsed = time.monotonic() - started
+        return report
+    for port in ports:
+        for protocol in protocols:
+            if cancel is not None and cancel.is_set():
+                report.cancelled = True
+                report.elapsed = time.monotonic() - started
+                return report
+            try:
+                report.results.append(action(protocol, port))
+            except (MappingError, OSError) as e:
+                report.results.append(MappingResult(protocol, port, error=str(e)))
+    report.elapsed = time.monotonic() - started
+    return report
+
+
+def map_ports(mapper, ports, protocols=('TCP',), lifetime=DEFAULT_LIFETIME, cancel=None):
+    """Пробросить порты (внешний = внутренний) одним сеансом, вернуть MappingReport"""
+    def add(protocol, port):
+        mapped_port, granted = mapper.add(protocol, port, port, lifetime)
+        return MappingResult(protocol, port, mapped_port, granted)
+    return _batch(mapper, ports, protocols, False, add, cancel)
+
+
+def unmap_ports(mapper, ports, protocols=('TCP',)):
+    """Снять пробросы портов одним сеансом, вернуть MappingReport"""
+    def remove(protocol, port):
+        mapper.remove(protocol, port, port)
+        return MappingResult(protocol, port, port)
+    return _batch(mapper, ports, protocols, True, remove)
+
+
+def undo_mappings(mapper, report, keep=None):
+    """Снять пробросы, которые сделал пакет report; вернуть сколько снято.
+    keep - пакет другого способа: его порты не трогаем, ведь UPnP и NAT-PMP
+    на многих роутерах (miniupnpd) пишут в одну таблицу правил."""
+    kept = set()
+    if keep is not None:
+        kept = {(result.protocol, result.mapped_port) for result in keep.succeeded}
+    removed = 0
+    for result in report.succeeded:
+        if (result.protocol, result.mapped_port) in kept:
+            continue
+        try:
+            mapper.remove(result.protocol, result.mapped_port, result.port)
+            removed += 1
+        except (MappingError, OSError):
+            pass
+    return removed
+
+
+def make_mappers(method=METHOD_AUTO, description=DESCRIPTION):
+    """Способы проброса в порядке попыток (NAT-PMP отвечает быстрее)"""
+    if method == METHOD_NATPMP:
+        return [NatPmpMapper()]
+    if method == METHOD_UPNP:
+        return [UpnpMapper(description)]
+    if method == METHOD_AUTO:
+        return [NatPmpMapper(), UpnpMapper(description)]
+    raise ValueError(f"Неизвестный способ проброса: {method}")
+
+
+class Lease:
+    """Один проброс: протокол, порты и когда продлевать"""
+
+    __slots__ = ('protocol', 'internal_port', 'external_port', 'mapped_port',
+                 'granted', 'expires', 'renew_at', 'active', 'mapper')
+
+    def __init__(self, protocol, internal_port, external_port=None):
+        self.protocol = protocol
+        self.internal_port = internal_port
+        self.external_port = external_port or internal_port
+        # Порт, который выдал роутер (NAT-PMP может дать другой)
+        self.mapped_port = None
+        self.granted = 0
+        self.expires = None
+        self.renew_at = 0.0
+        self.active = False
+        # Способ, которым проброс создан - им же его и снимать
+        self.mapper = None
+
+
+class LeaseManager:
+    """Держит проброс портов открытым, пока работает сервер.
+
+    Фоновый поток продлевает каждую аренду на половине срока; выбранный
+    способ (и найденный им IGD) запоминается до первой ошибки. При
+    остановке пробросы снимаются, если их не забрал новый процесс.
+    """
+
+    def __init__(self, ports, protocols=('TCP',), method=METHOD_AUTO,
+                 lifetime=DEFAULT_LIFETIME, mappers=None, log=None):
+        self.leases = [Lease(protocol, port) for port in ports for protocol in protocols]
+        self.mappers = mappers if mappers is not None else make_mappers(method)
+        self.mapper = None
+        self.lifetime = lifetime
+        self.log = log
+        self.external_ip = None
+        self.last_error = None
+        self.renewals = 0
+        self.failures = 0
+        self.stopping = threading.Event()
+        self.stopped = False
+        self.thread = None
+
+    def _report(self, level, tag, message, *args):
+        if self.log:
+            getattr(self.log, level)(tag, message, *args)
+        else:
+            print(f"[{tag}] " + (message % args if args else message))
+
+    def start(self):
+        """Запустить фоновое продление (первый проброс - тоже в фоне)"""
+        self.thread = threading.Thread(target=self._run, name='port-mapping')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.stopping.wait(self.renew_due())
+
+    def _select(self):
+        """Первый способ, роутер которого ответил"""
+        for mapper in self.mappers:
+            try:
+                self.external_ip = mapper.external_ip()
+            except (MappingError, OSError) as e:
+                self.last_error = f"{mapper.name}: {e}"
+                mapper.reset()
+                continue
+            self.mapper = mapper
+            self._report('info', 'PORTMAP', "Проброс через %s, внешний IP %s",
+                         mapper.name, self.external_ip)
+            return mapper
+        return None
+
+    def renew_due(self, now=None):
+        """Продлить аренды, у которых подошел срок; вернуть секунды до следующей"""
+        now = time.monotonic() if now is None else now
+        if self.mapper is not None and self.mapper.rebooted:
+            # Роутер перезагрузился - все пробросы создать заново сейчас же
+            self.mapper.rebooted = False
+            for lease in self.leases:
+                lease.renew_at = now
+        for lease in self.leases:
+            if lease.renew_at <= now and not self.stopping.is_set():
+                self._renew(lease, now)
+        if not self.leases:
+            return RETRY_INTERVAL
+        return max(0.5, min(lease.renew_at for lease in self.leases) - now)
+
+    def _renew(self, lease, now):
+        mapper = self.mapper or self._select()
+        if mapper is None:
+            self.failures += 1
+            lease.renew_at = now + RETRY_INTERVAL
+            return
+        # Порт в запросе NAT-PMP - только пожелание: продлевать нужно тот,
+        # что роутер уже выдал, иначе появится второй проброс, а старый истечет
+        requested = lease.mapped_port or lease.external_port
+        try:
+            mapped_port, granted = mapper.add(lease.protocol, requested,
+                                              lease.internal_port, self.lifetime)
+        except (MappingError, OSError) as e:
+            self.failures += 1
+            self.last_error = f"{mapper.name}: {e}"
+            self._report('warning', 'PORTMAP', "Не удалось продлить %d/%s: %s",
+                         lease.external_port, lease.protocol, self.last_error)
+            # Следующая попытка заново найдет роутер (и, возможно, другой способ)
+            mapper.reset()
+            self.mapper = None
+            lease.renew_at = now + RETRY_INTERVAL
+            if lease.expires is not None and lease.expires <= now:
+                lease.active = False
+            return
+        if lease.active and mapped_port != lease.mapped_port:
+            self._report('warning', 'PORTMAP', "Роутер сменил внешний порт %d/%s: %d -> %d",
+                         lease.internal_port, lease.protocol, lease.mapped_port, mapped_port)
+        elif not lease.active:
+            self._report('info', 'PORTMAP', "Порт %d/%s открыт снаружи как %s:%d",
+                         lease.internal_port, lease.protocol, self.external_ip, mapped_port)
+        lease.mapped_port = mapped_port
+        lease.active = True
+        lease.mapper = mapper
+        lease.granted = granted
+        lease.expires = now + granted if granted else None
+        # Бессрочный проброс тоже обновляем: роутер мог перезагрузиться
+        lease.renew_at = now + (granted or self.lifetime) * RENEW_FRACTION
+        self.renewals += 1
+
+    def stop(self, remove=True):
+        """Остановить продление; remove - снять пробросы с роутера.
+        Повторный вызов ничего не делает (после горячего перезапуска
+        пробросы принадлежат новому процессу)."""
+        if self.stopped:
+            return
+        self.stopped = True
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=10.0)
+            self.thread = None
+        if not remove:
+            return
+        removed = 0
+        for lease in self.leases:
+            if not lease.active:
+                continue
+            try:
+                lease.mapper.remove(lease.protocol, lease.mapped_port, lease.internal_port)
+                removed += 1
+            except (MappingError, OSError) as e:
+                self._report('warning', 'PORTMAP', "Не удалось снять %d/%s: %s",
+                             lease.mapped_port, lease.protocol, e)
+            lease.active = False
+        if removed:
+            self._report('info', 'PORTMAP', "Снято пробросов: %d", removed)
+
+    def describe(self, now=None):
+        """Состояние одной строкой"""
+        now = time.monotonic() if now is None else now
+        active = [lease for lease in self.leases if lease.active]
+        if not active:
+            error = f" ({self.last_error})" if self.last_error else ''
+            return f"не открыт{error}"
+        ports = ', '.join(f"{lease.mapped_port}/{lease.protocol}" for lease in active)
+        renew = max(0, min(lease.renew_at for lease in active) - now)
+        renew_text = f"{renew:.0f} сек" if renew < 120 else f"{renew / 60:.0f} мин"
+        return (f"{active[0].mapper.name} {self.external_ip}: {ports}, "
+                f"продлений {self.renewals}, следующее через {renew_text}")
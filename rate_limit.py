@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Ограничение входящего трафика
+Token bucket на клиента, на IP и на прием подключений. Превысивший
+лимит клиент не получает ошибку: сервер просто перестает читать его
+сокет на время долга, и TCP сам притормаживает телефон.
+"""
+
+import threading
+import time
+
+# Сообщений в секунду (0 - без ограничения)
+DEFAULT_CLIENT_RATE = 100.0
+# Все подключения с одного IP (телефоны за одним NAT делят этот лимит)
+DEFAULT_IP_RATE = 1000.0
+# Новых подключений в секунду на весь сервер
+DEFAULT_ACCEPT_RATE = 200.0
+
+# Емкость ведра - столько секунд трафика можно прислать пачкой
+BURST_SECONDS = 2.0
+
+
+class TokenBucket:
+    """Ведро токенов, которое может уйти в минус.
+
+    Сообщения уже приняты, когда становится известно их число, поэтому
+    charge всегда списывает токены, а долг возвращается как время паузы.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, burst=BURST_SECONDS):
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def charge(self, amount, now):
+        """Списать amount токенов, вернуть сколько секунд ждать (0 - можно дальше)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class RateLimiter:
+    """Лимиты сервера: ведро у каждого клиента, общее ведро на IP и на accept"""
+
+    def __init__(self, metrics, client_rate=DEFAULT_CLIENT_RATE, ip_rate=DEFAULT_IP_RATE,
+                 accept_rate=DEFAULT_ACCEPT_RATE, burst=BURST_SECONDS):
+        self.metrics = metrics
+        self.client_rate = client_rate
+        self.ip_rate = ip_rate
+        self.burst = burst
+        # IP -> [ведро, число подключений]; удаляется с последним подключением
+        self.ip_buckets = {}
+        self.accept_bucket = TokenBucket(accept_rate, burst) if accept_rate > 0 else None
+        self.lock = threading.Lock()
+
+    def attach(self, record):
+        """Завести ведра новому клиенту"""
+        record.bucket = TokenBucket(self.client_rate, self.burst) if self.client_rate > 0 else None
+        if self.ip_rate > 0:
+            with self.lock:
+                entry = self.ip_buckets.get(record.address[0])
+                if entry is None:
+                    entry = self.ip_buckets[record.address[0]] = [TokenBucket(self.ip_rate, self.burst), 0]
+                entry[1] += 1
+
+    def detach(self, record):
+        """Клиент отключился"""
+        if self.ip_rate > 0:
+            with self.lock:
+                entry = self.ip_buckets.get(record.address[0])
+                if entry is not None:
+                    entry[1] -= 1
+                    if entry[1] <= 0:
+                        del self.ip_buckets[record.address[0]]
+
+    def charge(self, record, messages, now=None):
+        """Учесть принятые сообщения, вернуть паузу чтения в секундах"""
+        if not messages:
+            return 0.0
+        now = time.monotonic() if now is None else now
+        delay = record.bucket.charge(messages, now) if record.bucket else 0.0
+        ip_delay = 0.0
+        if self.ip_rate > 0:
+            with self.lock:
+                entry = self.ip_buckets.get(record.address[0])
+                if entry is not None:
+                    ip_delay = entry[0].charge(messages, now)
+        if ip_delay > delay:
+            self.metrics.ip_rate_limited += 1
+            return ip_delay
+        if delay:
+            self.metrics.rate_limited += 1
+        return delay
+
+    def accept_delay(self, now=None):
+        """Учесть принятое подключение, вернуть паузу приема в секундах"""
+        if self.accept_bucket is None:
+            return 0.0
+        delay = self.accept_bucket.charge(1, time.monotonic() if now is None else now)
+        if delay:
+            self.metrics.accepts_delayed += 1
+        return delay
+
+    def describe(self):
+        """Лимиты одной строкой для заголовка"""
+        def rate(value):
+            return f"{value:g}/сек" if value > 0 else "нет"
+        accept = self.accept_bucket.rate if self.accept_bucket else 0
+        return (f"клиент {rate(self.client_rate)}, IP {rate(self.ip_rate)}, "
+                f"подключения {rate(accept)}")
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Поиск роутера
+Шлюз по умолчанию из таблицы маршрутов ОС, затем одновременная проверка
+всех кандидатов с общим сроком: ответ дает первый, кто принял подключение
+"""
+
+import errno
+import re
+import selectors
+import socket
+import subprocess
+import time
+
+import network_info
+
+# Типичные адреса домашних роутеров - если ОС шлюз не сообщила
+COMMON_ROUTER_IPS = ('192.168.1.1', '192.168.0.1', '192.168.1.254', '192.168.0.254',
+                     '10.0.0.1', '192.168.100.1')
+
+# Последняя догадка, когда не ответил никто
+FALLBACK_ROUTER_IP = '192.168.1.1'
+
+# Общий срок на проверку всех кандидатов (раньше - по 1 сек на каждого)
+PROBE_TIMEOUT = 1.0
+# Срок на вызов ip / route / ipconfig
+COMMAND_TIMEOUT = 2.0
+
+ROUTER_PORT = 80
+
+_IPV4 = re.compile(r'\b(\d{1,3}(?:\.\d{1,3}){3})\b')
+
+
+def run_command(command):
+    """Вывод команды или пустая строка, если ее нет или она зависла"""
+    try:
+        result = subprocess.run(command, capture_output=True, text=True,
+                                errors='replace', timeout=COMMAND_TIMEOUT)
+        return result.stdout
+    except (OSError, subprocess.SubprocessError):
+        return ''
+
+
+def _valid_gateway(ip):
+    return bool(ip) and ip != '0.0.0.0' and _IPV4.fullmatch(ip) is not None
+
+
+def parse_ip_route(output):
+    """Шлюзы из вывода "ip route show default": default via X dev Y"""
+    gateways = []
+    for line in output.splitlines():
+        fields = line.split()
+        if fields[:1] == ['default'] and 'via' in fields:
+            index = fields.index('via') + 1
+            if index < len(fields):
+                gateways.append(fields[index])
+    return gateways
+
+
+def parse_route_get(output):
+    """Шлюз из вывода "route -n get default" (macOS, BSD)"""
+    for line in output.splitlines():
+        name, _, value = line.partition(':')
+        if name.strip() == 'gateway':
+            return [value.strip()]
+    return []
+
+
+def parse_ipconfig(output):
+    """Шлюзы из вывода ipconfig (Windows). IPv4 адрес шлюза может стоять
+    в строке "Default Gateway" или на следующей строке после IPv6 адреса"""
+    gateways = []
+    in_gateway = False
+    for line in output.splitlines():
+        if 'Default Gateway' in line or 'Основной шлюз' in line:
+            in_gateway = True
+            line = line.split(':', 1)[1] if ':' in line else ''
+        elif in_gateway and ':' in line and '. .' in line:
+            # Следующее поле блока адаптера
+            in_gateway = False
+            continue
+        if in_gateway:
+            match = _IPV4.search(line)
+            if match:
+                gateways.append(match.group(1))
+                in_gateway = False
+            elif line.strip() and '%' not in line and '::' not in line:
+                in_gateway = False
+    return gateways
+
+
+def default_gateways():
+    """Шлюзы по умолчанию из таблицы маршрутов ОС (без повторов, по порядку)"""
+    gateways = [gateway for _, gateway in network_info.read_default_routes()]
+    if not gateways:
+        gateways = parse_ip_route(run_command(['ip', '-4', 'route', 'show', 'default']))
+    if not gateways:
+        gateways = parse_route_get(run_command(['route', '-n', 'get', 'default']))
+    if not gateways:
+        gateways = parse_ipconfig(run_command(['ipconfig']))
+    unique = []
+    for gateway in gateways:
+        if _valid_gateway(gateway) and gateway not in unique:
+            unique.append(gateway)
+    return unique
+
+
+def probe_first(candidates, port=ROUTER_PORT, timeout=PROBE_TIMEOUT):
+    """Подключиться ко всем кандидатам сразу, вернуть (ip, время ответа)
+    первого принявшего подключение или (None, None) по истечении срока"""
+    started = time.monotonic()
+    deadline = started + timeout
+    selector = selectors.DefaultSelector()
+    sockets = []
+    try:
+        for ip in candidates:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setblocking(False)
+            try:
+                code = sock.connect_ex((ip, port))
+            except OSError:
+                continue
+            if code == 0:
+                return ip, time.monotonic() - started
+            if code in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                selector.register(sock, selectors.EVENT_WRITE, ip)
+
+        while selector.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for key, _ in selector.select(remaining):
+                selector.unregister(key.fileobj)
+                if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                    return key.data, time.monotonic() - started
+        return None, None
+    finally:
+        selector.close()
+        for sock in sockets:
+            sock.close()
+
+
+def discover_router(port=ROUTER_PORT, timeout=PROBE_TIMEOUT, candidates=None):
+    """Найти роутер: (ip, откуда взят).
+
+    Шлюзы из таблицы маршрутов проверяются вместе с типичными адресами.
+    Если не ответил никто, берется шлюз ОС, а без него - FALLBACK_ROUTER_IP.
+    """
+    gateways = default_gateways()
+    if candidates is None:
+        candidates = gateways + [ip for ip in COMMON_ROUTER_IPS if ip not in gateways]
+    ip, elapsed = probe_first(candidates, port, timeout)
+    if ip is not None:
+        source = 'маршрут' if ip in gateways else 'проверка'
+        return ip, f"{source}, ответ за {elapsed * 1000:.0f} мс"
+    if gateways:
+        return gateways[0], 'маршрут, не ответил'
+    return FALLBACK_ROUTER_IP, 'догадка'
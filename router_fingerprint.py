@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Определение модели роутера
+Таблица отпечатков собрана в одно регулярное выражение: заголовки и
+страница роутера читаются кусками до первого совпадения. Результат
+кэшируется на диске по MAC адресу шлюза (или по IP, если MAC неизвестен).
+"""
+
+import json
+import os
+import re
+import time
+import urllib.error
+import urllib.request
+
+import router_discovery
+
+# Бренд, признаки в заголовках или HTML, поле пароля и страница проброса портов.
+# Порядок важен только при совпадении в одном и том же месте текста.
+FINGERPRINTS = (
+    {'brand': 'TP-Link', 'patterns': ('tp-link', 'tplink'),
+     'login_field': 'password', 'port_forwarding_path': '/userRpm/NatPortMappingRpm.htm'},
+    {'brand': 'D-Link', 'patterns': ('d-link', 'dlink'),
+     'login_field': 'password', 'port_forwarding_path': '/PortForwarding/PortForwarding.html'},
+    {'brand': 'ASUS', 'patterns': ('asus',),
+     'login_field': 'login_authorization',
+     'port_forwarding_path': '/Advanced_VirtualServer_Content.asp'},
+    {'brand': 'Netgear', 'patterns': ('netgear', 'routerlogin'),
+     'login_field': 'password', 'port_forwarding_path': '/PORT_forwarding.htm'},
+)
+
+UNKNOWN = {'brand': 'Unknown', 'login_field': 'password',
+           'port_forwarding_path': '/port_forwarding'}
+
+# Заголовки, в которых роутеры называют себя (realm в WWW-Authenticate)
+HEADERS = ('Server', 'WWW-Authenticate', 'X-Powered-By')
+
+CHUNK_SIZE = 4096
+# Дальше этого страницу не читаем - признаки бренда в начале
+MAX_BYTES = 256 * 1024
+
+DEFAULT_CACHE = 'router_cache.json'
+# Бренд по MAC не меняется; по IP - роутер могли заменить
+CACHE_TTL = 30 * 24 * 3600
+IP_CACHE_TTL = 7 * 24 * 3600
+
+_MAC = re.compile(r'\b([0-9a-f]{1,2}(?:[:-][0-9a-f]{1,2}){5})\b', re.IGNORECASE)
+
+
+def compile_fingerprints(fingerprints=FINGERPRINTS):
+    """Одно регулярное выражение на все бренды: группа f<номер> - номер записи"""
+    alternatives = []
+    for index, entry in enumerate(fingerprints):
+        patterns = sorted(entry['patterns'], key=len, reverse=True)
+        alternatives.append(f"(?P<f{index}>{'|'.join(re.escape(p) for p in patterns)})")
+    return re.compile('|'.join(alternatives).encode('ascii'), re.IGNORECASE)
+
+
+_MATCHER = compile_fingerprints()
+# Сколько байт предыдущего куска оставлять, чтобы не пропустить признак на стыке
+_OVERLAP = max(len(p) for entry in FINGERPRINTS for p in entry['patterns']) - 1
+
+
+def _entry(match, fingerprints=FINGERPRINTS):
+    return fingerprints[int(match.lastgroup[1:])]
+
+
+def match_stream(chunks, matcher=_MATCHER, fingerprints=FINGERPRINTS, max_bytes=MAX_BYTES):
+    """Искать признаки в потоке кусков байт, остановиться на первом совпадении.
+    Вернуть (запись таблицы или None, прочитано байт)."""
+    tail = b''
+    total = 0
+    for chunk in chunks:
+        total += len(chunk)
+        data = tail + chunk
+        match = matcher.search(data)
+        if match:
+            return _entry(match, fingerprints), total
+        if total >= max_bytes:
+            break
+        tail = data[-_OVERLAP:] if _OVERLAP > 0 else b''
+    return None, total
+
+
+def router_info(entry, router_ip):
+    """Сведения о роутере для инструкции и настройки"""
+    entry = entry or UNKNOWN
+    return {
+        'brand': entry['brand'],
+        'login_url': f"http://{router_ip}",
+        'login_field': entry['login_field'],
+        'port_forwarding_path': entry['port_forwarding_path'],
+    }
+
+
+def _read_chunks(response):
+    while True:
+        chunk = response.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+# Роутер в локальной сети - прокси из переменных окружения здесь только мешает
+_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+def fetch_fingerprint(router_ip, timeout=5):
+    """Опознать роутер по HTTP: (запись таблицы или None, прочитано байт).
+    Ошибки сети - OSError."""
+    request = urllib.request.Request(f"http://{router_ip}/",
+                                     headers={'User-Agent': 'Mozilla/5.0'})
+    try:
+        response = _OPENER.open(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        # 401 с realm в WWW-Authenticate - частый способ роутера назваться
+        response = e
+    try:
+        headers = ' '.join(response.headers.get(name, '') for name in HEADERS)
+        match = _MATCHER.search(headers.encode('latin-1', 'replace'))
+        if match:
+            return _entry(match), 0
+        return match_stream(_read_chunks(response))
+    finally:
+        response.close()
+
+
+def gateway_mac(router_ip):
+    """MAC адрес шлюза из ARP кэша (после поиска роутера запись там уже есть)"""
+    output = ''
+    try:
+        with open('/proc/net/arp', encoding='ascii') as f:
+            for line in f:
+                fields = line.split()
+                if fields and fields[0] == router_ip and len(fields) > 3:
+                    output = fields[3]
+                    break
+    except OSError:
+        output = router_discovery.run_command(['arp', '-a', router_ip])
+        if not _MAC.search(output):
+            output = router_discovery.run_command(['arp', '-n', router_ip])
+    match = _MAC.search(output)
+    if not match:
+        return None
+    mac = ':'.join(part.zfill(2) for part in re.split('[:-]', match.group(1).lower()))
+    return None if mac == '00:00:00:00:00:00' else mac
+
+
+class FingerprintCache:
+    """Опознанные роутеры в JSON файле: ключ - MAC шлюза или его IP"""
+
+    def __init__(self, path=DEFAULT_CACHE):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key, now=None):
+        """Бренд из кэша или None (нет записи или она устарела)"""
+        entry = self.load().get(key)
+        if not entry:
+            return None
+        ttl = CACHE_TTL if key.startswith('mac:') else IP_CACHE_TTL
+        if (now or time.time()) - entry.get('time', 0) > ttl:
+            return None
+        return entry.get('brand')
+
+    def put(self, key, brand, now=None):
+        """Записать бренд (файл заменяется целиком - не бывает полузаписанным)"""
+        data = self.load()
+        data[key] = {'brand': brand, 'time': int(now or time.time())}
+        temp = f"{self.path}.tmp"
+        try:
+            with open(temp, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1)
+            os.replace(temp, self.path)
+        except OSError:
+            pass
+
+
+def cache_key(router_ip):
+    mac = gateway_mac(router_ip)
+    return f"mac:{mac}" if mac else f"ip:{router_ip}"
+
+
+def detect_router(router_ip, timeout=5, cache=None):
+    """Опознать роутер: (сведения, откуда известно). Сначала кэш, потом HTTP.
+    cache=None - кэш в DEFAULT_CACHE, False - без кэша."""
+    if cache is None:
+        cache = FingerprintCache()
+    key = cache_key(router_ip) if cache else None
+    if cache:
+        brand = cache.get(key)
+        for entry in FINGERPRINTS:
+            if entry['brand'] == brand:
+                return router_info(entry, router_ip), f"кэш, {key}"
+
+    entry, size = fetch_fingerprint(router_ip, timeout)
+    if entry is None:
+        return router_info(None, router_ip), f"не опознан, прочитано {size} байт"
+    if cache:
+        cache.put(key, entry['brand'])
+    where = f"страница, прочитано {size} байт" if size else 'заголовки'
+    return router_info(entry, router_ip), where
@@ -0,0 +1,421 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Движок сервера на selectors
+Все клиенты обслуживаются в одном цикле, без потока на подключение
+"""
+
+import heapq
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+
+from message_framing import FrameError, RECV_SIZE
+from outbound_queue import QueueOverflow
+from client_registry import ClientRecord
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Сколько подключений принимать за одно пробуждение (остальные - в следующей итерации)
+ACCEPT_BATCH = 64
+
+
+def raise_fd_limit():
+    """Поднять лимит открытых файлов до максимума (для 10k+ подключений)"""
+    if resource is None:
+        return None
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            target = hard if hard != resource.RLIM_INFINITY else 1048576
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+            return target
+        return soft
+    except (ValueError, OSError):
+        return None
+
+
+class SelectorEngine:
+    """Однопоточный цикл обработки всех сокетов через selectors"""
+
+    def __init__(self, server):
+        self.server = server
+        self.selector = selectors.DefaultSelector()
+        # Таблица подключений - общий реестр сервера
+        self.connections = server.clients
+        self.pending_calls = deque()
+        self.thread = None
+        # Один буфер приема на весь цикл - без лишних аллокаций
+        self.recv_buffer = bytearray(RECV_SIZE)
+        self.recv_view = memoryview(self.recv_buffer)
+        # Клиенты с новыми данными в очереди: отправка одним вызовом в конце итерации
+        self.dirty = {}
+        # Клиенты на паузе по лимиту сообщений: куча (срок, client_id);
+        # прием подключений на паузе до accept_paused_until
+        self.throttled = []
+        self.accept_paused_until = 0.0
+        self.wakeup_recv, self.wakeup_send = socket.socketpair()
+        self.wakeup_recv.setblocking(False)
+        self.wakeup_send.setblocking(False)
+
+    def call_soon(self, func, *args):
+        """Выполнить функцию в потоке цикла (безопасно из любого потока)"""
+        self.pending_calls.append((func, args))
+        self.wakeup()
+
+    def wakeup(self):
+        """Разбудить цикл"""
+        try:
+            self.wakeup_send.send(b'\0')
+        except OSError:
+            pass
+
+    def run(self):
+        """Главный цикл"""
+        self.thread = threading.current_thread()
+        limit = raise_fd_limit()
+        if limit:
+            self.server.log.info('LIMIT', "Лимит открытых файлов: %d", limit)
+
+        server_socket = self.server.server_socket
+        server_socket.setblocking(False)
+        self.selector.register(server_socket, selectors.EVENT_READ, self._on_accept)
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ, self._on_wakeup)
+
+        self.server.log.info('LISTEN', "Слушаю порт %d на всех интерфейсах (selectors)...",
+                             self.server.port)
+        heartbeat = self.server.heartbeat
+        acks = self.server.acks
+        timeout = heartbeat.wheel.tick if heartbeat else 1.0
+        try:
+            while self.server.server_running:
+                events = self.selector.select(timeout=self._timeout(acks.timeout(timeout)))
+                for key, mask in events:
+                    if isinstance(key.data, ClientRecord):
+                        self._on_client_event(key.data, mask)
+                    else:
+                        key.data()
+                self._run_pending()
+                if heartbeat:
+                    heartbeat.tick()
+                acks.tick()
+                self._resume_throttled()
+                self._flush_dirty()
+        except Exception as e:
+            if self.server.server_running:
+                self.server.log.error('ERROR', "Ошибка цикла selectors: %s: %s",
+                                      type(e).__name__, e)
+        finally:
+            self._close_all()
+
+    def stop(self, timeout=5.0):
+        """Остановить цикл и дождаться закрытия клиентов"""
+        self.wakeup()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def _timeout(self, timeout):
+        """Таймаут select: не проспать конец паузы клиента или приема"""
+        due = [self.throttled[0][0]] if self.throttled else []
+        if self.accept_paused_until:
+            due.append(self.accept_paused_until)
+        if not due:
+            return timeout
+        return max(0.0, min(timeout, min(due) - time.monotonic()))
+
+    def _resume_throttled(self):
+        """Снять паузы, срок которых наступил"""
+        now = time.monotonic()
+        if self.accept_paused_until and self.accept_paused_until <= now:
+            self.accept_paused_until = 0.0
+            if not self.server.draining:
+                self.resume_accepting()
+        while self.throttled and self.throttled[0][0] <= now:
+            _, client_id = heapq.heappop(self.throttled)
+            conn = self.connections.get(client_id)
+            if conn is not None and conn.paused_until:
+                conn.paused_until = 0.0
+                self._update_events(conn)
+
+    def stop_accepting(self, close=True):
+        """Снять слушающий сокет с цикла (только из потока цикла).
+        close=False - сокет остается открытым для передачи новому процессу"""
+        server_socket = self.server.server_socket
+        try:
+            self.selector.unregister(server_socket)
+        except (KeyError, ValueError):
+            pass
+        if close:
+            try:
+                server_socket.close()
+            except OSError:
+                pass
+
+    def resume_accepting(self):
+        """Снова принимать подключения (после паузы или неудачной передачи)"""
+        try:
+            self.selector.register(self.server.server_socket, selectors.EVENT_READ,
+                                   self._on_accept)
+        except KeyError:
+            pass
+
+    def detach(self, conn):
+        """Снять клиента с цикла, не закрывая сокет (только из потока цикла)"""
+        try:
+            self.selector.unregister(conn.socket)
+        except (KeyError, ValueError):
+            pass
+        self.dirty.pop(conn.client_id, None)
+        self.connections.remove(conn.client_id)
+        return conn
+
+    def adopt(self, conn):
+        """Начать обслуживать клиента, полученного от старого процесса"""
+        conn.socket.setblocking(False)
+        conn.events = selectors.EVENT_READ
+        self.selector.register(conn.socket, selectors.EVENT_READ, conn)
+        # Неотправленное старым процессом уйдет в конце итерации
+        self.dirty[conn.client_id] = conn
+
+    def _run_pending(self):
+        """Выполнить отложенные вызовы из других потоков"""
+        while self.pending_calls:
+            func, args = self.pending_calls.popleft()
+            try:
+                func(*args)
+            except Exception as e:
+                self.server.log.error('ERROR', "Ошибка отложенного вызова: %s", e)
+
+    def _on_wakeup(self):
+        """Сбросить байты пробуждения"""
+        try:
+            while self.wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, InterruptedError):
+            pass
+
+    def _on_accept(self):
+        """Принять все ожидающие подключения (не больше ACCEPT_BATCH за раз)"""
+        for _ in range(ACCEPT_BATCH):
+            try:
+                client_socket, client_address = self.server.server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if self.server.server_running:
+                    self.server.metrics.error('accept')
+                    self.server.log.error('ERROR', "Ошибка принятия подключения: %s", e)
+                return
+            if not self._accept_one(client_socket, client_address):
+                return
+
+    def _accept_one(self, client_socket, client_address):
+        """Регистрация принятого подключения. False - прием на паузе по лимиту"""
+        client_socket.setblocking(False)
+        ssl_context = self.server.ssl_context
+        if ssl_context:
+            # Рукопожатие идет неблокирующим в цикле, не задерживая accept
+            client_socket = ssl_context.wrap_socket(client_socket, server_side=True,
+                                                    do_handshake_on_connect=False)
+        conn = self.server.register_client(client_socket, client_address)
+        client_id = conn.client_id
+        conn.handshaking = ssl_context is not None
+        conn.events = selectors.EVENT_READ
+        self.selector.register(client_socket, selectors.EVENT_READ, conn)
+
+        self.send(conn, self.server.make_welcome().encode())
+        self.server.log.debug('SENT', "Приветствие поставлено в очередь для %s", client_id)
+
+        # Лимит подключений: слушающий сокет снимается с цикла, остальные
+        # подождут в очереди ядра (backlog)
+        delay = self.server.limits.accept_delay()
+        if delay:
+            self.stop_accepting(close=False)
+            self.accept_paused_until = time.monotonic() + delay
+            return False
+        return True
+
+    def _on_client_event(self, conn, mask):
+        """Событие на клиентском сокете"""
+        if conn.handshaking:
+            self._handshake(conn)
+            return
+        if mask & selectors.EVENT_WRITE:
+            self._flush(conn)
+        if mask & selectors.EVENT_READ and conn.client_id in self.connections:
+            self._on_read(conn)
+
+    def _handshake(self, conn):
+        """Шаг TLS рукопожатия; после него уходит приветствие из очереди"""
+        try:
+            conn.socket.do_handshake()
+        except ssl.SSLWantReadError:
+            self._set_events(conn, selectors.EVENT_READ)
+            return
+        except ssl.SSLWantWriteError:
+            self._set_events(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            return
+        except OSError as e:
+            self.server.metrics.error('tls')
+            self.server.log.warning('TLS', "Рукопожатие с %s не удалось: %s", conn.client_id, e)
+            self.close_client(conn.client_id)
+            return
+
+        conn.handshaking = False
+        resumed = conn.socket.session_reused
+        self.server.metrics.tls_handshakes += 1
+        if resumed:
+            self.server.metrics.tls_resumed += 1
+        self.server.log.debug('TLS', "Клиент %s: %s%s", conn.client_id, conn.socket.version(),
+                              " (сессия возобновлена)" if resumed else "")
+        self._flush(conn)
+
+    def _set_events(self, conn, events):
+        """Маска событий клиента; 0 - сокет снимается с цикла до следующего вызова"""
+        if events == conn.events:
+            return
+        if not events:
+            self.selector.unregister(conn.socket)
+        elif not conn.events:
+            self.selector.register(conn.socket, events, conn)
+        else:
+            self.selector.modify(conn.socket, events, conn)
+        conn.events = events
+
+    def _update_events(self, conn):
+        """Чтение - если клиент не на паузе, запись - если очередь не пуста"""
+        events = 0 if conn.paused_until or conn.backpressure else selectors.EVENT_READ
+        if len(conn.queue):
+            events |= selectors.EVENT_WRITE
+        self._set_events(conn, events)
+
+    def _on_read(self, conn):
+        """Прием данных от клиента"""
+        try:
+            size = conn.socket.recv_into(self.recv_buffer)
+        except (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError):
+            return
+        except OSError as e:
+            self.server.metrics.error('recv')
+            self.server.log.error('ERROR', "Ошибка приема от %s: %s", conn.client_id, e)
+            self.close_client(conn.client_id)
+            return
+
+        if not size:
+            self.server.log.info('DISCONNECT', "Клиент %s отключился (нет данных)", conn.client_id)
+            self.close_client(conn.client_id)
+            return
+
+        received = time.perf_counter()
+        acks = conn.messages_out
+        messages = conn.messages_in
+        try:
+            response = self.server.process_data(conn, self.recv_view[:size])
+        except FrameError as e:
+            self.server.metrics.error('frame')
+            self.server.log.error('ERROR', "Ошибка приема от %s: %s", conn.client_id, e)
+            self.close_client(conn.client_id)
+            return
+
+        if response:
+            self.send(conn, response)
+            self.server.metrics.ack_latency.observe(time.perf_counter() - received,
+                                                    conn.messages_out - acks)
+
+        delay = self.server.limits.charge(conn, conn.messages_in - messages)
+        if delay and conn.client_id in self.connections:
+            # Превышен лимит - сокет не читается, TCP притормозит клиента
+            conn.paused_until = time.monotonic() + delay
+            heapq.heappush(self.throttled, (conn.paused_until, conn.client_id))
+            self._update_events(conn)
+            self.server.log.debug('LIMIT', "Клиент %s превысил лимит, пауза %.3f сек",
+                                  conn.client_id, delay)
+            return
+
+        # TLS мог расшифровать больше, чем поместилось в буфер: сокет
+        # при этом уже не будет готов к чтению, дочитываем сами
+        if self.server.ssl_context and conn.client_id in self.connections \
+                and conn.socket.pending() and not conn.backpressure:
+            self.pending_calls.append((self._on_read, (conn,)))
+
+    def send(self, conn, data, force=True):
+        """Поставить данные в очередь клиента; отправка - в конце итерации цикла,
+        все накопленное за итерацию уходит одним вызовом.
+        force=False - применяется политика медленного клиента."""
+        try:
+            queued = conn.queue.push(data, force=force)
+        except QueueOverflow as e:
+            self.server.metrics.error('slow_consumer')
+            self.server.log.warning('SLOW', "Медленный клиент %s: %s", conn.client_id, e)
+            self.close_client(conn.client_id)
+            return False
+        self.dirty[conn.client_id] = conn
+        return queued
+
+    def broadcast(self, payload, records=None):
+        """Рассылка всем клиентам или списку records (только из потока цикла)"""
+        for conn in (self.connections.snapshot() if records is None else records):
+            if self.send(conn, payload.get(conn.decoder.mode, conn.decoder.compress), force=False):
+                self.server.log.debug('SENT', "Отправлено клиенту %s", conn.client_id)
+            elif conn.client_id in self.connections:
+                self.server.log.warning('DROP', "Очередь %s заполнена, сообщение пропущено",
+                                        conn.client_id)
+
+    def _flush_dirty(self):
+        """Отправить очереди всех клиентов, получивших данные за итерацию"""
+        while self.dirty:
+            dirty = self.dirty
+            self.dirty = {}
+            for conn in dirty.values():
+                self._flush(conn)
+
+    def _flush(self, conn):
+        """Отправить очередь без блокировки, остаток - по EVENT_WRITE"""
+        if conn.queue.closed or conn.handshaking:
+            return
+        try:
+            conn.queue.send_nonblocking(conn.socket)
+        except OSError as e:
+            self.server.metrics.error('send')
+            self.server.log.error('ERROR', "Ошибка отправки %s: %s", conn.client_id, e)
+            self.close_client(conn.client_id)
+            return
+
+        # Клиент не успевает читать - не читаем и его, пока очередь не опустеет наполовину
+        if conn.backpressure:
+            if conn.queue.is_low():
+                conn.backpressure = False
+        elif conn.queue.is_full():
+            conn.backpressure = True
+            self.server.metrics.backpressure_pauses += 1
+            self.server.log.debug('LIMIT', "Очередь %s заполнена, чтение приостановлено",
+                                  conn.client_id)
+        self._update_events(conn)
+
+    def close_client(self, client_id):
+        """Закрыть клиента (только из потока цикла)"""
+        conn = self.connections.get(client_id)
+        if conn is None:
+            return
+        try:
+            self.selector.unregister(conn.socket)
+        except (KeyError, ValueError):
+            pass
+        self.server.unregister_client(client_id)
+
+    def _close_all(self):
+        """Закрыть все подключения при остановке"""
+        for client_id in self.connections.ids():
+            self.close_client(client_id)
+        for sock in (self.server.server_socket, self.wakeup_recv):
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+        self.selector.close()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Асинхронное логирование сервера
+Горячий путь только кладет запись в очередь, форматирует и пишет фоновый поток
+"""
+
+import json
+import os
+import queue
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR
+}
+LEVEL_NAMES = {value: name.upper() for name, value in LEVELS.items()}
+
+DEFAULT_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BACKUPS = 3
+BATCH_SIZE = 512
+
+_STOP = object()
+
+
+class RotatingFile:
+    """Файл лога с ротацией по размеру: log, log.1, log.2 ..."""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.file = open(path, 'a', encoding='utf-8')
+        self.size = self.file.tell()
+
+    def write(self, text):
+        """Записать пачку строк, при необходимости повернуть файл"""
+        if self.max_bytes and self.size + len(text) > self.max_bytes and self.size:
+            self.rotate()
+        self.file.write(text)
+        self.file.flush()
+        self.size += len(text)
+
+    def rotate(self):
+        """Сдвинуть старые файлы и начать новый"""
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{i}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+
+
+class ServerLog:
+    """Лог с уровнями, фоновым писателем и пакетной записью"""
+
+    def __init__(self, level='info', log_file=None, quiet=False,
+                 max_bytes=DEFAULT_MAX_BYTES, backups=DEFAULT_BACKUPS, stream=None):
+        self.level = LEVELS[level] if isinstance(level, str) else level
+        # Тихий режим: в консоль только предупреждения и ошибки
+        self.console_level = WARNING if quiet else self.level
+        self.min_level = min(self.level, self.console_level) if log_file else self.console_level
+        self.stream = stream or sys.stdout
+        self.file = RotatingFile(log_file, max_bytes, backups) if log_file else None
+        self.records = queue.SimpleQueue()
+        self.dropped_errors = 0
+        self.thread = threading.Thread(target=self._writer, name='server-log')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def enabled(self, level):
+        """Будет ли запись такого уровня куда-нибудь записана"""
+        return level >= self.min_level
+
+    def log(self, level, tag, message, *args, **fields):
+        """Поставить запись в очередь (форматирование - в фоне)"""
+        if level >= self.min_level:
+            self.records.put((time.time(), level, tag, message, args, fields))
+
+    def debug(self, tag, message, *args, **fields):
+        self.log(DEBUG, tag, message, *args, **fields)
+
+    def info(self, tag, message, *args, **fields):
+        self.log(INFO, tag, message, *args, **fields)
+
+    def warning(self, tag, message, *args, **fields):
+        self.log(WARNING, tag, message, *args, **fields)
+
+    def error(self, tag, message, *args, **fields):
+        self.log(ERROR, tag, message, *args, **fields)
+
+    def _writer(self):
+        """Фоновый поток: забирает записи пачками и пишет разом"""
+        running = True
+        while running:
+            batch = [self.records.get()]
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            console_lines = []
+            file_lines = []
+            for record in batch:
+                if record is _STOP:
+                    running = False
+                    continue
+                created, level, tag, message, args, fields = record
+                try:
+                    text = message % args if args else message
+                except Exception as e:
+                    text = f"{message} {args} (ошибка форматирования: {e})"
+                if level >= self.console_level:
+                    console_lines.append(f"[{tag}] {text}\n")
+                if self.file and level >= self.level:
+                    entry = {
+                        'ts': round(created, 3),
+                        'level': LEVEL_NAMES.get(level, str(level)),
+                        'tag': tag,
+                        'msg': text
+                    }
+                    if fields:
+                        entry.update(fields)
+                    file_lines.append(json.dumps(entry, ensure_ascii=False, default=str) + '\n')
+
+            try:
+                if console_lines:
+                    self.stream.write(''.join(console_lines))
+                    self.stream.flush()
+                if file_lines:
+                    self.file.write(''.join(file_lines))
+            except Exception:
+                self.dropped_errors += 1
+
+    def close(self, timeout=2.0):
+        """Дописать очередь и остановить писателя"""
+        if self.thread.is_alive():
+            self.records.put(_STOP)
+            self.thread.join(timeout)
+        if self.file:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Метрики сервера
+Счетчики горячего пути, гистограмма задержки подтверждений
+и локальный HTTP endpoint в текстовом формате Prometheus
+"""
+
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин гистограммы задержки (секунды)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+COUNTERS = ('connections_accepted', 'connections_closed', 'bytes_in', 'bytes_out',
+            'messages_in', 'messages_out', 'messages_dropped', 'socket_writes',
+            'tls_handshakes', 'tls_resumed', 'rate_limited', 'ip_rate_limited',
+            'accepts_delayed', 'backpressure_pauses')
+
+
+class LatencyHistogram:
+    """Гистограмма с фиксированными корзинами"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value, count=1):
+        """Добавить наблюдение (count одинаковых значений разом)"""
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += count
+            self.total += value * count
+            self.count += count
+
+    def snapshot(self):
+        with self.lock:
+            return {'buckets': list(self.counts), 'sum': self.total, 'count': self.count}
+
+
+class ServerMetrics:
+    """Метрики одного процесса сервера.
+
+    Байты и сообщения по живым клиентам лежат в их ClientRecord и
+    суммируются при снятии снимка, поэтому горячий путь не трогает
+    общих счетчиков. Итоги отключившихся клиентов копятся здесь.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.connections_accepted = 0
+        self.tls_handshakes = 0
+        self.tls_resumed = 0
+        # Паузы чтения по лимитам (rate_limit.py) и по заполненной очереди
+        self.rate_limited = 0
+        self.ip_rate_limited = 0
+        self.accepts_delayed = 0
+        self.backpressure_pauses = 0
+        self.closed_totals = dict.fromkeys(COUNTERS, 0)
+        self.errors = {}
+        self.ack_latency = LatencyHistogram()
+        self.lock = threading.Lock()
+        # Для расчета скорости между вызовами команды metrics
+        self.last_rate_sample = (time.time(), 0, 0, 0)
+
+    def error(self, kind):
+        """Посчитать ошибку по виду"""
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def record_closed(self, record):
+        """Перенести итоги отключившегося клиента в общие счетчики"""
+        with self.lock:
+            totals = self.closed_totals
+            totals['connections_closed'] += 1
+            totals['bytes_in'] += record.bytes_in
+            totals['bytes_out'] += record.bytes_out
+            totals['messages_in'] += record.messages_in
+            totals['messages_out'] += record.messages_out + record.ack_flushed
+            totals['messages_dropped'] += record.queue.dropped
+            totals['socket_writes'] += record.queue.writes
+
+    def snapshot(self, registry):
+        """Снимок всех метрик (словарь, можно передать между процессами)"""
+        with self.lock:
+            counters = dict(self.closed_totals)
+            errors = dict(self.errors)
+        counters['connections_accepted'] = self.connections_accepted
+        counters['tls_handshakes'] = self.tls_handshakes
+        counters['tls_resumed'] = self.tls_resumed
+        counters['rate_limited'] = self.rate_limited
+        counters['ip_rate_limited'] = self.ip_rate_limited
+        counters['accepts_delayed'] = self.accepts_delayed
+        counters['backpressure_pauses'] = self.backpressure_pauses
+
+        queued_bytes = 0
+        queue_max = 0
+        clients = []
+        for record in registry.snapshot():
+            counters['bytes_in'] += record.bytes_in
+            counters['bytes_out'] += record.bytes_out
+            counters['messages_in'] += record.messages_in
+            counters['messages_out'] += record.messages_out + record.ack_flushed
+            counters['messages_dropped'] += record.queue.dropped
+            counters['socket_writes'] += record.queue.writes
+            depth = len(record.queue)
+            queued_bytes += depth
+            queue_max = max(queue_max, depth)
+            clients.append((record.client_id, record.bytes_in, record.bytes_out,
+                            record.messages_in, record.messages_out + record.ack_flushed, depth))
+
+        return {
+            'counters': counters,
+            'gauges': {
+                'clients': len(clients),
+                'queue_bytes': queued_bytes,
+                'queue_max_bytes': queue_max,
+                'uptime_seconds': time.time() - self.started
+            },
+            'errors': errors,
+            'ack_latency': self.ack_latency.snapshot(),
+            'clients': clients
+        }
+
+    def rates(self, snapshot):
+        """Скорости с прошлого вызова: подключения, сообщения, байты в секунду"""
+        now = time.time()
+        counters = snapshot['counters']
+        current = (now, counters['connections_accepted'], counters['messages_in'],
+                   counters['bytes_in'] + counters['bytes_out'])
+        previous = self.last_rate_sample
+        self.last_rate_sample = current
+        elapsed = max(now - previous[0], 1e-6)
+        return tuple((current[i] - previous[i]) / elapsed for i in range(1, 4))
+
+
+def merge_snapshots(snapshots):
+    """Сложить снимки нескольких процессов-воркеров"""
+    merged = {
+        'counters': dict.fromkeys(COUNTERS, 0),
+        'gauges': {'clients': 0, 'queue_bytes': 0, 'queue_max_bytes': 0, 'uptime_seconds': 0.0},
+        'errors': {},
+        'ack_latency': {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'sum': 0.0, 'count': 0},
+        'clients': []
+    }
+    for snapshot in snapshots:
+        for name, value in snapshot['counters'].items():
+            merged['counters'][name] = merged['counters'].get(name, 0) + value
+        gauges = snapshot['gauges']
+        merged['gauges']['clients'] += gauges['clients']
+        merged['gauges']['queue_bytes'] += gauges['queue_bytes']
+        merged['gauges']['queue_max_bytes'] = max(merged['gauges']['queue_max_bytes'],
+                                                  gauges['queue_max_bytes'])
+        merged['gauges']['uptime_seconds'] = max(merged['gauges']['uptime_seconds'],
+                                                 gauges['uptime_seconds'])
+        for kind, value in snapshot['errors'].items():
+            merged['errors'][kind] = merged['errors'].get(kind, 0) + value
+        latency = snapshot['ack_latency']
+        merged['ack_latency']['buckets'] = [a + b for a, b in
+                                            zip(merged['ack_latency']['buckets'], latency['buckets'])]
+        merged['ack_latency']['sum'] += latency['sum']
+        merged['ack_latency']['count'] += latency['count']
+        merged['clients'].extend(snapshot['clients'])
+    return merged
+
+
+def latency_percentile(latency, fraction):
+    """Оценка перцентиля по корзинам (верхняя граница корзины)"""
+    if not latency['count']:
+        return 0.0
+    target = fraction * latency['count']
+    seen = 0
+    for index, count in enumerate(latency['buckets']):
+        seen += count
+        if seen >= target:
+            if index < len(LATENCY_BUCKETS):
+                return LATENCY_BUCKETS[index]
+            return float('inf')
+    return float('inf')
+
+
+def render_prometheus(snapshot, per_client=False):
+    """Текстовый формат Prometheus"""
+    lines = []
+    for name, value in sorted(snapshot['counters'].items()):
+        lines.append(f"# TYPE messenger_{name}_total counter")
+        lines.append(f"messenger_{name}_total {value}")
+    for name, value in sorted(snapshot['gauges'].items()):
+        lines.append(f"# TYPE messenger_{name} gauge")
+        lines.append(f"messenger_{name} {value}")
+
+    lines.append("# TYPE messenger_errors_total counter")
+    for kind, value in sorted(snapshot['errors'].items()):
+        lines.append(f'messenger_errors_total{{kind="{kind}"}} {value}')
+
+    latency = snapshot['ack_latency']
+    lines.append("# TYPE messenger_ack_latency_seconds histogram")
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, latency['buckets']):
+        cumulative += count
+        lines.append(f'messenger_ack_latency_seconds_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f'messenger_ack_latency_seconds_bucket{{le="+Inf"}} {latency["count"]}')
+    lines.append(f"messenger_ack_latency_seconds_sum {latency['sum']}")
+    lines.append(f"messenger_ack_latency_seconds_count {latency['count']}")
+
+    if per_client:
+        names = ('bytes_in', 'bytes_out', 'messages_in', 'messages_out', 'queue_bytes')
+        for index, name in enumerate(names, 1):
+            lines.append(f"# TYPE messenger_client_{name} gauge")
+            for client in snapshot['clients']:
+                lines.append(f'messenger_client_{name}{{client="{client[0]}"}} {client[index]}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsEndpoint:
+    """HTTP endpoint /metrics на локальном адресе"""
+
+    def __init__(self, snapshot_func, port, host='127.0.0.1', per_client=False):
+        self.snapshot_func = snapshot_func
+        self.per_client = per_client
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/metrics', '/'):
+                    self.send_error(404)
+                    return
+                body = render_prometheus(endpoint.snapshot_func(),
+                                         endpoint.per_client).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='metrics-http')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Параллельные этапы настройки
+Каждый этап - в своем фоновом потоке, общий срок на всю настройку,
+ожидание первого успешного этапа и отчет о времени каждого
+"""
+
+import threading
+import time
+
+# Общий срок автоматической настройки, сек
+DEFAULT_SETUP_TIMEOUT = 20.0
+
+
+class Stage:
+    """Один этап: результат, ошибка и время выполнения"""
+
+    __slots__ = ('name', 'started', 'finished', 'result', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.finished is not None
+
+    def elapsed(self, now=None):
+        end = self.finished if self.finished is not None else (now or time.monotonic())
+        return end - self.started
+
+    def status(self):
+        if not self.done:
+            return 'не дождались'
+        if self.error is not None:
+            return f"ошибка: {self.error}"
+        return 'успех' if self.result else 'неудача'
+
+
+class StageRunner:
+    """Запуск этапов в фоне под одним сроком.
+
+    Потоки - daemon: этап, не уложившийся в срок, не держит выход из
+    программы, его результат просто не ждут.
+    """
+
+    def __init__(self, timeout=DEFAULT_SETUP_TIMEOUT):
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.stages = {}
+        self.changed = threading.Condition()
+
+    def remaining(self):
+        """Сколько секунд осталось до общего срока"""
+        return max(0.0, self.deadline - time.monotonic())
+
+    def start(self, name, func, *args):
+        """Запустить этап в фоне"""
+        stage = Stage(name)
+        with self.changed:
+            self.stages[name] = stage
+        thread = threading.Thread(target=self._run, args=(stage, func, args),
+                                  name=f"stage-{name}")
+        thread.daemon = True
+        thread.start()
+        return stage
+
+    def _run(self, stage, func, args):
+        try:
+            result = func(*args)
+            error = None
+        except Exception as e:
+            result, error = None, e
+        with self.changed:
+            stage.result = result
+            stage.error = error
+            stage.finished = time.monotonic()
+            self.changed.notify_all()
+
+    def run(self, name, func, *args):
+        """Выполнить этап и дождаться его (в пределах срока)"""
+        self.start(name, func, *args)
+        return self.wait(name)
+
+    def wait(self, name):
+        """Результат этапа или None, если он не успел к сроку или упал"""
+        stage = self.stages[name]
+        with self.changed:
+            while not stage.done:
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+        return stage.result
+
+    def wait_first(self, names):
+        """Имя первого этапа из names с истинным результатом.
+        None - все закончились неудачей или истек срок."""
+        stages = [self.stages[name] for name in names if name in self.stages]
+        with self.changed:
+            while True:
+                for stage in stages:
+                    if stage.done and stage.result:
+                        return stage.name
+                if all(stage.done for stage in stages):
+                    return None
+                remaining = self.deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.changed.wait(remaining)
+
+    def report(self):
+        """Строки отчета: этап, время, итог (в порядке запуска)"""
+        now = time.monotonic()
+        with self.changed:
+            stages = list(self.stages.values())
+        width = max((len(stage.name) for stage in stages), default=0)
+        lines = [f"   {stage.name:<{width}}  {stage.elapsed(now):6.2f} сек  {stage.status()}"
+                 for stage in stages]
+        lines.append(f"   {'всего':<{width}}  {now - self.started:6.2f} сек")
+        return lines
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Индекс подписок: комнаты и пользователи
+Комната -> участники, пользователь -> его подключения; маршрутизация
+сообщения стоит пропорционально числу получателей
+"""
+
+import threading
+
+MAX_NAME_LENGTH = 64
+
+
+def valid_name(name):
+    """Имя комнаты или пользователя: непустое, без '|' и переводов строк"""
+    return (0 < len(name) <= MAX_NAME_LENGTH
+            and '|' not in name and '\n' not in name)
+
+
+class SubscriptionIndex:
+    """Прямые индексы для маршрутизации и обратные для отписки при отключении.
+
+    rooms: комната -> множество client_id
+    users: пользователь -> множество client_id (несколько телефонов)
+    client_rooms / client_user: что снять с клиента при отключении
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}
+        self.users = {}
+        self.client_rooms = {}
+        self.client_user = {}
+
+    def login(self, client_id, user):
+        """Привязать подключение к пользователю (повторный вход - смена имени)"""
+        with self.lock:
+            self._logout(client_id)
+            self.users.setdefault(user, set()).add(client_id)
+            self.client_user[client_id] = user
+
+    def user_of(self, client_id):
+        """Имя пользователя подключения или None"""
+        return self.client_user.get(client_id)
+
+    def join(self, client_id, room):
+        """Добавить клиента в комнату, вернуть число участников"""
+        with self.lock:
+            members = self.rooms.setdefault(room, set())
+            members.add(client_id)
+            self.client_rooms.setdefault(client_id, set()).add(room)
+            return len(members)
+
+    def leave(self, client_id, room):
+        """Убрать клиента из комнаты, вернуть True если он там был"""
+        with self.lock:
+            return self._leave(client_id, room)
+
+    def rooms_of(self, client_id):
+        """Комнаты клиента"""
+        with self.lock:
+            return tuple(self.client_rooms.get(client_id, ()))
+
+    def room_members(self, room):
+        """Кортеж client_id участников комнаты"""
+        with self.lock:
+            return tuple(self.rooms.get(room, ()))
+
+    def user_connections(self, user):
+        """Кортеж client_id всех подключений пользователя"""
+        with self.lock:
+            return tuple(self.users.get(user, ()))
+
+    def remove_client(self, client_id):
+        """Снять все подписки отключившегося клиента"""
+        with self.lock:
+            for room in tuple(self.client_rooms.get(client_id, ())):
+                self._leave(client_id, room)
+            self._logout(client_id)
+
+    def counts(self):
+        """(комнат, пользователей в сети)"""
+        return len(self.rooms), len(self.users)
+
+    def _leave(self, client_id, room):
+        members = self.rooms.get(room)
+        if not members or client_id not in members:
+            return False
+        members.discard(client_id)
+        if not members:
+            del self.rooms[room]
+        rooms = self.client_rooms.get(client_id)
+        if rooms is not None:
+            rooms.discard(room)
+            if not rooms:
+                del self.client_rooms[client_id]
+        return True
+
+    def _logout(self, client_id):
+        user = self.client_user.pop(client_id, None)
+        if user is None:
+            return
+        connections = self.users.get(user)
+        if connections is not None:
+            connections.discard(client_id)
+            if not connections:
+                del self.users[user]
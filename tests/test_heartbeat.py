@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Таймеры heartbeat при повторном client_id
+"""
+
+import socket
+import unittest
+
+from client_registry import ClientRecord
+from heartbeat import Heartbeat
+from message_framing import FrameDecoder, MODE_FRAMED
+from timer_wheel import TimerWheel
+
+
+class FakeServer:
+    """Сервер, который только запоминает отключения и PING"""
+
+    def __init__(self):
+        self.clients = {}
+        self.disconnected = []
+        self.controls = []
+        self.metrics = self
+        self.log = self
+
+    def error(self, name):
+        pass
+
+    def info(self, *args, **kwargs):
+        pass
+
+    def disconnect_client(self, client_id):
+        self.disconnected.append(client_id)
+        self.clients.pop(client_id, None)
+
+    def send_control(self, record, text):
+        self.controls.append((record.client_id, text))
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def test_cancelled_timer_does_not_fire(self):
+        wheel = TimerWheel(tick=1.0, slots=8)
+        now = wheel.next_tick
+        first = wheel.schedule('a', 1.0)
+        second = wheel.schedule('b', 1.0)
+        wheel.cancel(first)
+        self.assertEqual(len(wheel), 1)
+        self.assertEqual(wheel.advance(now), [second])
+        wheel.cancel(second)
+        self.assertEqual(len(wheel), 0)
+
+
+class HeartbeatReuseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = FakeServer()
+        self.heartbeat = Heartbeat(self.server, ping_interval=5, idle_timeout=10)
+        self.start = self.heartbeat.wheel.next_tick - self.heartbeat.wheel.tick
+
+    def connect(self, client_id='10.0.0.5:4000'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        decoder = FrameDecoder()
+        decoder.mode = MODE_FRAMED
+        record = ClientRecord(client_id, sock, ('10.0.0.5', 4000), decoder, None)
+        self.server.clients[client_id] = record
+        self.heartbeat.track(record)
+        return record
+
+    def test_reused_id_keeps_one_timer(self):
+        old = self.connect()
+        self.heartbeat.untrack(old.client_id)
+        del self.server.clients[old.client_id]
+        new = self.connect()
+        self.assertEqual(len(self.heartbeat.wheel), 1)
+        self.assertIs(self.heartbeat.timers[new.client_id].key, new.client_id)
+
+    def test_stale_timer_does_not_evict_new_client(self):
+        # Новый клиент с тем же id пришел через 2 сек после старого
+        self.connect()
+        self.heartbeat.tick(self.start + 2.5)
+        new = self.connect()
+        new.handshaking = True
+        # Таймер старого (срок 5 сек) отменен и по новому не срабатывает
+        self.heartbeat.tick(self.start + 5.5)
+        self.assertEqual(self.server.disconnected, [])
+        self.assertEqual(len(self.heartbeat.wheel), 1)
+        # Свой таймер нового клиента срабатывает в срок
+        self.heartbeat.tick(self.start + 7.5)
+        self.assertEqual(self.server.disconnected, [new.client_id])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+Рукопожатие и разбор кадров при приходе данных по частям
+"""
+
+import unittest
+
+from message_framing import (FrameDecoder, MODE_FRAMED, MODE_RAW, encode_message)
+
+
+def feed_bytes(decoder, data):
+    """Скормить данные по одному байту, собрать все сообщения"""
+    messages = []
+    for i in range(len(data)):
+        messages += decoder.feed(data[i:i + 1])
+    return messages
+
+
+class HandshakeTest(unittest.TestCase):
+
+    def test_handshake_one_byte_at_a_time(self):
+        decoder = FrameDecoder()
+        messages = feed_bytes(decoder, b'PROTO|framed\n' + encode_message('привет', MODE_FRAMED))
+        self.assertEqual(decoder.mode, MODE_FRAMED)
+        self.assertEqual(messages, ['привет'])
+        self.assertEqual(decoder.take_handshake_reply(), b'PROTO_OK|framed\n')
+
+    def test_split_prefix(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b'PRO'), [])
+        self.assertIsNone(decoder.mode)
+        self.assertEqual(decoder.feed(b'TO|framed\n'), [])
+        self.assertEqual(decoder.mode, MODE_FRAMED)
+
+    def test_raw_client(self):
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b'hello'), ['hello'])
+        self.assertEqual(decoder.mode, MODE_RAW)
+
+    def test_raw_after_partial_prefix(self):
+        # Префикс перестал совпадать - это старый клиент, буфер уходит сообщением
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(b'PR'), [])
+        self.assertEqual(decoder.feed(b'INT hi'), ['PRINT hi'])
+        self.assertEqual(decoder.mode, MODE_RAW)
+
+
+if __name__ == '__main__':
+    unittest.main()
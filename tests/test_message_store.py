@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""
+Ротация сегментов журнала и индекс каналов
+"""
+
+import shutil
+import tempfile
+import unittest
+
+from message_store import MessageStore
+
+
+class RetentionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def fill(self, store, count):
+        for i in range(count):
+            store.append('x' * 200, 'user', 'old' if i < 20 else 'new')
+
+    def test_retention_trims_channel_index(self):
+        store = MessageStore(self.directory, segment_bytes=2048, max_segments=3)
+        self.addCleanup(store.close)
+        self.fill(store, 20)
+        self.assertEqual(len(store.channels['old']), 20)
+        for _ in range(5):
+            self.fill(store, 40)
+        self.assertEqual(len(store.segments), 3)
+        # Канал целиком в удаленных сегментах - его больше нет в индексе
+        self.assertNotIn('old', store.channels)
+        first = store.bases[0]
+        self.assertGreaterEqual(store.channels['new'][0], first)
+        self.assertEqual(len(store.channels['new']), store.next_seq - first)
+
+    def test_readonly_refresh_trims_channel_index(self):
+        writer = MessageStore(self.directory, segment_bytes=2048, max_segments=3, shared=True)
+        self.addCleanup(writer.close)
+        self.fill(writer, 20)
+        reader = MessageStore(self.directory, readonly=True)
+        self.addCleanup(reader.close)
+        self.assertIn('old', reader.channels)
+        for _ in range(5):
+            self.fill(writer, 40)
+        reader.refresh()
+        self.assertNotIn('old', reader.channels)
+        self.assertEqual(reader.bases, writer.bases)
+        self.assertEqual(list(reader.channels['new']), list(writer.channels['new']))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Продление аренды NAT-PMP против поддельного роутера на 127.0.0.1
+"""
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import port_mapping
+from port_mapping import LeaseManager, NatPmpMapper
+
+
+class FakeNatPmp:
+    """NAT-PMP роутер на UDP сокете: хранит пробросы, выдает заданный срок"""
+
+    def __init__(self, granted=10, external_ip='203.0.113.7'):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.granted = granted
+        self.external_ip = external_ip
+        self.epoch = 1000
+        # (код операции, внутренний порт) -> внешний порт
+        self.mappings = {}
+        # Занятые внешние порты: запрошенный -> выдаваемый вместо него
+        self.busy = {}
+        # (код операции, внутренний порт, запрошенный порт, срок)
+        self.requests = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reboot(self):
+        """Роутер перезагрузился: пробросы забыты, epoch начался заново"""
+        with self.lock:
+            self.mappings.clear()
+            self.epoch = 5
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(64)
+            except OSError:
+                return
+            with self.lock:
+                reply = self._handle(data)
+            self.sock.sendto(reply, address)
+
+    def _handle(self, data):
+        if data[1] == 0:
+            return struct.pack('!BBHI', 0, 128, 0, self.epoch) + socket.inet_aton(self.external_ip)
+        _, opcode, _, internal, suggested, lifetime = struct.unpack('!BBHHHI', data)
+        self.requests.append((opcode, internal, suggested, lifetime))
+        if lifetime == 0:
+            self.mappings.pop((opcode, internal), None)
+            external, granted = 0, 0
+        else:
+            external = self.mappings.get((opcode, internal)) or self.busy.get(suggested, suggested)
+            self.mappings[(opcode, internal)] = external
+            granted = min(lifetime, self.granted)
+        return struct.pack('!BBHIHHI', 0, opcode + 128, 0, self.epoch, internal, external, granted)
+
+    def map_requests(self):
+        with self.lock:
+            return [request for request in self.requests if request[3]]
+
+    def close(self):
+        self.sock.close()
+
+
+class LeaseManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.router = FakeNatPmp(granted=10)
+        self.addCleanup(self.router.close)
+        self.mapper = NatPmpMapper('127.0.0.1', self.router.port)
+
+    def manager(self, ports=(9001,), **options):
+        manager = LeaseManager(list(ports), mappers=[self.mapper], lifetime=3600, **options)
+        manager._report = lambda *args: None
+        return manager
+
+    def test_renews_at_half_of_granted_lifetime(self):
+        manager = self.manager()
+        self.assertEqual(manager.renew_due(now=100.0), 5.0)
+        self.assertEqual(len(self.router.map_requests()), 1)
+        self.assertTrue(manager.leases[0].active)
+
+        self.assertEqual(manager.renew_due(now=104.0), 1.0)
+        self.assertEqual(len(self.router.map_requests()), 1)
+
+        manager.renew_due(now=105.0)
+        self.assertEqual(len(self.router.map_requests()), 2)
+        self.assertEqual(manager.renewals, 2)
+
+    def test_renewal_requests_granted_port(self):
+        self.router.busy[9001] = 19001
+        manager = self.manager()
+        manager.renew_due(now=100.0)
+        self.assertEqual(manager.leases[0].mapped_port, 19001)
+
+        manager.renew_due(now=105.0)
+        first, second = self.router.map_requests()
+        self.assertEqual(first[2], 9001)
+        self.assertEqual(second[2], 19001)
+        self.assertEqual(manager.leases[0].mapped_port, 19001)
+        self.assertEqual(list(self.router.mappings.values()), [19001])
+
+    def test_reboot_recreates_all_mappings(self):
+        manager = self.manager(ports=(9001, 9002))
+        manager.renew_due(now=100.0)
+        self.assertEqual(len(self.router.mappings), 2)
+
+        self.router.reboot()
+        # Первым подходит срок одной аренды - ее ответ показывает новый epoch
+        manager.leases[0].renew_at = 101.0
+        manager.renew_due(now=101.0)
+        self.assertTrue(self.mapper.rebooted)
+        self.assertEqual(len(self.router.mappings), 1)
+
+        # Вторая аренда создается заново сразу, не дожидаясь своего срока
+        manager.renew_due(now=101.5)
+        self.assertFalse(self.mapper.rebooted)
+        self.assertEqual(len(self.router.mappings), 2)
+
+    def test_stop_removes_mappings_once(self):
+        manager = self.manager(ports=(9001, 9002))
+        manager.renew_due(now=100.0)
+        manager.stop()
+        self.assertEqual(self.router.mappings, {})
+        self.assertFalse(any(lease.active for lease in manager.leases))
+        requests = len(self.router.requests)
+        manager.stop()
+        self.assertEqual(len(self.router.requests), requests)
+
+    def test_stop_without_remove_keeps_mappings(self):
+        manager = self.manager()
+        manager.renew_due(now=100.0)
+        manager.stop(remove=False)
+        manager.stop()
+        self.assertEqual(len(self.router.mappings), 1)
+
+    def test_background_thread_renews(self):
+        self.router.granted = 1
+        manager = self.manager()
+        manager.start()
+        time.sleep(1.3)
+        manager.stop()
+        self.assertGreaterEqual(manager.renewals, 2)
+        self.assertEqual(self.router.mappings, {})
+
+
+class NatPmpMapperTest(unittest.TestCase):
+
+    def test_no_responder_fails_fast(self):
+        # Порт без слушателя: ICMP отказ приходит сразу, повторов не ждем
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        started = time.monotonic()
+        with self.assertRaises(port_mapping.MappingError):
+            NatPmpMapper('127.0.0.1', port).external_ip()
+        self.assertLess(time.monotonic() - started, 1.0)
+
+
+class RecordingMapper:
+    """Способ проброса, который только запоминает снятые правила"""
+
+    def __init__(self):
+        self.removed = []
+
+    def remove(self, protocol, external_port, internal_port):
+        self.removed.append((protocol, external_port))
+
+
+class UndoMappingsTest(unittest.TestCase):
+
+    def report(self, method, ports):
+        report = port_mapping.MappingReport(method)
+        report.results = [port_mapping.MappingResult('TCP', port, port, 60) for port in ports]
+        return report
+
+    def test_keeps_ports_of_winner(self):
+        # Общая таблица правил: снимать порт победителя нельзя
+        mapper = RecordingMapper()
+        loser = self.report('UPnP', (8888, 8889, 8890))
+        winner = self.report('NAT-PMP', (8888, 8889))
+        self.assertEqual(port_mapping.undo_mappings(mapper, loser, keep=winner), 1)
+        self.assertEqual(mapper.removed, [('TCP', 8890)])
+
+    def test_without_winner_removes_all(self):
+        mapper = RecordingMapper()
+        self.assertEqual(port_mapping.undo_mappings(mapper, self.report('UPnP', (1, 2))), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
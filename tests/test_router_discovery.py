@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""
+Поиск роутера против локальных слушателей вместо настоящих шлюзов
+"""
+
+import socket
+import time
+import unittest
+
+import router_discovery
+
+
+def listener(address='127.0.0.1', backlog=16):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((address, 0))
+    sock.listen(backlog)
+    return sock
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ProbeFirstTest(unittest.TestCase):
+
+    def black_hole(self):
+        """Слушатель с переполненной очередью: ядро молча отбрасывает SYN,
+        и подключение к нему висит, как к выключенному роутеру"""
+        sock = listener('127.0.0.3', backlog=0)
+        self.addCleanup(sock.close)
+        port = sock.getsockname()[1]
+        for _ in range(4):
+            filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            filler.setblocking(False)
+            filler.connect_ex(('127.0.0.3', port))
+            self.addCleanup(filler.close)
+        time.sleep(0.1)
+        return port
+
+    def test_returns_listening_candidate(self):
+        server = listener('127.0.0.2')
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        ip, elapsed = router_discovery.probe_first(['127.0.0.4', '127.0.0.2', '127.0.0.5'],
+                                                   port, timeout=1.0)
+        self.assertEqual(ip, '127.0.0.2')
+        self.assertLess(elapsed, 1.0)
+
+    def test_answer_does_not_wait_for_silent_candidates(self):
+        port = self.black_hole()
+        # Тот же порт на другом адресе - кандидат, который отвечает
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.2', port))
+        server.listen(16)
+        self.addCleanup(server.close)
+        started = time.monotonic()
+        ip, _ = router_discovery.probe_first(['127.0.0.3', '127.0.0.2'], port, timeout=2.0)
+        self.assertEqual(ip, '127.0.0.2')
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_gives_up_at_deadline(self):
+        port = self.black_hole()
+        started = time.monotonic()
+        ip, elapsed = router_discovery.probe_first(['127.0.0.3'], port, timeout=0.3)
+        spent = time.monotonic() - started
+        self.assertIsNone(ip)
+        self.assertIsNone(elapsed)
+        self.assertGreaterEqual(spent, 0.25)
+        self.assertLess(spent, 0.8)
+
+    def test_refused_candidates_return_none_quickly(self):
+        started = time.monotonic()
+        ip, _ = router_discovery.probe_first(['127.0.0.1', '127.0.0.2'], free_port(),
+                                             timeout=2.0)
+        self.assertIsNone(ip)
+        self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_discover_router_prefers_answering_candidate(self):
+        server = listener('127.0.0.2')
+        self.addCleanup(server.close)
+        ip, source = router_discovery.discover_router(port=server.getsockname()[1],
+                                                      timeout=1.0, candidates=['127.0.0.2'])
+        self.assertEqual(ip, '127.0.0.2')
+        self.assertIn('мс', source)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_ip_route(self):
+        output = "default via 192.168.1.1 dev wlan0 proto dhcp metric 600\n"
+        self.assertEqual(router_discovery.parse_ip_route(output), ['192.168.1.1'])
+
+    def test_ipconfig_gateway_after_ipv6(self):
+        output = ("   Default Gateway . . . . . . . . . : fe80::1%12\n"
+                  "                                       192.168.1.1\n"
+                  "   DHCP Server . . . . . . . . . . . : 192.168.1.2\n")
+        self.assertEqual(router_discovery.parse_ipconfig(output), ['192.168.1.1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Колесо таймеров (hashed timing wheel)
+Добавление таймера и срабатывание - O(1), стоимость тика не зависит от числа таймеров
+"""
+
+import math
+import threading
+import time
+
+
+class Timer:
+    """Запланированный таймер (его же возвращает advance)"""
+
+    __slots__ = ('key', 'rounds', 'cancelled')
+
+    def __init__(self, key, rounds):
+        self.key = key
+        self.rounds = rounds
+        self.cancelled = False
+
+
+class TimerWheel:
+    """Колесо из slots корзин по tick секунд.
+
+    Таймер дальше одного оборота хранит число оставшихся оборотов.
+    Таймеры ленивые - активность клиента не трогает колесо вообще,
+    владелец сам решает при срабатывании, что делать. cancel нужен,
+    когда ключ переходит к другому владельцу (тот же client_id).
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = 0
+        self.next_tick = time.monotonic() + tick
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, key, delay):
+        """Запланировать key через delay секунд (с точностью до тика), вернуть Timer"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        size = len(self.slots)
+        timer = Timer(key, (ticks - 1) // size)
+        with self.lock:
+            index = (self.current + ticks) % size
+            self.slots[index].append(timer)
+            self.count += 1
+        return timer
+
+    def cancel(self, timer):
+        """Отменить таймер (сработавший или отмененный - ничего не делать).
+        Из корзины он уходит при ее проходе, до того просто пропускается."""
+        with self.lock:
+            if not timer.cancelled and timer.rounds >= 0:
+                timer.cancelled = True
+                self.count -= 1
+
+    def advance(self, now=None):
+        """Провернуть колесо до now, вернуть список сработавших Timer"""
+        now = time.monotonic() if now is None else now
+        if now < self.next_tick:
+            return []
+        due = []
+        with self.lock:
+            while now >= self.next_tick:
+                self.current = (self.current + 1) % len(self.slots)
+                self.next_tick += self.tick
+                bucket = self.slots[self.current]
+                if not bucket:
+                    continue
+                waiting = []
+                for timer in bucket:
+                    if timer.cancelled:
+                        continue
+                    if timer.rounds:
+                        timer.rounds -= 1
+                        waiting.append(timer)
+                    else:
+                        # Сработал: rounds < 0 - отменять больше нечего
+                        timer.rounds = -1
+                        due.append(timer)
+                self.slots[self.current] = waiting
+            self.count -= len(due)
+        return due
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TLS для сервера
+Самоподписанный сертификат для тестов и контекст ssl с возобновлением сессий
+"""
+
+import datetime
+import os
+import shutil
+import ssl
+import subprocess
+
+import network_info
+
+DEFAULT_CERT = os.path.join('certs', 'server.crt')
+DEFAULT_KEY = os.path.join('certs', 'server.key')
+CERT_DAYS = 365
+
+# Сколько TLS 1.3 билетов сессии выдавать на подключение (по одному на переподключение)
+SESSION_TICKETS = 2
+
+
+def _subject_alt_names():
+    """localhost и все IPv4 адреса машины - телефон может прийти на любой"""
+    addresses = {'127.0.0.1'}
+    addresses.update(ip for _, ip in network_info.get_interfaces())
+    return ['localhost'], sorted(addresses)
+
+
+def _generate_with_openssl(cert_path, key_path, common_name):
+    names, addresses = _subject_alt_names()
+    alt_names = ','.join([f"DNS:{name}" for name in names] + [f"IP:{ip}" for ip in addresses])
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec',
+                    '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+                    '-days', str(CERT_DAYS), '-subj', f"/CN={common_name}",
+                    '-addext', f"subjectAltName={alt_names}",
+                    '-keyout', key_path, '-out', cert_path],
+                   check=True, capture_output=True)
+
+
+def _generate_with_cryptography(cert_path, key_path, common_name):
+    import ipaddress
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    names, addresses = _subject_alt_names()
+    key = ec.generate_private_key(ec.SECP256R1())
+    subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    alt_names = ([x509.DNSName(name) for name in names]
+                 + [x509.IPAddress(ipaddress.ip_address(ip)) for ip in addresses])
+    certificate = (x509.CertificateBuilder()
+                   .subject_name(subject).issuer_name(subject)
+                   .public_key(key.public_key())
+                   .serial_number(x509.random_serial_number())
+                   .not_valid_before(now)
+                   .not_valid_after(now + datetime.timedelta(days=CERT_DAYS))
+                   .add_extension(x509.SubjectAlternativeName(alt_names), critical=False)
+                   .sign(key, hashes.SHA256()))
+    with open(key_path, 'wb') as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM,
+                                  serialization.PrivateFormat.PKCS8,
+                                  serialization.NoEncryption()))
+    with open(cert_path, 'wb') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+
+def ensure_certificate(cert_path=DEFAULT_CERT, key_path=DEFAULT_KEY, common_name='messenger'):
+    """Создать самоподписанный сертификат, если его еще нет. True - создан новый"""
+    if os.path.exists(cert_path) and os.path.exists(key_path):
+        return False
+    for path in (cert_path, key_path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    if shutil.which('openssl'):
+        _generate_with_openssl(cert_path, key_path, common_name)
+    else:
+        try:
+            _generate_with_cryptography(cert_path, key_path, common_name)
+        except ImportError:
+            raise RuntimeError("Для создания сертификата нужен openssl или "
+                               "pip install cryptography")
+    try:
+        os.chmod(key_path, 0o600)
+    except OSError:
+        pass
+    return True
+
+
+def make_server_context(cert_path, key_path):
+    """Контекст сервера: TLS 1.2+, кэш сессий и билеты для быстрого переподключения.
+
+    Билеты TLS 1.3 шифруются ключом этого контекста, поэтому возобновление
+    работает в пределах одного процесса (в каждом воркере - свой ключ).
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_path, key_path)
+    if hasattr(context, 'num_tickets'):
+        context.num_tickets = SESSION_TICKETS
+    return context
+
+
+def make_client_context(cafile):
+    """Контекст клиента для тестов: доверяет только нашему сертификату"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.load_verify_locations(cafile)
+    context.check_hostname = False
+    return context
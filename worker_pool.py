@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Многопроцессный режим сервера
+N процессов слушают один порт через SO_REUSEPORT, ядро делит подключения
+"""
+
+import itertools
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+
+def reuse_port_supported():
+    """Есть ли SO_REUSEPORT с балансировкой (Linux 3.9+, FreeBSD 12+)"""
+    return hasattr(socket, 'SO_REUSEPORT') and os.name != 'nt'
+
+
+class WorkerBus:
+    """Связь процесса-воркера с главным процессом"""
+
+    def __init__(self, worker_id, commands, events):
+        self.worker_id = worker_id
+        self.commands = commands
+        self.events = events
+
+    def publish_broadcast(self, message):
+        """Рассылка на весь парк воркеров через главный процесс"""
+        self.events.put(('broadcast', self.worker_id, message))
+
+    def publish(self, channel, sender, text, origin):
+        """Сообщение в комнату/пользователю - главный процесс раздаст всем воркерам"""
+        self.events.put(('publish', self.worker_id, channel, sender, text, origin))
+
+    def reply(self, request_id, payload):
+        """Ответ на запрос главного процесса"""
+        self.events.put(('reply', request_id, self.worker_id, payload))
+
+
+def worker_main(worker_id, port, server_options, commands, events):
+    """Точка входа процесса-воркера"""
+    # Импорт здесь - messenger_server сам импортирует этот модуль
+    from messenger_server import SimpleTestServer
+
+    options = dict(server_options)
+    if options.get('log_file'):
+        # У каждого воркера свой файл - ротация не конфликтует между процессами
+        options['log_file'] = f"{options['log_file']}.worker{worker_id}"
+    if options.get('store_dir'):
+        # Журнал рассылок пишет главный процесс, входящие - свои у воркера
+        options['store_readonly'] = True
+        options['inbox_name'] = f"inbox.worker{worker_id}"
+    server = SimpleTestServer(port=port, reuse_port=True, **options)
+    server.bus = WorkerBus(worker_id, commands, events)
+    try:
+        server.listen()
+        server.start_engine()
+    except Exception as e:
+        events.put(('failed', worker_id, f"{type(e).__name__}: {e}"))
+        return
+    events.put(('ready', worker_id, os.getpid()))
+
+    try:
+        while server.server_running:
+            command = commands.get()
+            kind = command[0]
+            if kind == 'stop':
+                break
+            elif kind == 'broadcast':
+                server.broadcast_local(command[1], command[2])
+            elif kind == 'deliver':
+                server.deliver_local(*command[1:])
+            elif kind == 'snapshot':
+                server.bus.reply(command[1], server.snapshot())
+    except (KeyboardInterrupt, EOFError):
+        pass
+    finally:
+        server.stop()
+
+
+class WorkerPool:
+    """Главный процесс: запуск воркеров и шина между ними"""
+
+    def __init__(self, port, workers, server_options, on_broadcast=None, on_publish=None):
+        self.port = port
+        # Рассылка от воркера проходит через главный процесс (журнал, seq)
+        self.on_broadcast = on_broadcast or self.broadcast
+        self.on_publish = on_publish or self._publish_unstored
+        self.size = workers
+        self.server_options = server_options
+        self.context = multiprocessing.get_context()
+        self.events = self.context.Queue()
+        self.workers = {}
+        self.pids = {}
+        self.request_ids = itertools.count(1)
+        self.replies = {}
+        self.replies_ready = threading.Condition()
+        self.relay_thread = None
+        self.running = False
+
+    def start(self, timeout=10.0):
+        """Запустить воркеров и дождаться их готовности"""
+        self.running = True
+        for worker_id in range(self.size):
+            commands = self.context.Queue()
+            process = self.context.Process(
+                target=worker_main,
+                args=(worker_id, self.port, self.server_options, commands, self.events),
+                name=f"messenger-worker-{worker_id}"
+            )
+            process.daemon = True
+            process.start()
+            self.workers[worker_id] = (process, commands)
+
+        deadline = time.monotonic() + timeout
+        pending = set(self.workers)
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"Воркеры не запустились: {sorted(pending)}")
+            event = self.events.get(timeout=remaining)
+            if event[0] == 'ready':
+                pending.discard(event[1])
+                self.pids[event[1]] = event[2]
+            elif event[0] == 'failed':
+                raise RuntimeError(f"Воркер {event[1]} не запустился: {event[2]}")
+
+        self.relay_thread = threading.Thread(target=self._relay)
+        self.relay_thread.daemon = True
+        self.relay_thread.start()
+
+    def _relay(self):
+        """Разбор событий от воркеров"""
+        while self.running:
+            try:
+                event = self.events.get(timeout=1.0)
+            except Exception:
+                continue
+            kind = event[0]
+            if kind == 'broadcast':
+                self.on_broadcast(event[2])
+            elif kind == 'publish':
+                self.on_publish(*event[2:])
+            elif kind == 'reply':
+                _, request_id, worker_id, payload = event
+                with self.replies_ready:
+                    if request_id in self.replies:
+                        self.replies[request_id][worker_id] = payload
+                        self.replies_ready.notify_all()
+
+    def broadcast(self, message, seq=None):
+        """Отправить сообщение клиентам всех воркеров"""
+        for process, commands in self.workers.values():
+            if process.is_alive():
+                commands.put(('broadcast', message, seq))
+
+    def _publish_unstored(self, channel, sender, text, origin):
+        """Доставка без журнала (seq 0)"""
+        self.deliver(channel, 0, sender, text, origin)
+
+    def deliver(self, channel, seq, sender, text, origin=None):
+        """Доставка сообщения канала: каждый воркер сам найдет своих подписчиков"""
+        for process, commands in self.workers.values():
+            if process.is_alive():
+                commands.put(('deliver', channel, seq, sender, text, origin))
+
+    def collect(self, timeout=2.0):
+        """Собрать снимки состояния со всех живых воркеров: {worker_id: snapshot}"""
+        request_id = next(self.request_ids)
+        alive = [worker_id for worker_id, (process, _) in self.workers.items()
+                 if process.is_alive()]
+        with self.replies_ready:
+            self.replies[request_id] = {}
+        for worker_id in alive:
+            self.workers[worker_id][1].put(('snapshot', request_id))
+
+        deadline = time.monotonic() + timeout
+        with self.replies_ready:
+            while len(self.replies[request_id]) < len(alive):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.replies_ready.wait(remaining)
+            return self.replies.pop(request_id)
+
+    def alive_count(self):
+        """Сколько воркеров живо"""
+        return sum(1 for process, _ in self.workers.values() if process.is_alive())
+
+    def stop(self, timeout=5.0):
+        """Остановить всех воркеров"""
+        self.running = False
+        for process, commands in self.workers.values():
+            if process.is_alive():
+                commands.put(('stop',))
+        deadline = time.monotonic() + timeout
+        for process, _ in self.workers.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()